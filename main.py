@@ -1,8 +1,10 @@
 import argparse
+import json
 from datetime import datetime, timedelta
 import logging
-from re import I
+import time
 from requests.exceptions import HTTPError
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -14,10 +16,29 @@ from pipeline.ceden import CEDEN
 from pipeline.nerrs import NERRS
 from pipeline.hawaii import Hawaii
 from pipeline.oregon import Oregon
+from pipeline.aggregate import aggregate_data, frequencies
+from pipeline.analysis import write_exceedance_summary
+from pipeline.profiling import write_profile
+from pipeline.carbonate import add_derived_parameters, inputs as carbonate_inputs
+from pipeline.coverage import CoverageStore
+from pipeline.dedup import fingerprints, remove_duplicates, sharing_stations
+from pipeline.sinks import ParquetArchive, StationSummary
+from pipeline.spatial import read_polygon, select_stations
+from pipeline import checkpoint
+from pipeline import utils
+from pipeline import incremental
+from pipeline import manifest
+from pipeline import service
+from pipeline import workqueue
+from pipeline.ledger import FetchLedger
+from pipeline.spill import SpilledFrames, apply, cleanup, parse_size
 
 HERE = Path(__file__).resolve().parent
 STATIONS = HERE / 'pipeline' / 'metadata' / 'stations.csv'
 
+# --preview keeps one sample per station per day
+PREVIEW_THIN = 24 * 60
+
 collectors = {
     "NERRS": NERRS(),
     "OOI": ERDDAP("https://erddap.dataexplorer.oceanobservatories.org/erddap/"),
@@ -33,7 +54,24 @@ formatters = {
     "Oregon": Oregon,
 }
 
-def collect_data(state, start_time, end_time):
+# written alongside the agency files from the same batches
+sinks = {
+    "archive": ParquetArchive,
+    "summary": StationSummary,
+}
+
+def get_state_stations(state, station_ids=None):
+    """ Rows of stations.csv in state, optionally limited to station_ids """
+    stations = pd.read_csv(STATIONS, index_col="station_id")
+    state_stations = stations[stations['state'] == state]
+    if station_ids is not None:
+        state_stations = state_stations[state_stations.index.isin(station_ids)]
+    return state_stations[state_stations["provider"] != "Test"]
+
+def collect_data(
+    state, start_time, end_time, thin=None, station_ids=None,
+    results_directory=None, ledger=None, max_memory=None, parameters=None
+):
     """ Collects all data from state in time period 
     
     Args:
@@ -42,48 +80,371 @@ def collect_data(state, start_time, end_time):
             for the input time period. 
         start_time (datetime):  earliest date from which to collect
         end_time (datetime):  latest date from which to collect 
+        thin (int): if set, collect at most one sample per `thin` minutes
+            for each series. Thinned server side where providers allow it.
+        station_ids (list): if set, only these stations from state are queried
+        results_directory (Path): if set, each station's data is checkpointed
+            here as soon as it is collected, and stations that already have
+            a checkpoint are loaded instead of collected again.
+        ledger (FetchLedger): where each collector call is logged. Defaults
+            to the shared ledger in output/.
+        max_memory (int): if set, bytes of collected data held in memory.
+            Stations past it are spilled to disk.
+        parameters (list): if set, only these normalized parameters are
+            requested from providers
     Returns:
-        data (pd.DataFrame): Table containing all data points
+        data (pd.DataFrame): Table containing all data points, or
+            SpilledFrames of one frame per station if max_memory is set
     """
-    stations = pd.read_csv(STATIONS, index_col="station_id")
-    state_stations = stations[stations['state'] == state]
-    all_station_data = []
+    state_stations = get_state_stations(state, station_ids)
+    if ledger is None:
+        ledger = FetchLedger()
+    completed = set()
+    if results_directory is not None:
+        completed = checkpoint.completed_stations(results_directory)
+    all_station_data = [] if max_memory is None else SpilledFrames(max_memory)
     for index, row in state_stations.iterrows():
-        logging.info(f"Collecting data from {index}")
-        if row["provider"] == "Test":
+        if index in completed:
+            logging.info(f"Loading checkpoint of {index}")
+            all_station_data.append(checkpoint.load_checkpoint(results_directory, index))
+            continue
+        station_data = collect_station(
+            index, row["provider"], start_time, end_time, thin=thin,
+            ledger=ledger, parameters=parameters
+        )
+        if station_data is None:
             continue
-        try:
-            collector = collectors[row["provider"]]
-            station_data = collector.get_data(index, start_time, end_time)
-            logging.info(f"Collected {len(station_data)} rows from {index}")
-            all_station_data.append(station_data)
-        except HTTPError as e:
+        all_station_data.append(station_data)
+        if results_directory is not None:
+            checkpoint.save_checkpoint(results_directory, index, station_data)
+            incremental.save_fingerprints(results_directory, [index])
+    if max_memory is not None:
+        return all_station_data
+    data = pd.concat(all_station_data)
+    return data
+
+def collect_station(
+    station_id, provider, start_time, end_time, thin=None, ledger=None, parameters=None
+):
+    """ Collects one station's data and logs the call to the ledger
+
+    Args:
+        station_id (str): station to collect
+        provider (str): its provider in stations.csv
+        others: same as collect_data
+    Returns:
+        (pd.DataFrame): standardized data, or None if the provider failed
+            or has no collector. Other errors are logged to the ledger and
+            raised.
+    """
+    if ledger is None:
+        ledger = FetchLedger()
+    logging.info(f"Collecting data from {station_id}")
+    started = time.perf_counter()
+    try:
+        collector = collectors[provider]
+        station_data = collector.get_data(
+            station_id, start_time, end_time, thin=thin, parameters=parameters
+        )
+    except Exception as e:
+        # every failed call is logged, so plans see failures too
+        if provider in collectors:
+            ledger.record(
+                provider, station_id, start_time, end_time,
+                time.perf_counter() - started, type(e).__name__, thin=thin
+            )
+        if isinstance(e, HTTPError):
             logging.warning(e)
-        except KeyError as e:
-            logging.warning(f"{row['provider']} collector not implemented")
+        elif isinstance(e, KeyError):
+            logging.warning(f"{provider} collector not implemented")
             logging.info(e, exc_info=True)
-    data = pd.concat(all_station_data)
+        else:
+            raise
+        return None
+    ledger.record(
+        provider, station_id, start_time, end_time,
+        time.perf_counter() - started, "ok", data=station_data, thin=thin,
+        requests=collector.request_count(station_id, parameters)
+    )
+    logging.info(f"Collected {len(station_data)} rows from {station_id}")
+    return station_data
+
+def query(
+    state, start_time, end_time, parameters=None, station_ids=None, store=None, ledger=None
+):
+    """ Data of a state's stations, read through the local coverage store
+
+    Only the days of the period the store does not cover yet are fetched
+    from the collectors, and stored for the next query. Everything else is
+    served from disk.
+
+    Args:
+        state (str): state whose stations are queried
+        start_time (datetime): earliest time of the data
+        end_time (datetime): latest time of the data
+        parameters (list): if set, only these normalized parameters
+        station_ids (list): if set, only these stations from state
+        store (CoverageStore): defaults to the store in output/store
+        ledger (FetchLedger): where fetches are logged
+    Returns:
+        (pd.DataFrame): standardized data of the period
+    """
+    if store is None:
+        store = CoverageStore()
+    station_data = []
+    for index, row in get_state_stations(state, station_ids).iterrows():
+        for gap_start, gap_end in store.gaps(index, start_time, end_time, parameters):
+            data = collect_station(
+                index, row["provider"], gap_start, gap_end, ledger=ledger, parameters=parameters
+            )
+            if data is not None:
+                store.save(index, gap_start, gap_end, data, parameters)
+        station_data.append(store.load(index, start_time, end_time, parameters))
+    if not station_data:
+        return pd.DataFrame()
+    return pd.concat(station_data, ignore_index=True)
+
+def plan_collection(
+    state, start_time, end_time, thin=None, station_ids=None, ledger=None, parameters=None
+):
+    """ Estimates the cost of collect_data from past runs without fetching
+
+    Args:
+        same as collect_data
+    Returns:
+        (pd.DataFrame): estimated requests, rows, in-memory size of the
+            standardized data and seconds of each station, and the number
+            of past calls each estimate is based on
+    """
+    if ledger is None:
+        ledger = FetchLedger()
+    history = ledger.history()
+    plan = []
+    for index, row in get_state_stations(state, station_ids).iterrows():
+        estimate = {"station_id": index, "provider": row["provider"], "requests": None}
+        if row["provider"] in collectors:
+            estimate["requests"] = collectors[row["provider"]].request_count(index, parameters)
+        estimate.update(ledger.estimate(
+            row["provider"], index, start_time, end_time, thin=thin, history=history
+        ))
+        plan.append(estimate)
+    plan = pd.DataFrame(plan).set_index("station_id")
+    plan.loc["TOTAL", ["requests", "rows", "memory_bytes", "seconds"]] = plan[
+        ["requests", "rows", "memory_bytes", "seconds"]
+    ].sum()
+    return plan
+
+def reformat_data(
+    state, results_directory, station_ids=None, aggregate=None, derive=False,
+    deduplicate=True, max_memory=None, extra_sinks=(), compress=False, excel=False, analyze=False
+):
+    """ Applies metadata changes to a finished run without collecting again
+
+    Checkpoints of stations whose rows in stations.csv or
+    station_parameter_metadata.csv changed are enriched again from their
+    raw parameter names, and only the output files holding those stations
+    are rewritten. If duplicates are removed, files of stations sharing a
+    sample with a changed station, before or after the change, are
+    rewritten too, as which of their rows survive may have changed.
+
+    Args:
+        state (str): state of the run
+        results_directory (Path): directory of the run
+        station_ids (list): station selection of the run
+        aggregate (str): aggregation frequency of the run, if any
+        derive (bool): whether the run derived carbonate system parameters
+        deduplicate (bool): whether the run removed cross provider duplicates
+        max_memory (int): bytes of data held in memory by the run, if limited
+        extra_sinks (list): sinks the run wrote, which are written again in full
+        compress (bool): whether the run gzipped its csv files
+        excel (bool): whether the run saved xlsx workbooks
+        analyze (bool): whether the run saved an exceedance summary, which
+            is saved again
+    Returns:
+        (list): ids of the stations that were reformatted
+    """
+    completed = checkpoint.completed_stations(results_directory)
+    # same order as collect_data, so batches hold the same stations as before
+    state_stations = get_state_stations(state, station_ids)
+    state_stations = state_stations[state_stations.index.isin(completed)]
+    changed = incremental.changed_stations(results_directory, list(state_stations.index))
+    if not changed:
+        logging.info("No station metadata changed since the last run")
+        return []
+    all_station_data = [] if max_memory is None else SpilledFrames(max_memory)
+    # samples of changed stations, as enriched before and after the change
+    changed_samples = []
+    for index, row in state_stations.iterrows():
+        station_data = checkpoint.load_checkpoint(results_directory, index)
+        if index in changed:
+            logging.info(f"Applying new metadata to {index}")
+            if deduplicate and not station_data.empty:
+                changed_samples.append(fingerprints(station_data))
+            try:
+                station_data = incremental.reenrich(
+                    station_data,
+                    add_locations=not isinstance(collectors.get(row["provider"]), ERDDAP)
+                )
+            except ValueError as e:
+                logging.error(f"{index}: {e}")
+                changed.remove(index)
+                continue
+            checkpoint.save_checkpoint(results_directory, index, station_data)
+            if deduplicate and not station_data.empty:
+                changed_samples.append(fingerprints(station_data))
+        all_station_data.append(station_data)
+    data = all_station_data if max_memory is not None else pd.concat(all_station_data)
+    rewrite = list(changed)
+    if changed_samples:
+        sharing = sharing_stations(data, np.unique(np.concatenate(changed_samples))) - set(changed)
+        if sharing:
+            logging.info(f"Rewriting stations sharing samples with changed stations: {sorted(sharing)}")
+            rewrite += sorted(sharing)
+    try:
+        data = prepare_data(
+            data, deduplicate=deduplicate, derive=derive, aggregate=aggregate,
+            analysis_directory=results_directory if analyze else None
+        )
+        format_data(
+            state, data, results_directory, only_stations=rewrite, max_memory=max_memory,
+            extra_sinks=extra_sinks, compress=compress, excel=excel
+        )
+    finally:
+        cleanup(data)
+    incremental.save_fingerprints(results_directory, changed)
+    return changed
+
+def prepare_data(
+    data, deduplicate=True, derive=False, aggregate=None, analysis_directory=None
+):
+    """ Processing between collection and formatting
+
+    Args:
+        data (pd.DataFrame): collected data, or SpilledFrames of it
+        deduplicate (bool): drop samples a preferred provider also reported
+        derive (bool): add carbonate system parameters
+        aggregate (str): if set, summarize each series per this period
+        analysis_directory (Path): if set, an exceedance summary of the
+            data is saved here before aggregating
+    Returns:
+        data ready for format_data
+    """
+    if deduplicate:
+        data = remove_duplicates(data)
+    if derive:
+        data = apply(data, add_derived_parameters)
+    if analysis_directory is not None:
+        write_exceedance_summary(data, analysis_directory)
+    if aggregate:
+        data = apply(data, lambda station_data: aggregate_data(station_data, aggregate))
     return data
 
-def format_data(state, data, output_directory):
+def format_data(
+    state, data, output_directory, only_stations=None, max_memory=None, extra_sinks=(),
+    compress=False, excel=False
+):
     """ Formats input data according to state's specifications
     
     Args:
         state (str): One of 'California', 'Washington', or 'Hawaii'
-        data (pd.DataFrame): Table containing relevant observations
+        data (pd.DataFrame): Table containing relevant observations, or
+            SpilledFrames of them
+        only_stations (list): if set, only output files holding these
+            stations are rewritten
+        max_memory (int): if set, bytes of data held in memory while sorting
+        extra_sinks (list): names of sinks to write as well
+        compress (bool): gzip csv files as they are written
+        excel (bool): save xlsx workbooks instead of csv files, for
+            formatters that support it
     Returns:
-        Nothing. Saves relevant documents to folder with name {state}-{unixtime}
+        The formatter used, listing the files it wrote. Saves relevant
+        documents to folder with name {state}-{unixtime} and lists them
+        with their sha256 in manifest.json. Files whose content is
+        unchanged since the last run into the folder are not rewritten,
+        and files that run wrote but this one did not are removed.
     """
     formatter = formatters[state](output_directory)
-    formatter.format_data_for_agency(data)
-    
+    formatter.artifacts = incremental.load_artifacts(output_directory)
+    formatter.manifest = manifest.load_manifest(output_directory)
+    if max_memory is not None:
+        formatter.memory_budget = max_memory
+    formatter.compress = compress
+    formatter.excel = excel
+    formatter.sinks = [sinks[name](output_directory) for name in extra_sinks]
+    formatter.format_data_for_agency(data, only_stations=only_stations)
+    for sink in formatter.sinks:
+        sink.close()
+    if only_stations is None:
+        removed = formatter.prune()
+        if removed:
+            logging.info(f"Removed {len(removed)} output files of the last run: {removed}")
+    logging.info(
+        f"{len(formatter.written) - len(formatter.unchanged)} output files written, "
+        f"{len(formatter.unchanged)} unchanged"
+    )
+    incremental.save_artifacts(output_directory, formatter.artifacts)
+    manifest.save_manifest(output_directory, formatter.manifest)
+    return formatter
+
+def run_service_job(job, now):
+    """ One run of a service.StateJob: collects new data and formats the window
+
+    Only data since each station's last successful collection is collected.
+    It is merged into the data the job keeps in memory, which is then
+    prepared and formatted into the job's output directory like a run with
+    --output-dir.
+
+    Returns:
+        (dict): window, rows, output directory, files written and stations
+            that failed
+    """
+    options = job.options
+    _, start = job.collection_window(now)
+    logging.info(f"Service collecting {job.state} until {now}")
+    collected, failed, station_data = [], [], []
+    for index, row in get_state_stations(job.state, options.get("station_ids")).iterrows():
+        fetch_start, _ = job.collection_window(now, index)
+        data = collect_station(
+            index, row["provider"], fetch_start, now, thin=options.get("thin"),
+            parameters=options.get("parameters")
+        )
+        if data is None:
+            failed.append(index)
+            continue
+        collected.append(index)
+        station_data.append(data)
+    new_data = pd.concat(station_data) if station_data else pd.DataFrame()
+    data = job.merge(new_data, start, now, collected)
+    job.output_directory.mkdir(exist_ok=True, parents=True)
+    write_profile(data, job.output_directory)
+    data = prepare_data(
+        data.copy(), deduplicate=not options.get("keep_duplicates", False),
+        derive=options.get("derive", False), aggregate=options.get("aggregate"),
+        analysis_directory=job.output_directory if options.get("analyze") else None
+    )
+    formatter = format_data(
+        job.state, data, job.output_directory, extra_sinks=options.get("sinks", []),
+        compress=options.get("gzip", False), excel=options.get("excel", False)
+    )
+    return {
+        "state": job.state,
+        "start": start.isoformat(),
+        "end": now.isoformat(),
+        "collected_rows": len(new_data),
+        "rows": len(job.recent),
+        "output_directory": str(job.output_directory),
+        "written": sorted(set(formatter.written) - set(formatter.unchanged)),
+        "unchanged": len(formatter.unchanged),
+        "failed": failed,
+    }
+
 
 if __name__ == "__main__":
     # set up for command line arguments
     parser = argparse.ArgumentParser(
         description="Automated oceanographic data collection for 303(d) reviews"
     )
-    parser.add_argument("state", metavar="STATE", type=str,
+    parser.add_argument("state", metavar="STATE", type=str, nargs="?",
         help="State from which to gather and prepare data"
     )
     parser.add_argument("--start", type=str, default=None,
@@ -91,7 +452,150 @@ if __name__ == "__main__":
     )
     parser.add_argument("--end", type=str,
         help="YYYY/MM/DD. Latest time from which to gather data. Default today.")
+    parser.add_argument("--thin", type=int, default=None, metavar="N",
+        help="Collect at most one sample every N minutes for each series."
+    )
+    parser.add_argument("--preview", action="store_true",
+        help="Quick run for checking formatting. Same as --thin {}.".format(PREVIEW_THIN)
+    )
+    parser.add_argument("--aggregate", choices=list(frequencies), default=None,
+        help="Submit mean/min/max/count summaries of each series instead of raw data."
+    )
+    parser.add_argument("--parameters", type=str, default=None, metavar="NAME,NAME,...",
+        help="Only request these normalized parameters (e.g. pH,salinity) from providers."
+    )
+    parser.add_argument("--bbox", type=str, default=None,
+        metavar="MIN_LON,MIN_LAT,MAX_LON,MAX_LAT",
+        help="Only collect from stations inside this bounding box."
+    )
+    parser.add_argument("--polygon", type=Path, default=None,
+        help="CSV of polygon vertices with latitude and longitude columns. "
+        "Only collect from stations inside it."
+    )
+    parser.add_argument("--nearest", type=str, default=None, metavar="LAT,LON,N",
+        help="Only collect from the N stations closest to LAT,LON."
+    )
+    parser.add_argument("--keep-duplicates", action="store_true",
+        help="Keep samples reported by more than one provider. By default "
+        "only the preferred provider's copy is kept."
+    )
+    parser.add_argument("--derive", action="store_true",
+        help="Add carbonate system parameters (tco2, co2, omega_aragonite) "
+        "calculated from measured pH or tco2, alkalinity, salinity and temperature."
+    )
+    parser.add_argument("--analyze", action="store_true",
+        help="Screen data against 303(d) criteria and save an exceedance summary."
+    )
+    parser.add_argument("--sink", choices=list(sinks), action="append", default=[],
+        dest="sinks", help="Also write a parquet archive of the data or a summary of "
+        "each station's parameters, from the same batches as the agency files. Repeatable."
+    )
+    parser.add_argument("--gzip", action="store_true",
+        help="Gzip agency csv files as they are written, as <name>.csv.gz."
+    )
+    parser.add_argument("--excel", action="store_true",
+        help="Save each batch as an xlsx workbook with Locations and Field Results "
+        "sheets instead of csv files. California and Hawaii only."
+    )
+    parser.add_argument("--max-memory", type=parse_size, default=None, metavar="SIZE",
+        help="Hold at most SIZE (e.g. 512M, 4G) of collected data in memory. "
+        "Stations past it are spilled to disk until formatting."
+    )
+    parser.add_argument("--plan", action="store_true",
+        help="Estimate requests, data volume and time of each station from "
+        "past runs, without fetching anything."
+    )
+    parser.add_argument("--use-store", action="store_true",
+        help="Serve data from the local store in output/store and only fetch "
+        "the days it does not cover yet, storing them for later runs."
+    )
+    parser.add_argument("--coverage", action="store_true",
+        help="Print the days of the period the local store covers for each "
+        "station, without fetching anything."
+    )
+    parser.add_argument("--output-dir", type=Path, default=None, metavar="DIR",
+        help="Write results to DIR instead of a new timestamped directory. "
+        "Files whose content did not change since the last run into DIR are left untouched."
+    )
+    parser.add_argument("--resume", type=Path, default=None, metavar="RESULTS_DIR",
+        help="Finish an interrupted run. Stations already collected in "
+        "RESULTS_DIR are reused and its time window and station selection apply."
+    )
+    parser.add_argument("--reformat", type=Path, default=None, metavar="RESULTS_DIR",
+        help="Rewrite the output of a finished run for stations whose metadata "
+        "changed since, from its checkpoints and without collecting again."
+    )
+    parser.add_argument("--queue", type=Path, default=None, metavar="DIR",
+        help="Plan the run as one job per station and time shard in the shared "
+        "directory DIR instead of collecting, for --work processes to run."
+    )
+    parser.add_argument("--shard-days", type=float, default=30, metavar="DAYS",
+        help="Days of data in each --queue job. Default 30."
+    )
+    parser.add_argument("--work", type=Path, default=None, metavar="DIR",
+        help="Claim and run jobs of the --queue in DIR until none are left. "
+        "Any number of workers, on hosts sharing DIR, can run at once."
+    )
+    parser.add_argument("--merge", type=Path, default=None, metavar="DIR",
+        help="Combine the job results of the --queue in DIR and format them. "
+        "Stations with failed jobs are collected again."
+    )
+    parser.add_argument("--serve", type=Path, default=None, metavar="CONFIG",
+        help="Stay running and collect the states in the json CONFIG on their "
+        "schedules, keeping connections, metadata and recent data warm."
+    )
+    parser.add_argument("--trigger", action="store_true",
+        help="Ask the running --serve process to produce STATE's agency files now."
+    )
+    parser.add_argument("--port", type=int, default=service.DEFAULT_PORT,
+        help="Local port of the --serve trigger. Default {}.".format(service.DEFAULT_PORT)
+    )
     args = parser.parse_args()
+    if args.serve:
+        (HERE / "output").mkdir(exist_ok=True)
+        logging.basicConfig(
+            filename=HERE / "output" / "service.log", encoding='utf-8', level=logging.INFO,
+            format='%(levelno)s %(asctime)s %(pathname)s %(message)s'
+        )
+        jobs = service.load_jobs(args.serve, HERE / "output")
+        unknown = set(jobs) - set(formatters)
+        if unknown:
+            parser.error("Unknown states in {}: {}".format(args.serve, ", ".join(sorted(unknown))))
+        for job in jobs.values():
+            if job.options.get("parameters") and job.options.get("derive"):
+                # derived parameters need their inputs collected
+                job.options["parameters"] = list(dict.fromkeys(
+                    job.options["parameters"] + list(carbonate_inputs)
+                ))
+        service.Service(jobs, run_service_job, port=args.port).serve_forever()
+    if args.work:
+        results_directory = args.work.resolve()
+        run = checkpoint.load_run(results_directory)
+        worker = workqueue.worker_id()
+        logging.basicConfig(
+            filename=workqueue.queue_directory(results_directory, "logs") / f"{worker}.log",
+            encoding='utf-8', level=logging.INFO,
+            format='%(levelno)s %(asctime)s %(pathname)s %(message)s'
+        )
+        ran = workqueue.run_worker(
+            results_directory,
+            lambda job: collect_station(
+                job["station_id"], job["provider"], job["start"], job["end"],
+                thin=run["thin"], parameters=run.get("parameters")
+            ),
+            worker=worker
+        )
+        print(f"{worker} ran {ran} jobs, {len(workqueue.pending_jobs(results_directory))} left")
+        exit()
+    if args.merge:
+        args.resume = args.merge
+        if args.state is None:
+            args.state = checkpoint.load_run(args.merge.resolve())["state"]
+    if args.state is None:
+        parser.error("STATE is required")
+    if args.trigger:
+        print(json.dumps(service.trigger(args.state, args.port), indent=2))
+        exit()
     # set defaults
     if args.start == None:
         args.start = datetime.now() - timedelta(30)
@@ -101,23 +605,143 @@ if __name__ == "__main__":
         args.end = datetime.now()
     else:
         args.end = datetime.strptime(args.end, "%Y/%m/%d")
+    if args.excel and not formatters[args.state].supports_excel:
+        parser.error("--excel is not supported for {}".format(args.state))
+    if args.preview and args.thin is None:
+        args.thin = PREVIEW_THIN
+    parameters = None
+    if args.parameters:
+        parameters = args.parameters.split(",")
+        unknown = set(parameters) - set(utils.parameter_dict.values())
+        if unknown:
+            parser.error("Unknown parameters: {}".format(", ".join(sorted(unknown))))
+        if args.derive:
+            # derived parameters need their inputs collected
+            parameters = list(dict.fromkeys(parameters + list(carbonate_inputs)))
+    station_ids = None
+    if args.bbox or args.polygon or args.nearest:
+        stations = pd.read_csv(STATIONS, index_col="station_id")
+        selected = select_stations(
+            stations[stations["state"] == args.state],
+            bbox=[float(i) for i in args.bbox.split(",")] if args.bbox else None,
+            polygon=read_polygon(args.polygon) if args.polygon else None,
+            nearest=[float(i) for i in args.nearest.split(",")] if args.nearest else None,
+        )
+        station_ids = list(selected.index)
+    if args.use_store and args.thin is not None:
+        parser.error("--use-store keeps full resolution data and can't be thinned")
+    if args.coverage:
+        report = CoverageStore().coverage(
+            get_state_stations(args.state, station_ids).index, args.start, args.end,
+            parameters=parameters
+        )
+        print(report.to_string(index=False))
+        exit()
+    if args.plan:
+        plan = plan_collection(
+            args.state, args.start, args.end, thin=args.thin, station_ids=station_ids,
+            parameters=parameters
+        )
+        print(plan.to_string())
+        exit()
     # set up paths
-    request_time = datetime.now().strftime("%Y-%m-%dT%H-%M")
-    results_directory = HERE / "output" / args.state / request_time
-    results_directory.mkdir(exist_ok=True, parents=True)
+    if args.reformat:
+        results_directory = args.reformat.resolve()
+        run = checkpoint.load_run(results_directory)
+        if run["state"] != args.state:
+            parser.error(f"{results_directory} is a run for {run['state']}")
+        logging.basicConfig(
+            filename=results_directory / "output.log", encoding='utf-8', level=logging.INFO,
+            format='%(levelno)s %(asctime)s %(pathname)s %(message)s'
+        )
+        changed = reformat_data(
+            args.state, results_directory, station_ids=run["station_ids"],
+            aggregate=run.get("aggregate"), derive=run.get("derive", False),
+            deduplicate=not run.get("keep_duplicates", False),
+            max_memory=run.get("max_memory"), extra_sinks=run.get("sinks", []),
+            compress=run.get("gzip", False), excel=run.get("excel", False),
+            analyze=run.get("analyze", False)
+        )
+        print("Reformatted {} stations: {}".format(len(changed), ", ".join(changed)))
+        exit()
+    if args.resume:
+        results_directory = args.resume.resolve()
+        run = checkpoint.load_run(results_directory)
+        if run["state"] != args.state:
+            parser.error(f"{results_directory} is a run for {run['state']}")
+        args.start, args.end = run["start"], run["end"]
+        args.thin, station_ids = run["thin"], run["station_ids"]
+        args.aggregate = run.get("aggregate")
+        args.derive = run.get("derive", False)
+        args.keep_duplicates = run.get("keep_duplicates", False)
+        args.max_memory = run.get("max_memory")
+        args.sinks = run.get("sinks", [])
+        args.gzip = run.get("gzip", False)
+        args.excel = run.get("excel", False)
+        args.use_store = run.get("use_store", False)
+        args.analyze = run.get("analyze", False)
+        parameters = run.get("parameters")
+    else:
+        if args.queue or args.output_dir:
+            results_directory = (args.queue or args.output_dir).resolve()
+            # checkpoints of the last run into it are for another window
+            checkpoint.clear_checkpoints(results_directory)
+        else:
+            request_time = datetime.now().strftime("%Y-%m-%dT%H-%M")
+            results_directory = HERE / "output" / args.state / request_time
+        results_directory.mkdir(exist_ok=True, parents=True)
+        checkpoint.save_run(
+            results_directory, args.state, args.start, args.end,
+            thin=args.thin, station_ids=station_ids,
+            aggregate=args.aggregate, derive=args.derive,
+            keep_duplicates=args.keep_duplicates, max_memory=args.max_memory,
+            parameters=parameters, sinks=args.sinks, gzip=args.gzip, excel=args.excel,
+            use_store=args.use_store, analyze=args.analyze
+        )
     logfile = results_directory / "output.log"
     # set up logging
     logging.basicConfig(
         filename=logfile , encoding='utf-8', level=logging.INFO,
         format='%(levelno)s %(asctime)s %(pathname)s %(message)s'
     )
+    if args.queue:
+        jobs = workqueue.plan_jobs(
+            results_directory, get_state_stations(args.state, station_ids),
+            args.start, args.end, args.shard_days
+        )
+        print(f"{jobs} jobs queued in {results_directory}")
+        exit()
+    if args.merge:
+        merged = workqueue.merge_shards(results_directory)
+        logging.info(f"Merged job results of {len(merged)} stations")
     # run pipeline
     logging.info(
         f"Collecting data for {args.state} from {args.start} to {args.end}"
     )
-    data = collect_data(args.state, args.start, args.end)
+    if args.use_store:
+        data = query(
+            args.state, args.start, args.end, parameters=parameters, station_ids=station_ids
+        )
+    else:
+        data = collect_data(
+            args.state, args.start, args.end, thin=args.thin,
+            station_ids=station_ids, results_directory=results_directory,
+            max_memory=args.max_memory, parameters=parameters
+        )
     logging.info(
         f"{len(data)} rows of data collected. Formatting for agency..."
     )
-    format_data(args.state, data, output_directory=results_directory)
+    try:
+        write_profile(data, results_directory)
+        data = prepare_data(
+            data, deduplicate=not args.keep_duplicates, derive=args.derive,
+            aggregate=args.aggregate, analysis_directory=results_directory if args.analyze else None
+        )
+        format_data(
+            args.state, data, output_directory=results_directory, max_memory=args.max_memory,
+            extra_sinks=args.sinks, compress=args.gzip, excel=args.excel
+        )
+    finally:
+        # spilled data of --max-memory runs
+        cleanup(data)
     logging.info("COMPLETE")
\ No newline at end of file
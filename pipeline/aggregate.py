@@ -0,0 +1,86 @@
+import logging
+import numpy as np
+import pandas as pd
+from pipeline import utils
+from pipeline import qc
+
+# pandas offsets for supported aggregation periods
+frequencies = {
+    "hourly": "1H",
+    "daily": "1D",
+}
+
+series_columns = ["station_id", "parameter", "depth"]
+
+
+def aggregate_data(data: pd.DataFrame, frequency: str = "hourly") -> pd.DataFrame:
+    """ Summarizes each station x parameter x depth series to a fixed period
+
+    Rows are sorted once by series and period, and every statistic is
+    computed over the sorted group boundaries with ufunc reduceat.
+
+    Args:
+        data: data from collectors in standardized long format
+        frequency: one of the keys of `frequencies`
+    Returns:
+        one row per series per period in standardized long format. `value`
+        holds the mean, with the added columns `value_min`, `value_max` and
+        `sample_count`. Rows flagged FAIL or MISSING are left out of periods
+        that have other rows, so a period is only FAIL when all of its rows
+        are. Numeric quality flags keep the worst (highest) flag of the rows
+        used. Text flags are kept only when all records agree.
+    """
+    data = data[pd.to_numeric(data["value"], errors="coerce").notna()]
+    if data.empty:
+        return data
+    times = pd.to_datetime(data["datetime"], utc=True)
+    buckets = times.dt.floor(frequencies[frequency])
+    keys = [pd.factorize(data[column])[0] for column in series_columns]
+    order, starts = utils.group_boundaries(*keys, buckets.values.astype("int64"))
+
+    failed = (pd.to_numeric(data["quality"], errors="coerce") >= qc.FAIL).to_numpy()[order]
+    counts = np.diff(np.append(starts, len(order)))
+    usable = np.add.reduceat(~failed, starts)
+    # rows of periods with no usable rows are all kept, to be flagged FAIL
+    used = ~failed | np.repeat(usable == 0, counts)
+    counts = np.where(usable == 0, counts, usable)
+    first = order[starts]
+    order = order[used]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    values = pd.to_numeric(data["value"]).to_numpy(float)[order]
+
+    aggregated = data.iloc[first].copy()
+    aggregated["datetime"] = buckets.values[first]
+    aggregated["value"] = np.add.reduceat(values, starts) / counts
+    aggregated["value_min"] = np.minimum.reduceat(values, starts)
+    aggregated["value_max"] = np.maximum.reduceat(values, starts)
+    aggregated["sample_count"] = counts
+    aggregated["quality"] = aggregate_quality(data["quality"].to_numpy(object)[order], starts)
+    aggregated.reset_index(drop=True, inplace=True)
+    logging.info(
+        f"Aggregated {len(data)} rows to {len(aggregated)} {frequency} rows"
+    )
+    return aggregated
+
+
+def aggregate_quality(quality: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """ Combines sorted quality flags into one flag per group
+
+    Args:
+        quality: quality flags sorted by group
+        starts: index of the first flag of each group
+    Returns:
+        worst numeric flag of each group. Groups with only text flags keep
+        the flag if it is the same for every record, else None.
+    """
+    numeric = pd.to_numeric(pd.Series(quality), errors="coerce").to_numpy(float)
+    worst = np.fmax.reduceat(numeric, starts)
+    text = pd.Series(quality).where(np.isnan(numeric))
+    codes, labels = pd.factorize(text)
+    if len(labels) == 0:
+        return worst
+    high = np.maximum.reduceat(codes, starts)
+    low = np.minimum.reduceat(np.where(codes < 0, len(labels), codes), starts)
+    uniform = (high == low) & (high >= 0)
+    flags = np.where(uniform, np.asarray(labels, dtype=object)[np.maximum(high, 0)], None)
+    return np.where(np.isnan(worst), flags, worst)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from pipeline import utils
+
+# rows of different series are never matched with each other
+series_columns = ["station_id", "depth"]
+
+
+def align(
+    data: pd.DataFrame,
+    parameters: list = None,
+    frequency: str = "15min",
+    tolerance: str = None,
+    by: list = series_columns,
+    carry: list = (),
+) -> pd.DataFrame:
+    """ Wide table of parameters matched to a common time grid
+
+    Each series gets a grid every `frequency` from its first to its last
+    sample. Every grid time takes the nearest sample of each parameter of
+    the same series within `tolerance`. All series are laid out one after
+    another on a single integer time axis, so each parameter is matched
+    with one searchsorted over its sorted samples.
+
+    Args:
+        data: data from collectors in standardized long format
+        parameters: parameters to align, defaults to all
+        frequency: grid spacing as a pandas offset string
+        tolerance: furthest a sample can be from a grid time, defaults to
+            half of frequency
+        by: columns identifying a series
+        carry: columns copied from the first row of each series, such as
+            latitude and longitude
+    Returns:
+        one row per series and grid time with at least one matched sample.
+        Has the `by` columns, datetime, the `carry` columns, a column of
+        values for each parameter and, if data has quality flags, a
+        `quality_` column for each parameter.
+    """
+    if parameters is None:
+        parameters = list(pd.unique(data["parameter"].dropna()))
+    step = int(pd.Timedelta(frequency).total_seconds())
+    tolerance = step // 2 if tolerance is None else int(pd.Timedelta(tolerance).total_seconds())
+    times = pd.to_datetime(data["datetime"], utc=True)
+    selected = data["parameter"].isin(parameters).values & times.notna().values
+    data = data[selected]
+    if data.empty:
+        return pd.DataFrame(columns=list(by) + ["datetime"] + list(carry) + list(parameters))
+    seconds = times.values[selected].astype("int64") // 10**9
+
+    # series of each row, and the first and last time of each series
+    keys = [pd.factorize(data[column])[0] for column in by]
+    order, starts = utils.group_boundaries(*keys)
+    series = np.empty(len(data), dtype=np.int64)
+    series[order] = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(data))))
+    first_time = np.full(len(starts), np.iinfo(np.int64).max)
+    last_time = np.full(len(starts), np.iinfo(np.int64).min)
+    np.minimum.at(first_time, series, seconds)
+    np.maximum.at(last_time, series, seconds)
+
+    # each series occupies its own stretch of the time axis, with a gap
+    # wider than the tolerance before the next one
+    grid_start = first_time - first_time % step
+    grid_points = (last_time - grid_start) // step + 1
+    stretch = grid_points * step + 2 * tolerance + step
+    base = np.concatenate(([0], np.cumsum(stretch)[:-1]))
+    sample_keys = base[series] + seconds - grid_start[series]
+    grid_series = np.repeat(np.arange(len(starts)), grid_points)
+    grid_offsets = (np.arange(grid_points.sum()) - np.repeat(np.cumsum(grid_points) - grid_points, grid_points)) * step
+    grid_keys = base[grid_series] + grid_offsets
+
+    first_rows = data.iloc[order[starts]]
+    aligned = {column: first_rows[column].values[grid_series] for column in by}
+    aligned["datetime"] = pd.to_datetime(grid_start[grid_series] + grid_offsets, unit="s", utc=True)
+    for column in carry:
+        if column in data.columns:
+            aligned[column] = first_rows[column].values[grid_series]
+    values = pd.to_numeric(data["value"], errors="coerce").to_numpy(float)
+    quality = data["quality"].to_numpy(object) if "quality" in data.columns else None
+    row_parameters = data["parameter"].to_numpy(object)
+    matched_any = np.zeros(len(grid_keys), dtype=bool)
+    for parameter in parameters:
+        rows = np.flatnonzero((row_parameters == parameter) & ~np.isnan(values))
+        rows = rows[np.argsort(sample_keys[rows], kind="stable")]
+        nearest, matched = _nearest(sample_keys[rows], grid_keys, tolerance)
+        matched_any |= matched
+        column = np.full(len(grid_keys), np.nan)
+        column[matched] = values[rows[nearest[matched]]]
+        aligned[parameter] = column
+        if quality is not None:
+            flags = np.full(len(grid_keys), None, dtype=object)
+            flags[matched] = quality[rows[nearest[matched]]]
+            aligned["quality_" + parameter] = flags
+    aligned = pd.DataFrame(aligned)
+    return aligned[matched_any].reset_index(drop=True)
+
+
+def _nearest(sorted_keys: np.ndarray, targets: np.ndarray, tolerance: int):
+    """ Position of the nearest key to each target, and whether it is within tolerance """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(targets), dtype=int), np.zeros(len(targets), dtype=bool)
+    after = np.searchsorted(sorted_keys, targets, side="left").clip(max=len(sorted_keys) - 1)
+    before = (after - 1).clip(min=0)
+    use_before = np.abs(targets - sorted_keys[before]) <= np.abs(sorted_keys[after] - targets)
+    nearest = np.where(use_before, before, after)
+    return nearest, np.abs(sorted_keys[nearest] - targets) <= tolerance
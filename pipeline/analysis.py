@@ -0,0 +1,185 @@
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pipeline import utils
+from pipeline import spill
+from pipeline import qc
+
+# Screening criteria in standardized units. These are common marine water
+# quality criteria and should be checked against the state's standards.
+# parameter: (lowest acceptable value, highest acceptable value)
+criteria = {
+    "pH": (7.0, 8.5),
+    "oxygen_concentration": (5.0, None),  # mg/L
+    "water_temperature": (None, 20.0),  # deg C
+}
+
+# parameter: (daily statistic, lowest acceptable average, highest acceptable average)
+rolling_criteria = {
+    "oxygen_concentration": ("min", 6.0, None),  # 7 day average of daily minima
+    "water_temperature": ("max", None, 16.0),  # 7 day average of daily maxima
+}
+
+ROLLING_DAYS = 7
+
+SUMMARY_FILE = "exceedance_summary.csv"
+
+summary_columns = [
+    "samples", "exceedances", "percent_exceeding", "days",
+    "rolling_statistic", "rolling_windows", "rolling_exceedances",
+]
+
+
+def daily_statistics(data: pd.DataFrame) -> pd.DataFrame:
+    """ Computes daily and rolling statistics of each series with criteria
+
+    Args:
+        data: data from collectors in standardized long format
+    Returns:
+        one row per station x parameter x depth x day with the daily
+        min, max, mean and count, and ROLLING_DAYS averages of the daily min
+        and max of samples not flagged FAIL or MISSING. Rolling averages are
+        NaN unless all ROLLING_DAYS days have data.
+    """
+    return _daily_statistics(_screened(data))
+
+
+def _daily_statistics(data: pd.DataFrame) -> pd.DataFrame:
+    """ daily_statistics of data that is already screened """
+    if data.empty:
+        return pd.DataFrame()
+    days = pd.to_datetime(data["datetime"], utc=True).values.astype("datetime64[D]").astype("int64")
+    series_keys = [pd.factorize(data[column])[0] for column in ["station_id", "parameter", "depth"]]
+    order, starts = utils.group_boundaries(*series_keys, days)
+    values = data["value"].to_numpy(float)[order]
+
+    daily = data.iloc[order[starts]][["station_id", "parameter", "depth"]]
+    daily.reset_index(drop=True, inplace=True)
+    day = days[order[starts]]
+    daily["date"] = day.astype("datetime64[D]")
+    daily["count"] = np.diff(np.append(starts, len(values)))
+    daily["mean"] = np.add.reduceat(values, starts) / daily["count"].to_numpy()
+    daily["min"] = np.minimum.reduceat(values, starts)
+    daily["max"] = np.maximum.reduceat(values, starts)
+
+    # daily rows are sorted by series then day, so a window is a contiguous
+    # slice found by searching series-offset day numbers
+    series = np.column_stack([keys[order[starts]] for keys in series_keys])
+    new_series = np.concatenate(([True], np.any(series[1:] != series[:-1], axis=1)))
+    span = day.max() - day.min() + ROLLING_DAYS
+    key = (np.cumsum(new_series) * span) + (day - day.min())
+    window_start = np.searchsorted(key, key - (ROLLING_DAYS - 1), side="left")
+    window_end = np.arange(1, len(key) + 1)
+    complete = (window_end - window_start) == ROLLING_DAYS
+    for statistic in ["min", "max"]:
+        totals = np.concatenate(([0], np.cumsum(daily[statistic].to_numpy())))
+        average = (totals[window_end] - totals[window_start]) / (window_end - window_start)
+        daily["rolling_{}".format(statistic)] = np.where(complete, average, np.nan)
+    return daily
+
+
+def exceedance_summary(data: pd.DataFrame) -> pd.DataFrame:
+    """ Counts criteria exceedances of each station and parameter
+
+    Args:
+        data: data from collectors in standardized long format
+    Returns:
+        one row per station x parameter with the number of samples and
+        samples outside `criteria`, and the number of complete rolling
+        windows and windows outside `rolling_criteria`. Samples flagged
+        FAIL or MISSING are left out.
+    """
+    screened = _screened(data)
+    if screened.empty:
+        # no parameter with criteria was collected
+        return _empty_summary()
+    codes, index = _station_parameter_codes(screened)
+    low, high = _thresholds(screened["parameter"], criteria, 0)
+    values = screened["value"].to_numpy(float)
+    exceeds = (values < low) | (values > high)
+
+    summary = pd.DataFrame(index=index)
+    summary["samples"] = np.bincount(codes, minlength=len(index))
+    summary["exceedances"] = np.bincount(codes, weights=exceeds, minlength=len(index)).astype(int)
+    summary["percent_exceeding"] = 100 * summary["exceedances"] / summary["samples"]
+
+    daily = _daily_statistics(screened)
+    daily_codes = index.get_indexer(pd.MultiIndex.from_arrays([daily["station_id"], daily["parameter"]]))
+    # a day can hold several depths of the same station and parameter
+    day_numbers = daily["date"].values.astype("int64")
+    span = day_numbers.max() - day_numbers.min() + 1
+    station_days = np.unique(daily_codes * span + (day_numbers - day_numbers.min()))
+    summary["days"] = np.bincount(station_days // span, minlength=len(index))
+
+    statistic = daily["parameter"].map({k: v[0] for k, v in rolling_criteria.items()})
+    rolling = np.where(statistic == "min", daily["rolling_min"], daily["rolling_max"])
+    rolling = np.where(statistic.isna(), np.nan, rolling)
+    low, high = _thresholds(daily["parameter"], rolling_criteria, 1)
+    summary["rolling_statistic"] = [
+        "{} day average of daily {}".format(ROLLING_DAYS, rolling_criteria[p][0])
+        if p in rolling_criteria else None
+        for p in summary.index.get_level_values("parameter")
+    ]
+    summary["rolling_windows"] = np.bincount(
+        daily_codes, weights=~np.isnan(rolling), minlength=len(index)
+    ).astype(int)
+    summary["rolling_exceedances"] = np.bincount(
+        daily_codes, weights=(rolling < low) | (rolling > high), minlength=len(index)
+    ).astype(int)
+    return summary.sort_index()
+
+
+def write_exceedance_summary(data, results_directory: Path) -> Path:
+    """ Saves exceedance summary next to the agency files
+
+    Args:
+        data: DataFrame, or SpilledFrames with each station in one frame
+        results_directory: where agency files are saved
+    """
+    summaries = [exceedance_summary(part) for part in spill.parts(data)]
+    # a SpilledFrames holds no frame when every station failed
+    summary = pd.concat(summaries) if summaries else _empty_summary()
+    summary = summary.sort_index() if not summary.empty else summary
+    summary_file = results_directory / SUMMARY_FILE
+    summary.to_csv(summary_file)
+    logging.info(
+        f"{int(summary['exceedances'].sum())} criteria exceedances found. Summary saved to {summary_file}"
+    )
+    return summary_file
+
+
+def _screened(data: pd.DataFrame) -> pd.DataFrame:
+    """ Rows of parameters with criteria and a numeric value not flagged FAIL or MISSING """
+    data = data[data["parameter"].isin(set(criteria) | set(rolling_criteria))]
+    data = data.assign(value=pd.to_numeric(data["value"], errors="coerce"))
+    usable = data["value"].notna()
+    if "quality" in data.columns:
+        # spikes and stuck sensors are kept with their flag, not counted
+        usable &= ~(pd.to_numeric(data["quality"], errors="coerce") >= qc.FAIL)
+    return data[usable]
+
+
+def _empty_summary() -> pd.DataFrame:
+    """ Exceedance summary without any station and parameter """
+    index = pd.MultiIndex.from_arrays([[], []], names=["station_id", "parameter"])
+    return pd.DataFrame(columns=summary_columns, index=index)
+
+
+def _station_parameter_codes(data: pd.DataFrame):
+    """ Integer code of each row's station x parameter pair and the pairs """
+    station_codes, station_ids = pd.factorize(data["station_id"])
+    parameter_codes, parameters = pd.factorize(data["parameter"])
+    codes, pairs = pd.factorize(station_codes * len(parameters) + parameter_codes)
+    index = pd.MultiIndex.from_arrays(
+        [station_ids[pairs // len(parameters)], parameters[pairs % len(parameters)]],
+        names=["station_id", "parameter"]
+    )
+    return codes, index
+
+
+def _thresholds(parameters: pd.Series, table: dict, position: int):
+    """ Arrays of lowest and highest acceptable values for each row """
+    low = parameters.map({k: v[position] for k, v in table.items()})
+    high = parameters.map({k: v[position + 1] for k, v in table.items()})
+    return low.astype(float).to_numpy(), high.astype(float).to_numpy()
@@ -0,0 +1,210 @@
+import logging
+import numpy as np
+import pandas as pd
+from pipeline import qc
+from pipeline import align
+
+# measured parameters used to solve the carbonate system, in the units expected
+inputs = {
+    "pH": "pH",
+    "total_alkalinity": "micromol/kg",
+    "tco2": "micromol/kg",
+    "salinity": "PSU",
+    "water_temperature": "C",
+}
+
+# derived parameters and their units. Only emitted where not measured.
+outputs = {
+    "tco2": "micromol/kg",
+    "co2": "microatm",
+    "omega_aragonite": None,
+}
+
+# inputs of a station and depth are matched to a grid of this spacing,
+# within half of it
+ALIGN_MINUTES = 30
+
+METHOD = "Calculated: Lueker et al. 2000 K1 K2, total pH scale"
+
+series_columns = ["station_id", "depth"]
+
+
+def constants(salinity: np.ndarray, temperature: np.ndarray) -> dict:
+    """ Equilibrium constants of seawater, total pH scale, mol/kg
+
+    K1 and K2 from Lueker et al. 2000, K0 from Weiss 1974, KB from Dickson
+    1990, Kw from Millero 1995, aragonite solubility from Mucci 1983, total
+    boron from Uppstrom 1974 and calcium from Riley and Tongudai 1967.
+    """
+    S = salinity
+    T = temperature + 273.15
+    sqrt_S = np.sqrt(S)
+    return {
+        "K1": 10 ** -(3633.86 / T - 61.2172 + 9.6777 * np.log(T) - 0.011555 * S + 0.0001152 * S ** 2),
+        "K2": 10 ** -(471.78 / T + 25.929 - 3.16967 * np.log(T) - 0.01781 * S + 0.0001122 * S ** 2),
+        "K0": np.exp(
+            -60.2409 + 93.4517 * (100 / T) + 23.3585 * np.log(T / 100)
+            + S * (0.023517 - 0.023656 * (T / 100) + 0.0047036 * (T / 100) ** 2)
+        ),
+        "KB": np.exp(
+            (-8966.90 - 2890.53 * sqrt_S - 77.942 * S + 1.728 * S ** 1.5 - 0.0996 * S ** 2) / T
+            + 148.0248 + 137.1942 * sqrt_S + 1.62142 * S
+            - (24.4344 + 25.085 * sqrt_S + 0.2474 * S) * np.log(T)
+            + 0.053105 * sqrt_S * T
+        ),
+        "Kw": np.exp(
+            148.9652 - 13847.26 / T - 23.6521 * np.log(T)
+            + (118.67 / T - 5.977 + 1.0495 * np.log(T)) * sqrt_S - 0.01615 * S
+        ),
+        "Ksp_aragonite": 10 ** (
+            -171.945 - 0.077993 * T + 2903.293 / T + 71.595 * np.log10(T)
+            + (-0.068393 + 0.0017276 * T + 88.135 / T) * sqrt_S
+            - 0.10018 * S + 0.0059415 * S ** 1.5
+        ),
+        "BT": 0.0004157 * S / 35,
+        "Ca": 0.01028 * S / 35,
+    }
+
+
+def _alkalinity_terms(h: np.ndarray, k: dict) -> np.ndarray:
+    """ Borate and water alkalinity, mol/kg """
+    return k["BT"] * k["KB"] / (k["KB"] + h) + k["Kw"] / h - h
+
+
+def from_ph_alkalinity(ph: np.ndarray, alkalinity: np.ndarray, k: dict) -> dict:
+    """ Carbonate system from pH and total alkalinity in mol/kg
+
+    Returns:
+        dict of tco2 and co3 in mol/kg and co2 in microatm
+    """
+    h = 10 ** -ph
+    carbonate_alkalinity = alkalinity - _alkalinity_terms(h, k)
+    denominator = h ** 2 + k["K1"] * h + k["K1"] * k["K2"]
+    tco2 = carbonate_alkalinity * denominator / (k["K1"] * h + 2 * k["K1"] * k["K2"])
+    return {
+        "tco2": tco2,
+        "co3": tco2 * k["K1"] * k["K2"] / denominator,
+        "co2": tco2 * h ** 2 / denominator / k["K0"] * 1e6,
+    }
+
+
+def ph_from_tco2_alkalinity(tco2: np.ndarray, alkalinity: np.ndarray, k: dict, iterations: int = 40) -> np.ndarray:
+    """ pH of total alkalinity and dissolved inorganic carbon in mol/kg
+
+    Bisection between pH 5 and 11 on every sample at once. Alkalinity
+    decreases monotonically with hydrogen ion concentration.
+    """
+    low = np.full(len(tco2), 5.0)
+    high = np.full(len(tco2), 11.0)
+    for _ in range(iterations):
+        ph = (low + high) / 2
+        h = 10 ** -ph
+        denominator = h ** 2 + k["K1"] * h + k["K1"] * k["K2"]
+        modelled = tco2 * (k["K1"] * h + 2 * k["K1"] * k["K2"]) / denominator + _alkalinity_terms(h, k)
+        too_acidic = modelled < alkalinity
+        low = np.where(too_acidic, ph, low)
+        high = np.where(too_acidic, high, ph)
+    return (low + high) / 2
+
+
+def aligned_inputs(data: pd.DataFrame) -> pd.DataFrame:
+    """ Input and output parameters of each station and depth on a common time grid
+
+    Returns:
+        output of align.align, with missing quality flags NOT_EVALUATED
+    """
+    measured = (
+        data["parameter"].isin(list(inputs)) & (data["unit"] == data["parameter"].map(inputs))
+    ) | data["parameter"].isin(list(outputs))
+    parameters = list(inputs) + [p for p in outputs if p not in inputs]
+    aligned = align.align(
+        data[measured], parameters=parameters, frequency="{}min".format(ALIGN_MINUTES),
+        carry=["latitude", "longitude", "depth_unit"]
+    )
+    if aligned.empty:
+        return aligned
+    for parameter in parameters:
+        aligned["quality_" + parameter] = pd.to_numeric(
+            aligned.get("quality_" + parameter), errors="coerce"
+        ).fillna(qc.NOT_EVALUATED).to_numpy(float)
+    return aligned
+
+
+def derive_carbonate(data: pd.DataFrame) -> pd.DataFrame:
+    """ Carbonate system parameters missing from data
+
+    Inputs of each station and depth are matched to a common time grid of
+    ALIGN_MINUTES and solved together, from pH and total alkalinity or, without pH, from
+    tco2 and total alkalinity. Salinity and water temperature are needed
+    for both.
+
+    Args:
+        data: data from collectors in standardized long format
+    Returns:
+        derived rows in standardized long format. `derived_from` lists the
+        measured parameters used and `quality` is their worst flag.
+    """
+    aligned = aligned_inputs(data)
+    if aligned.empty:
+        return pd.DataFrame()
+    known = aligned[["total_alkalinity", "salinity", "water_temperature"]].notna().all(axis=1)
+    from_ph = (known & aligned["pH"].notna()).to_numpy()
+    from_tco2 = (known & aligned["pH"].isna() & aligned["tco2"].notna()).to_numpy()
+    solvable = from_ph | from_tco2
+    if not solvable.any():
+        return pd.DataFrame()
+    aligned = aligned[solvable].reset_index(drop=True)
+    from_ph = from_ph[solvable]
+    k = constants(aligned["salinity"].to_numpy(), aligned["water_temperature"].to_numpy())
+    alkalinity = aligned["total_alkalinity"].to_numpy() * 1e-6
+    ph = aligned["pH"].to_numpy().copy()
+    solve = ~from_ph
+    if solve.any():
+        ph[solve] = ph_from_tco2_alkalinity(
+            aligned["tco2"].to_numpy()[solve] * 1e-6, alkalinity[solve],
+            {name: constant[solve] for name, constant in k.items()}
+        )
+    system = from_ph_alkalinity(ph, alkalinity, k)
+    derived_values = {
+        "tco2": system["tco2"] * 1e6,
+        "co2": system["co2"],
+        "omega_aragonite": k["Ca"] * system["co3"] / k["Ksp_aragonite"],
+    }
+    used = ["total_alkalinity", "salinity", "water_temperature"]
+    derived_from = np.where(
+        from_ph, ",".join(["pH"] + used), ",".join(["tco2"] + used)
+    )
+    input_quality = np.maximum.reduce([
+        aligned["quality_" + p].to_numpy() for p in used
+    ] + [np.where(from_ph, aligned["quality_pH"], aligned["quality_tco2"])])
+
+    rows, parameters, values = [], [], []
+    for parameter, parameter_values in derived_values.items():
+        missing = np.flatnonzero(aligned[parameter].isna().to_numpy() & np.isfinite(parameter_values))
+        rows.append(missing)
+        parameters.append(np.full(len(missing), parameter, dtype=object))
+        values.append(parameter_values[missing])
+    rows = np.concatenate(rows)
+    if len(rows) == 0:
+        return pd.DataFrame()
+    parameters = np.concatenate(parameters)
+    derived = aligned.iloc[rows][["datetime", "station_id", "depth"] + [
+        c for c in ["latitude", "longitude", "depth_unit"] if c in aligned.columns
+    ]].reset_index(drop=True)
+    derived["parameter"] = parameters
+    derived["raw_parameter"] = parameters
+    derived["value"] = np.concatenate(values)
+    derived["unit"] = pd.Series(parameters).map(outputs).values
+    derived["quality"] = input_quality[rows].astype(int)
+    derived["method"] = METHOD
+    derived["derived_from"] = derived_from[rows]
+    logging.info(f"Derived {len(derived)} carbonate system values")
+    return derived
+
+
+def add_derived_parameters(data: pd.DataFrame) -> pd.DataFrame:
+    """ data with derived carbonate system rows appended """
+    derived = derive_carbonate(data)
+    if derived.empty:
+        return data
+    return pd.concat([data, derived], ignore_index=True)
@@ -1,18 +1,17 @@
 # -*- coding: utf-8 -*-
 from pipeline import utils
 from pipeline.formatter import Formatter
+from pipeline import lookup
+from pipeline.spec import (
+    Constant, Derived, FormattedTable, Mapped, TableSpec, converted_values, formatted_times, renamed
+)
 import pandas as pd
-from datetime import datetime
 import numpy as np
 from pathlib import Path
 from pytemp import pytemp  # for temperature unit conversion
-import time
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
-HERE = Path(__file__).resolve().parent
-stations = HERE / "metadata" / "stations.csv"
-
 # .xls does not allow more than 63356 rows
 MAX_EXCEL_SIZE = 65535
 
@@ -51,8 +50,127 @@ parameter_dict = {
     "tco2": "Carbon dioxide, free",
     "pH": "pH",
 }
+
+location_template = [
+    "StationCode",
+    "SampleDate",
+    "ProjectCode",
+    "EventCode",
+    "ProtocolCode",
+    "AgencyCode",
+    "SampleComments",
+    "LocationCode",
+    "GeometryShape",
+    "CoordinateNumber",
+    "ActualLatitude",
+    "ActualLongitude",
+    "Datum",
+    "CoordinateSource",
+    "Elevation",
+    "UnitElevation",
+    "StationDetailVerBy",
+    "StationDetailVerDate",
+    "StationDetailComments",
+]
+
+results_template = [
+    "StationCode",
+    "SampleDate",
+    "ProjectCode",
+    "EventCode",
+    "ProtocolCode",
+    "AgencyCode",
+    "SampleComments",
+    "LocationCode",
+    "GeometryShape",
+    "CollectionTime",
+    "CollectionMethodCode",
+    "Replicate",
+    "CollectionDeviceName",
+    "CollectionDepth",
+    "UnitCollectionDepth",
+    "PositionWaterColumn",
+    "FieldCollectionComments",
+    "MatrixName",
+    "MethodName",
+    "AnalyteName",
+    "FractionName",
+    "UnitName",
+    "FieldReplicate",
+    "Result",
+    "ResQualCode",
+    "QACode",
+    "ComplianceCode",
+    "BatchVerificationCode",
+    "CalibrationDate",
+    "FieldResultComments",
+]
+
+# unit -> conversion of values to the unit CEDEN takes
+conversions = {
+    "µmol/kg": lambda values: values * 1000,
+    "F": lambda values: values.apply(lambda x: pytemp(x, "f", "c")),
+    "inHg": lambda values: values / 0.0393701,
+}
+
+
+def or_default(default: str):
+    """ Mapping of values to themselves, or default where they are empty """
+    return lambda values: np.where(values, values, default)
+
+
+def agency_names() -> lookup.AgencyNames:
+    return lookup.get_lookup().agency("ceden", parameter_dict, utils.ceden_unit_dict)
+
+
+def station_codes(station_ids: pd.Series) -> pd.Series:
+    """ CEDEN StationCode of each station, its station_id if it has no ceden_id """
+    stations_table = lookup.get_lookup().stations_table
+    ceden_ids = pd.Series(
+        np.where(stations_table["ceden_id"], stations_table["ceden_id"], stations_table.index),
+        index=stations_table.index,
+    )
+    return station_ids.map(ceden_ids)
+
+
+def replicates(df: pd.DataFrame) -> pd.Series:
+    """ Number of each sample among the samples of its StationCode and day """
+    station_ids, uniques = pd.factorize(df["station_id"])
+    # stations sharing a StationCode count as one
+    stations = pd.factorize(station_codes(pd.Series(uniques)))[0][station_ids]
+    days = pd.factorize(pd.to_datetime(df["datetime"], utc=True).dt.floor("D"))[0]
+    return pd.Series(stations).groupby([stations, days]).cumcount() + 1
+
+
+location_spec = TableSpec({
+    **renamed(location_columns),
+    "StationCode": Mapped("station_id", station_codes),
+    "CoordinateNumber": Constant(1),
+    "LocationCode": Constant("Not Recorded"),
+    "EventCode": Constant("WQ"),
+    "ProtocolCode": Constant("Not Recorded"),
+    "GeometryShape": Constant("Point"),
+}, location_template)
+
+results_spec = TableSpec({
+    **renamed(results_columns),
+    **{column: Constant(value) for column, value in utils.ceden_field_misc.items()},
+    "StationCode": Mapped("station_id", station_codes),
+    "CollectionTime": formatted_times("datetime", "%H:%M", "min"),
+    "SampleDate": formatted_times("datetime", "%d/%m/%Y", "D"),
+    "MatrixName": Mapped("parameter", utils.ceden_matrix_dict),
+    "Replicate": Derived(replicates, requires=["station_id", "datetime"]),
+    "CollectionDeviceName": Mapped("instrument", or_default("Not Recorded")),
+    "MethodName": Mapped("method", or_default("FieldMeasure")),
+    "Result": converted_values(conversions),
+    "UnitName": Mapped("unit", lambda units: agency_names().unit(units)),
+    "AnalyteName": Mapped("parameter", lambda parameters: agency_names().parameter(parameters)),
+}, results_template)
+
+
 class CEDEN(Formatter):
     state = "California"
+    supports_excel = True
     instructions = """California Submission Instructions
     Before you run the pipeline, you should have:
      - Create an IR Portal account: https://public2.waterboards.ca.gov/IRPORTAL/Account/Register
@@ -62,35 +180,33 @@ class CEDEN(Formatter):
      - Submit results to the IR Portal
     """
 
-    def format_data_for_agency(self, data: pd.DataFrame) -> Path:
+    def format_data_for_agency(self, data: pd.DataFrame, only_stations: list=None) -> Path:
         """ Outermost method for transforming data into agency ready format
         
         Args:
             data: data from collector subclass in standardized format 
+            only_stations: if set, only batches with data from these
+                stations are rewritten
         Returns:
             nothing. Creates directory with results.
         """
-        split_n = data.shape[0] // MAX_EXCEL_SIZE + 1
-        dfs = np.array_split(data, split_n)
-
-        for batch_no, df in enumerate(dfs):
-            stations_table = pd.read_csv(stations, index_col="station_id")
+        stations_table = lookup.get_lookup().stations_table
+        for batch_no, df in enumerate(self.sorted_batches(data, MAX_EXCEL_SIZE)):
             stations_used = df["station_id"].unique()
+            if not self.affected(stations_used, only_stations, path=self.batch_files(batch_no)[-1]):
+                continue
             stations_subset = stations_table[stations_table.index.isin(stations_used)]
             locations = self.populate_locations(stations_subset)
             results = self.populate_field_results(df)
-            location_file = self.results_directory / "cbd_locations_b{}.csv".format(batch_no)
-            locations.to_csv(location_file)
-            results_file = self.results_directory / "cbd_results_b{}.csv".format(batch_no)
-            results.to_csv(results_file)
+            self.save_batch(batch_no, stations_used, locations, results)
 
         # create instructions
-        with open(self.results_directory / "README.txt", "w") as f:
+        with self.output(self.results_directory / "README.txt") as f:
             f.write(self.instructions.format(self.relative_path))
 
         return self.results_directory
 
-    def populate_locations(self, df: pd.DataFrame):
+    def populate_locations(self, df: pd.DataFrame) -> FormattedTable:
         """ Processes California data to match CEDEN template restrictions.
 
         Args:
@@ -98,120 +214,17 @@ class CEDEN(Formatter):
                 and 'stations' tables for California stations. 
             
         Returns:
-            locations_dataframe
+            locations table
         """
-        df = df.reset_index()
-        df["ceden_id"] = np.where(df["ceden_id"], df["ceden_id"], df["station_id"])
-        # Preprocess the dataframe to match CEDEN format
-        df = df[
-            ["ceden_id", "latitude", "longitude", "source", "horizontal_datum", "ceden_project_code", "horizontal_coordinate_collection"]
-        ]
-        df.rename(columns=location_columns, inplace=True, errors="ignore")
-        df["CoordinateNumber"] = 1
-        df["LocationCode"] = "Not Recorded"
-        df["EventCode"] = "WQ"
-        df["ProtocolCode"] = "Not Recorded"
-        df["GeometryShape"] = "Point"
-
-        df = df.loc[:, df.columns.isin(
-            [
-                "StationCode",
-                "SampleDate",
-                "ProjectCode",
-                "EventCode",
-                "ProtocolCode",
-                "AgencyCode",
-                "SampleComments",
-                "LocationCode",
-                "GeometryShape",
-                "CoordinateNumber",
-                "ActualLatitude",
-                "ActualLongitude",
-                "Datum",
-                "CoordinateSource",
-                "Elevation",
-                "UnitElevation",
-                "StationDetailVerBy",
-                "StationDetailVerDate",
-                "StationDetailComments",
-            ]
-        )]
-
-        return df
-
-
-    def populate_field_results(self, df):
+        return location_spec.apply(df.reset_index())
+
+    def populate_field_results(self, df: pd.DataFrame) -> FormattedTable:
         """ Processes California data to match CEDEN template restrictions.
 
         Args:
             df (DataFrame): Contains the merged columns of 'measurements' 
                 and 'stations' tables for California stations.             
         Returns:
-            field_results dataframe
+            field results table, df is left unchanged
         """
-        stations_table = pd.read_csv(stations)
-        stations_table["ceden_id"] = np.where(
-            stations_table["ceden_id"],
-            stations_table["ceden_id"], 
-            stations_table["station_id"]
-        )
-        df["station_id"] = df["station_id"].map(stations_table.set_index("station_id")["ceden_id"])
-        df["CollectionTime"] = pd.to_datetime(df["datetime"], utc=True).dt.strftime("%H:%M")
-        df["SampleDate"] = pd.to_datetime(df["datetime"], utc=True).dt.strftime("%d/%m/%Y")
-        df["MatrixName"] = df["parameter"].map(utils.ceden_matrix_dict)
-        df["Replicate"] = df.groupby(["station_id", "SampleDate"]).cumcount() + 1
-        df["instrument"] = np.where(df["instrument"], df["instrument"], "Not Recorded")
-        df["method"] = np.where(df["method"], df["method"], "FieldMeasure")
-
-        molg = df.loc[df.unit == "µmol/kg", "value"] * 1000
-        df.loc[df.unit == "µmol/kg", "value"] = molg
-
-        deg_c = df.loc[df.unit == "F", "value"].apply(lambda x: pytemp(x, "f", "c"))
-        df.loc[df.unit == "F", "value"] = deg_c
-
-        mmhg = df.loc[df.unit == "inHg", "value"] / 0.0393701
-        df.loc[df.unit == "inHg", "value"] = mmhg
-
-        for k, v in utils.ceden_field_misc.items():
-            df.loc[:, k] = v
-
-        
-        df["unit"] = df["unit"].map(utils.ceden_unit_dict)
-        df["parameter"] = df["parameter"].map(parameter_dict)
-        df.sort_values(["station_id", "parameter", "datetime"])
-        df.rename(columns=results_columns, inplace=True, errors="ignore")
-        df = df.loc[:, df.columns.isin(
-            [
-                "StationCode",
-                "SampleDate",
-                "ProjectCode",
-                "EventCode",
-                "ProtocolCode",
-                "AgencyCode",
-                "SampleComments",
-                "LocationCode",
-                "GeometryShape",
-                "CollectionTime",
-                "CollectionMethodCode",
-                "Replicate",
-                "CollectionDeviceName",
-                "CollectionDepth",
-                "UnitCollectionDepth",
-                "PositionWaterColumn",
-                "FieldCollectionComments",
-                "MatrixName",
-                "MethodName",
-                "AnalyteName",
-                "FractionName",
-                "UnitName",
-                "FieldReplicate",
-                "Result",
-                "ResQualCode",
-                "QACode",
-                "ComplianceCode",
-                "BatchVerificationCode",
-                "CalibrationDate",
-                "FieldResultComments",
-            ]
-        )]
-        return df
+        return results_spec.apply(df)
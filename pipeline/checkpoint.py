@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+CHECKPOINT_DIRECTORY = "checkpoints"
+RUN_FILE = "run.json"
+
+time_format = "%Y-%m-%dT%H:%M:%S"
+
+
+def checkpoint_directory(results_directory: Path) -> Path:
+    """ Directory holding checkpoints of a run """
+    directory = Path(results_directory) / CHECKPOINT_DIRECTORY
+    directory.mkdir(exist_ok=True, parents=True)
+    return directory
+
+
+def clear_checkpoints(results_directory: Path):
+    """ Removes the checkpoints of an earlier run in results_directory """
+    shutil.rmtree(Path(results_directory) / CHECKPOINT_DIRECTORY, ignore_errors=True)
+
+
+def checkpoint_path(results_directory: Path, station_id: str) -> Path:
+    """ Path of the checkpoint of one station's standardized data """
+    return checkpoint_directory(results_directory) / "{}.pkl".format(station_id)
+
+
+def write_atomic(data: pd.DataFrame, path: Path) -> Path:
+    """ Pickles data to path
+
+    Written to a temporary file and renamed, so a process killed while
+    writing never leaves a partial file behind.
+    """
+    partial = path.with_suffix(".partial")
+    data.to_pickle(partial)
+    os.replace(partial, path)
+    return path
+
+
+def save_checkpoint(results_directory: Path, station_id: str, data: pd.DataFrame) -> Path:
+    """ Saves one station's standardized data """
+    return write_atomic(data, checkpoint_path(results_directory, station_id))
+
+
+def completed_stations(results_directory: Path) -> set:
+    """ Ids of stations with a checkpoint in results_directory """
+    return {path.stem for path in checkpoint_directory(results_directory).glob("*.pkl")}
+
+
+def load_checkpoint(results_directory: Path, station_id: str) -> pd.DataFrame:
+    """ Standardized data of one station saved by save_checkpoint """
+    return pd.read_pickle(checkpoint_path(results_directory, station_id))
+
+
+def save_run(results_directory: Path, state: str, start_time: datetime, end_time: datetime, **options):
+    """ Records the arguments of a run so it can be resumed """
+    run = {
+        "state": state,
+        "start": start_time.strftime(time_format),
+        "end": end_time.strftime(time_format),
+        **options
+    }
+    with open(checkpoint_directory(results_directory) / RUN_FILE, "w") as f:
+        json.dump(run, f, indent=2)
+
+
+def load_run(results_directory: Path) -> dict:
+    """ Arguments of the run saved in results_directory """
+    with open(checkpoint_directory(results_directory) / RUN_FILE) as f:
+        run = json.load(f)
+    run["start"] = datetime.strptime(run["start"], time_format)
+    run["end"] = datetime.strptime(run["end"], time_format)
+    return run
@@ -0,0 +1,187 @@
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+import pandas as pd
+from pipeline import checkpoint
+from pipeline import utils
+
+HERE = Path(__file__).resolve().parent
+STORE_DIRECTORY = HERE.parent / "output" / "store"
+INDEX_FILE = "coverage.json"
+
+# coverage of fetches made without a parameter filter
+ALL_PARAMETERS = "*"
+
+# providers take dates, so fetches and coverage are in whole days
+DAY = timedelta(days=1)
+
+time_format = checkpoint.time_format
+
+
+def day_window(start_time: datetime, end_time: datetime) -> tuple:
+    """ Whole days containing the period """
+    start = datetime.combine(start_time.date(), datetime.min.time())
+    end = datetime.combine(end_time.date(), datetime.min.time())
+    if end < end_time:
+        end += DAY
+    return start, end
+
+
+def add_interval(intervals: list, start: datetime, end: datetime) -> list:
+    """ Sorted, disjoint intervals covering intervals and [start, end) """
+    merged = []
+    for interval_start, interval_end in sorted(intervals + [(start, end)]):
+        if merged and interval_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], interval_end))
+        else:
+            merged.append((interval_start, interval_end))
+    return merged
+
+
+def intersect(intervals: list, others: list) -> list:
+    """ Intervals covered by both sorted, disjoint interval lists """
+    common = []
+    for start, end in intervals:
+        for other_start, other_end in others:
+            if max(start, other_start) < min(end, other_end):
+                common.append((max(start, other_start), min(end, other_end)))
+    return common
+
+
+def subtract(start: datetime, end: datetime, intervals: list) -> list:
+    """ Parts of [start, end) outside the sorted, disjoint intervals """
+    gaps = []
+    for interval_start, interval_end in intervals:
+        if interval_end <= start or interval_start >= end:
+            continue
+        if interval_start > start:
+            gaps.append((start, interval_start))
+        start = max(start, interval_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class CoverageStore():
+    """ Standardized data fetched so far, indexed by the time it covers
+
+    Each fetch of a station is saved as one file, and the days it covered
+    are added to the station's interval set of each parameter fetched, or
+    of ALL_PARAMETERS if none was specified. A day counts as covered once
+    it was fetched, whether or not the station had data that day.
+
+    The index is json of station_id -> {"coverage": {parameter: [[start,
+    end], ...]}, "files": [[file, start, end], ...]}.
+    """
+
+    def __init__(self, directory: Path = STORE_DIRECTORY):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.index = {}
+        path = self.directory / INDEX_FILE
+        if path.exists():
+            with open(path) as f:
+                self.index = json.load(f)
+
+    def save_index(self):
+        path = self.directory / INDEX_FILE
+        with open(path.with_suffix(".partial"), "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(path.with_suffix(".partial"), path)
+
+    def intervals(self, station_id: str, parameter: str) -> list:
+        stored = self.index.get(station_id, {}).get("coverage", {}).get(parameter, [])
+        return [
+            (datetime.strptime(start, time_format), datetime.strptime(end, time_format))
+            for start, end in stored
+        ]
+
+    def covered(self, station_id: str, parameters: list = None) -> list:
+        """ Intervals in which all parameters, or the full station, were fetched """
+        full = self.intervals(station_id, ALL_PARAMETERS)
+        if parameters is None:
+            return full
+        covered = None
+        for parameter in parameters:
+            intervals = full
+            for interval in self.intervals(station_id, parameter):
+                intervals = add_interval(intervals, *interval)
+            covered = intervals if covered is None else intersect(covered, intervals)
+        return covered
+
+    def gaps(self, station_id: str, start_time: datetime, end_time: datetime, parameters: list = None) -> list:
+        """ Whole day windows of the period still to be fetched """
+        return subtract(*day_window(start_time, end_time), self.covered(station_id, parameters))
+
+    def save(self, station_id: str, start: datetime, end: datetime, data: pd.DataFrame, parameters: list = None):
+        """ Stores one fetch of a station and marks its window covered
+
+        Days not over yet when fetched are not marked covered, as
+        providers are still adding to them.
+        """
+        entry = self.index.setdefault(station_id, {"coverage": {}, "files": []})
+        name = "{}_{}_{}.pkl".format(
+            start.strftime("%Y%m%d"), end.strftime("%Y%m%d"), len(entry["files"])
+        )
+        station_directory = self.directory / str(station_id)
+        station_directory.mkdir(exist_ok=True)
+        checkpoint.write_atomic(data, station_directory / name)
+        entry["files"].append([name, start.strftime(time_format), end.strftime(time_format)])
+        end = min(end, day_window(datetime.now(), datetime.now())[0])
+        for parameter in parameters or [ALL_PARAMETERS]:
+            if start >= end:
+                break
+            intervals = add_interval(self.intervals(station_id, parameter), start, end)
+            entry["coverage"][parameter] = [
+                [interval_start.strftime(time_format), interval_end.strftime(time_format)]
+                for interval_start, interval_end in intervals
+            ]
+        self.save_index()
+
+    def load(self, station_id: str, start_time: datetime, end_time: datetime, parameters: list = None) -> pd.DataFrame:
+        """ Stored data of a station in the period
+
+        Samples stored by more than one fetch are kept once, from the
+        latest fetch.
+        """
+        frames = []
+        for name, start, end in self.index.get(station_id, {}).get("files", []):
+            if datetime.strptime(start, time_format) >= end_time or datetime.strptime(end, time_format) <= start_time:
+                continue
+            frames.append(pd.read_pickle(self.directory / str(station_id) / name))
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame()
+        data = pd.concat(frames, ignore_index=True)
+        times = pd.to_datetime(data["datetime"], utc=True)
+        selected = (
+            (times >= pd.Timestamp(start_time, tz="UTC")) & (times <= pd.Timestamp(end_time, tz="UTC"))
+        ).to_numpy()
+        if parameters is not None:
+            selected &= data["parameter"].isin(parameters).to_numpy()
+        data = data[selected]
+        keys = [column for column in utils.sample_columns if column in data.columns]
+        return data.drop_duplicates(subset=keys, keep="last").reset_index(drop=True)
+
+    def coverage(self, station_ids, start_time: datetime, end_time: datetime, parameters: list = None) -> pd.DataFrame:
+        """ Days of the period stored and still missing for each station
+
+        Answers what is available locally without fetching anything.
+        """
+        start, end = day_window(start_time, end_time)
+        rows = []
+        for station_id in station_ids:
+            for parameter in parameters or [ALL_PARAMETERS]:
+                covered = intersect(self.covered(station_id, [parameter] if parameters else None), [(start, end)])
+                gaps = subtract(start, end, covered)
+                rows.append({
+                    "station_id": station_id,
+                    "parameter": parameter,
+                    "days": (end - start).days,
+                    "covered_days": sum((interval_end - interval_start).days for interval_start, interval_end in covered),
+                    "gaps": ", ".join(
+                        "{} to {}".format(gap_start.date(), gap_end.date()) for gap_start, gap_end in gaps
+                    ),
+                })
+        return pd.DataFrame(rows)
@@ -0,0 +1,102 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pipeline import spec
+
+# rows encoded and written at once
+BLOCK_ROWS = 100000
+
+# text values containing these are quoted
+NEEDS_QUOTES = '[,"\r\n]'
+
+
+def is_numeric(values: pd.Series) -> bool:
+    return values.dtype.kind in "iuf"
+
+
+def column_text(values: pd.Series) -> pa.Array:
+    """ Text of each value, null where the value is missing
+
+    Numbers are formatted in bulk by arrow, shortest text that reads back
+    as the same number.
+    """
+    if is_numeric(values):
+        return pc.cast(pa.array(values.to_numpy(), from_pandas=True), pa.string())
+    if values.dtype.kind == "b":
+        return pa.array(np.where(values.to_numpy(), "True", "False"))
+    try:
+        return pa.array(values.to_numpy(object), type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # dates, numbers mixed with text and other objects
+        return pa.array(values.map(str, na_action="ignore").to_numpy(object), type=pa.string(), from_pandas=True)
+
+
+def encode_column(values: pd.Series) -> pa.Array:
+    """ Csv text of each value, null where the value is missing
+
+    Text is quoted only where needed. A spec.LazyColumn only has its
+    distinct values encoded, and a constant stays an arrow scalar.
+    """
+    if isinstance(values, spec.LazyColumn):
+        return values.encode(encode_column)
+    text = column_text(values)
+    if is_numeric(values):
+        return text
+    quote = pc.match_substring_regex(text, NEEDS_QUOTES)
+    if not pc.any(quote).as_py():
+        return text
+    quoted = pc.binary_join_element_wise('"', pc.replace_substring(text, '"', '""'), '"', "")
+    return pc.if_else(quote, quoted, text)
+
+
+def encode_rows(table: pd.DataFrame) -> bytes:
+    """ Csv lines of every row of table, without a header """
+    if table.empty:
+        return b""
+    columns = broadcast([encode_column(table[column]) for column in table.columns], len(table))
+    lines = pc.binary_join_element_wise(*columns, ",", null_handling="replace")
+    return concatenate(pc.binary_join_element_wise(lines, "", "\n"))
+
+
+def broadcast(columns: list, length: int) -> list:
+    """ Columns with the first made an array if all are scalars, so they join into length rows """
+    if not any(isinstance(column, pa.Array) for column in columns):
+        columns[0] = pa.array([columns[0].as_py()] * length, type=pa.string())
+    return columns
+
+
+def concatenate(lines: pa.Array) -> bytes:
+    """ All strings of lines, one after another """
+    # the lines are laid out one after another in the array's data buffer
+    offsets = np.frombuffer(lines.buffers()[1], dtype=np.int32, count=len(lines) + 1, offset=lines.offset * 4)
+    return lines.buffers()[2].slice(offsets[0], offsets[-1] - offsets[0]).to_pybytes()
+
+
+def encode_header(columns) -> bytes:
+    """ Csv line of column names """
+    return encode_rows(pd.DataFrame([list(columns)], columns=list(columns)))
+
+
+def write_csv(table: pd.DataFrame, handle, columns: list = None, header: bool = True, index: bool = False):
+    """ Writes table as csv in blocks of BLOCK_ROWS rows
+
+    Args:
+        table: data to write
+        handle: path, binary file or manifest.HashingWriter
+        columns: columns to write and their order, defaults to all
+        header: write column names first
+        index: write the index as the first column, named after it
+    """
+    if index:
+        table = table.reset_index()
+    if columns is not None:
+        table = table[columns]
+    if isinstance(handle, (str, Path)):
+        with open(handle, "wb") as f:
+            return write_csv(table, f, header=header)
+    if header:
+        handle.write(encode_header(table.columns))
+    for start in range(0, len(table), BLOCK_ROWS):
+        handle.write(encode_rows(table.iloc[start:start + BLOCK_ROWS]))
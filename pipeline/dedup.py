@@ -0,0 +1,109 @@
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pipeline import spill
+
+HERE = Path(__file__).resolve().parent
+stations = HERE / "metadata" / "stations.csv"
+
+# preferred source of a measurement reported by several providers, first
+# is best. Direct sources come before aggregators, providers not listed last.
+provider_priority = ["OOI", "CeNCOOS", "NERRS", "King County", "IPACOA"]
+
+# decimals kept of each key column, so the same sample reported by two
+# providers gets the same fingerprint
+key_decimals = {
+    "latitude": 2,
+    "longitude": 2,
+    "depth": 0,
+    "value": 1,
+}
+# samples are compared within the same period
+BUCKET_MINUTES = 10
+
+depth_units = {"ft": 0.3048, "m": 1.0}
+
+
+def fingerprints(data: pd.DataFrame) -> np.ndarray:
+    """ 64 bit hash of each row's location, depth, parameter, period and value
+
+    Depths are converted to meters and every key is rounded to
+    `key_decimals` before hashing.
+    """
+    depth = pd.to_numeric(data["depth"], errors="coerce")
+    if "depth_unit" in data.columns:
+        depth = depth * data["depth_unit"].map(depth_units).fillna(1.0)
+    keys = pd.DataFrame({
+        "latitude": pd.to_numeric(data["latitude"], errors="coerce").round(key_decimals["latitude"]),
+        "longitude": pd.to_numeric(data["longitude"], errors="coerce").round(key_decimals["longitude"]),
+        "depth": depth.round(key_decimals["depth"]),
+        "parameter": data["parameter"],
+        "period": pd.to_datetime(data["datetime"], utc=True).dt.floor("{}min".format(BUCKET_MINUTES)),
+        "value": pd.to_numeric(data["value"], errors="coerce").round(key_decimals["value"]),
+    })
+    # -0.0 and 0.0 must hash alike
+    for column in ["latitude", "longitude", "depth", "value"]:
+        keys[column] = keys[column] + 0.0
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def providers(data: pd.DataFrame) -> pd.Series:
+    """ Provider of each row, from stations.csv """
+    stations_table = pd.read_csv(stations, index_col="station_id")
+    return data["station_id"].map(stations_table["provider"])
+
+
+def sharing_stations(data, sample_fingerprints: np.ndarray) -> set:
+    """ Stations of data with a row whose fingerprint is in sample_fingerprints
+
+    Only these stations can have rows removed or kept differently by
+    remove_duplicates when the rows with sample_fingerprints change.
+    """
+    stations_found = set()
+    for part in spill.parts(data):
+        if part.empty:
+            continue
+        shared = np.isin(fingerprints(part), sample_fingerprints)
+        stations_found.update(part.loc[shared, "station_id"].unique())
+    return stations_found
+
+
+def remove_duplicates(data, priority: list = provider_priority):
+    """ Drops rows another, preferred provider also reported
+
+    Rows with the same fingerprint from different providers are the same
+    sample. Only rows of the best ranked provider in `priority` are kept.
+    Duplicates within one provider are left alone.
+
+    Args:
+        data: DataFrame or SpilledFrames in standardized long format. Only
+            the fingerprints of all frames are held at once.
+        priority: providers from most to least preferred
+    Returns:
+        data without cross provider duplicates
+    """
+    if data.empty:
+        return data
+    part_providers, part_ranks, part_fingerprints = [], [], []
+    for part in spill.parts(data):
+        row_providers = providers(part)
+        ranks = pd.Index(priority).get_indexer(row_providers)
+        ranks[ranks < 0] = len(priority)
+        part_providers.append(row_providers.to_numpy(object))
+        part_ranks.append(ranks)
+        part_fingerprints.append(fingerprints(part))
+    ranks = np.concatenate(part_ranks)
+    codes, uniques = pd.factorize(np.concatenate(part_fingerprints))
+    best = np.full(len(uniques), len(priority) + 1)
+    np.minimum.at(best, codes, ranks)
+    duplicate = ranks > best[codes]
+    if not duplicate.any():
+        return data
+    removed = pd.Series(np.concatenate(part_providers)[duplicate]).value_counts()
+    logging.info(
+        f"Removed {int(duplicate.sum())} rows also reported by a preferred provider: "
+        f"{removed.to_dict()}"
+    )
+    part_duplicates = iter(np.split(duplicate, np.cumsum([len(r) for r in part_ranks])[:-1]))
+    return spill.apply(data, lambda part: part[~next(part_duplicates)])
@@ -2,11 +2,12 @@ import pandas as pd
 from pathlib import Path
 import numpy as np
 import logging
-from datetime import datetime
+import shutil
 from pipeline.formatter import Formatter
-
-HERE = Path(__file__).resolve().parent
-stations = HERE / "metadata" / "stations.csv"
+from pipeline.csvencode import write_csv
+from pipeline import lookup
+from pipeline import spill
+from pipeline.spec import Constant, FormattedTable, Mapped, TableSpec, formatted_times, renamed
 
 MAX_EIM_ROWS = 150000
 
@@ -62,6 +63,74 @@ units = {
     "inHg": "in/Hg"
 }
 
+location_template = [
+    "Location ID",
+    "Location Name",
+    "Location Setting",
+    "Location Description",
+    "Coordinate System",
+    "Latitude Degrees",
+    "Longitude Degrees",
+    "Horizontal Coordinates Represent",
+    "Horizontal Datum",
+    "Horizontal Coordinate Accuracy",
+    "Horizontal Coordinate Collection Method"
+]
+
+results_template = [
+    "Study ID",
+    "Instrument ID",
+    "Location ID", 
+    "Study Specific Location ID",
+    "Field Collection Type",
+    "Field Collector",
+    "Matrix",
+    "Source",
+    "Start Date",
+    "Start Time",
+    "Result Parameter Name",
+    "Result Value",
+    "Result Unit",
+    "Result Method",
+    "Result Data Qualifier",
+    "Field Collection Reference Point",
+    "Field Collection Depth",
+    "Field Collection Depth Units"
+]
+
+
+def station_column(column: str) -> Mapped:
+    """ Step looking up each row's station in a column of stations.csv """
+    return Mapped("station_id", lambda station_ids: station_ids.map(lookup.get_lookup().stations_table[column]))
+
+
+def agency_names() -> lookup.AgencyNames:
+    return lookup.get_lookup().agency("eim", parameter_names, units)
+
+
+location_spec = TableSpec({
+    **renamed(location_columns),
+    "Location Setting": Constant("Water"),
+    "Coordinate System": Constant("LAT/LONG"),
+    # 24 = Discrete Monitoring Point
+    "Horizontal Coordinates Represent": Constant(24),
+}, location_template)
+
+results_spec = TableSpec({
+    **renamed(results_columns),
+    "Study ID": station_column("eim_study_id"),
+    "Study Specific Location ID": station_column("eim_location_study"),
+    "Field Collection Type": Constant("Measurement"),
+    "Field Collector": station_column("collector"),
+    "Field Collection Reference Point": station_column("reference_point"),
+    "Matrix": Constant("Water"),
+    "Source": Constant("Salt/Marine Water"),
+    "Start Date": formatted_times("datetime", "%m/%d/%Y", "D", utc=False),
+    "Start Time": formatted_times("datetime", "%H:%M:%S", "S", utc=False),
+    "Result Parameter Name": Mapped("parameter", lambda parameters: agency_names().parameter(parameters)),
+    "Result Unit": Mapped("unit", lambda units: agency_names().unit(units)),
+}, results_template)
+
 class EIM(Formatter):
     state = "Washington"
     instructions = """Washington Submission Steps
@@ -79,28 +148,44 @@ class EIM(Formatter):
      - Follow the instructions here (https://fortress.wa.gov/ecy/eimhelp/HelpDocuments/OpenDocument/13) to submit the generated data files in this directory. Note that each study will have its own subdirectory. 
     """
 
-    def format_data_for_agency(self, data: pd.DataFrame) -> Path:
+    def format_data_for_agency(self, data: pd.DataFrame, only_stations: list=None) -> Path:
         """ Outermost method for transforming data into agency ready format
         
         Args:
             data: data from collector subclass in standardized format 
+            only_stations: if set, only study directories with data from
+                these stations are rewritten
         Returns:
             path to directory with results.
         """
-        stations_table = pd.read_csv(stations, index_col="station_id")
-        stations_used = data["station_id"].unique()
+        stations_table = lookup.get_lookup().stations_table
+        stations_used = spill.station_ids(data)
         stations_subset = stations_table[stations_table.index.isin(stations_used)]
         stations_subset.reset_index(inplace=True)
         study_ids = list(stations_subset["eim_study_id"].unique())
         if len(study_ids) == 1 and isinstance(study_ids[0], np.float) and np.isnan(study_ids[0]):
             logging.error("Stations must have an 'eim_study_id in stations.csv")
             raise ValueError("No returned stations have an 'eim_study_id' in stations.csv")
+        # studies that held these stations before, in case a station moved study
+        previous_studies = set()
+        if only_stations is not None:
+            previous_studies = {
+                path.split("/")[0] for path, station_ids in self.artifacts.items()
+                if "/" in path and self.affected(station_ids, only_stations)
+            }
         for study_id in stations_subset["eim_study_id"].unique():
             stations_used_by_study = stations_subset[stations_subset["eim_study_id"] == study_id]["station_id"].unique()
-            self.save_results_for_study(data[data["station_id"].isin(stations_used_by_study)], study_id)
+            if only_stations is not None:
+                if not self.affected(stations_used_by_study, only_stations) and str(study_id) not in previous_studies:
+                    continue
+                self.clear_study(study_id)
+            self.save_results_for_study(spill.select(data, stations_used_by_study), study_id)
+            previous_studies.discard(str(study_id))
+        for study_id in previous_studies:
+            self.clear_study(study_id)
         
         # create instructions
-        with open(self.results_directory / "README.txt", "w") as f:
+        with self.output(self.results_directory / "README.txt") as f:
             f.write(self.instructions.format(self.relative_path))
 
         return self.results_directory
@@ -111,104 +196,59 @@ class EIM(Formatter):
         # 150,000 records per batch. 1 study + location per batch
         study_result_directory = self.results_directory / str(study_id)
         study_result_directory.mkdir(exist_ok=True)
-        stations_table = pd.read_csv(stations, index_col="station_id")
+        stations_table = lookup.get_lookup().stations_table
         stations_used = data["station_id"].unique()
         stations_subset = stations_table[stations_table.index.isin(stations_used)]
         locations_table = self.create_locations_table(stations_subset)
-        locations_table.to_csv(study_result_directory / "{}_locations.csv".format(study_id))
+        locations_file = study_result_directory / "{}_locations.csv".format(study_id)
+        with self.output(locations_file) as f:
+            write_csv(locations_table, f)
+        self.track(locations_file, stations_used)
         for station_id in stations_used:
             if not stations_table.loc[station_id, "approved"]:
                 continue
             station_data = data[data["station_id"] == station_id]
-            splits = station_data.shape[0] // MAX_EIM_ROWS + 1
-            for batch_no, batch in enumerate(np.array_split(station_data, splits)):
+            for batch_no, batch in enumerate(self.sorted_batches(station_data, MAX_EIM_ROWS)):
                 results_table = self.create_results_table(batch)
                 result_file = study_id + "_" + station_id + "_b" + str(batch_no) + ".csv"
-                results_table.to_csv(study_result_directory / result_file)
+                with self.output(study_result_directory / result_file) as f:
+                    write_csv(results_table, f)
+                self.track(study_result_directory / result_file, [station_id])
+
+    def clear_study(self, study_id: str):
+        """ Removes a study directory and its tracked files before it is rewritten """
+        shutil.rmtree(self.results_directory / str(study_id), ignore_errors=True)
+        prefix = "{}/".format(study_id)
+        self.artifacts = {
+            path: station_ids for path, station_ids in self.artifacts.items()
+            if not path.startswith(prefix)
+        }
+        self.manifest = {
+            path: entry for path, entry in self.manifest.items()
+            if not path.startswith(prefix)
+        }
 
             
-    def create_results_table(self, data: pd.DataFrame):
-        """ Creates dataframe with required time series result info
+    def create_results_table(self, data: pd.DataFrame) -> FormattedTable:
+        """ Creates table with required time series result info
         
         Args:
-            data: each row is the result from one parameter
+            data: each row is the result from one parameter, left unchanged
         Returns:
-            modified data with proper columns and values
+            table with proper columns and values
         """
-        stations_table = pd.read_csv(stations, index_col="station_id")
-        data["Study ID"] = data["station_id"].map(stations_table["eim_study_id"])
-        data["Study Specific Location ID"] = data["station_id"].map(stations_table["eim_location_study"])
-        data["Field Collection Type"] = "Measurement"
-        data["Field Collector"] = data["station_id"].map(stations_table["collector"])
-        data["Field Collection Reference Point"] = data["station_id"].map(stations_table["reference_point"])
-        data["Matrix"] = "Water"
-        data["Source"] = "Salt/Marine Water"
-        eim_date_format = "%m/%d/%Y"
-        eim_time_format = "%H:%M:%S"
-        data["Start Date"] = pd.to_datetime(data["datetime"]).dt.strftime(eim_date_format)
-        data["Start Time"] = pd.to_datetime(data["datetime"]).dt.strftime(eim_time_format)
         # check which parameters are not included
         unknown_parameters = set(data["parameter"].unique()).difference(set(parameter_names.keys()))
         if len(unknown_parameters) > 0:
             logging.info(f"{unknown_parameters} in data but have no EIM parameter name listed.")
-        data["parameter"] = data["parameter"].map(parameter_names)
-        data["unit"] = data["unit"].map(units)
-        results_table = data.rename(columns=results_columns)
-        results_table = results_table.loc[:, results_table.columns.isin(
-            [
-                "Study ID",
-                "Instrument ID",
-                "Location ID", 
-                "Study Specific Location ID",
-                "Field Collection Type",
-                "Field Collector",
-                "Matrix",
-                "Source",
-                "Start Date",
-                "Start Time",
-                "Result Parameter Name",
-                "Result Value",
-                "Result Unit",
-                "Result Method",
-                "Result Data Qualifier",
-                "Field Collection Reference Point",
-                "Field Collection Depth",
-                "Field Collection Depth Units"
-            ]
-        )]
-
-
-
-        return results_table
-        
+        return results_spec.apply(data)
 
-    def create_locations_table(self, station_data: pd.DataFrame):
-        """ Creates dataframe with required station information 
+    def create_locations_table(self, station_data: pd.DataFrame) -> FormattedTable:
+        """ Creates table with required station information 
         
         Args:
-            station_data: each row is a location 
+            station_data: each row is a location, indexed by station_id
         Returns:
-            modified station data with proper columns and names
+            table with proper columns and names
         """
-        station_data.reset_index(inplace=True)
-        location_data = station_data.rename(columns=location_columns)
-        location_data["Location Setting"] = "Water"
-        location_data["Coordinate System"] = "LAT/LONG"
-        # 24 = Discrete Monitoring Point
-        location_data["Horizontal Coordinates Represent"] = 24
-        location_data = location_data.loc[:, location_data.columns.isin(
-            [
-                "Location ID",
-                "Location Name",
-                "Location Setting",
-                "Location Description",
-                "Coordinate System",
-                "Latitude Degrees",
-                "Longitude Degrees",
-                "Horizontal Coordinates Represent",
-                "Horizontal Datum",
-                "Horizontal Coordinate Accuracy",
-                "Horizontal Coordinate Collection Method"
-            ]
-        )]
-        return location_data
+        return location_spec.apply(station_data.reset_index())
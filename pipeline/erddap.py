@@ -1,17 +1,26 @@
-from datetime import datetime, timedelta
-from urllib.error import HTTPError
+from datetime import datetime
+from urllib.parse import quote
 import pandas as pd
-import numpy as np
 import erddapy
-import requests
+import logging
 from pathlib import Path
 from pipeline import utils
+from pipeline import spatial
+from pipeline import lookup
+from pipeline import qc
 
 
 index_columns = ["datetime", "latitude", "longitude", "station_id", "depth"]
+# dataset variables standardize_data turns into index_columns
+index_variables = ["time", "latitude", "longitude", "station", "z"]
 
 HERE = Path(__file__).resolve().parent
-station_parameter_metadata = HERE / 'metadata' / 'station_parameter_metadata.csv'
+
+# Approximate box containing all water within 3 miles of west coast
+west_coast = pd.DataFrame({
+    "latitude": [32, 50, 50, 32],
+    "longitude": [-134, -134, -117, -117],
+})
 
 class ERDDAP():
 
@@ -19,11 +28,16 @@ class ERDDAP():
 
     def __init__(self, server_id):
         self.server_id = server_id
+        # dataset id -> its variables, listed once
+        self.dataset_variables = {}
 
     def get_location_data(
             self,
             start_time,
-            end_time
+            end_time,
+            region=None,
+            coastline=None,
+            buffer_miles=3
     ):
         """ Generates dataframe of west coast pH datasets from server_id 
         
@@ -31,20 +45,26 @@ class ERDDAP():
             server_id (str): URL of ERDDAP server
             start_time (datetime): start of time window of interest
             end_time (datetime): end of time window of interest
+            region (pd.DataFrame): polygon vertices with latitude and
+                longitude columns. Defaults to a box around the west coast.
+            coastline (pd.DataFrame): optional coastline vertices with
+                latitude and longitude columns. If given, only datasets
+                within buffer_miles of the coastline are kept.
+            buffer_miles (float): distance from coastline to keep
         Returns:
             (pd.DataFrame): Each row is dataset hosted by server that
-            measures pH and is generally located on the US west coast.
+            measures pH and is located in region.
         """
         time_format = "%Y-%m-%dT%H:%M:%SZ"
-        # Approximate box containing all water within 3 miles of west coast
-        min_longitude, max_longitude = -134, -117
-        min_latitude, max_latitude = 32, 50
+        if region is None:
+            region = west_coast
+        # the search only accepts a box, region is applied after
         key_words = {
             "standard_name": "sea_water_ph_reported_on_total_scale",
-            "min_longitude": min_longitude,
-            "max_longitude": max_longitude,
-            "min_latitude": min_latitude,
-            "max_latitude": max_latitude,
+            "min_longitude": region["longitude"].min(),
+            "max_longitude": region["longitude"].max(),
+            "min_latitude": region["latitude"].min(),
+            "max_latitude": region["latitude"].max(),
             "min_time": datetime.strftime(start_time, time_format),
             "max_time": datetime.strftime(end_time, time_format),
             "cdm_data_type": "TimeSeries"
@@ -65,13 +85,44 @@ class ERDDAP():
         )
         locations["provider"] = self.server_id
         locations = locations[["station_id", "name", "source", "provider"]]
+        locations = locations.merge(self.get_dataset_locations(), on="station_id", how="left")
+        unlocated = locations["latitude"].isna() | locations["longitude"].isna()
+        if unlocated.any():
+            logging.warning(f"{unlocated.sum()} datasets have no location and were skipped")
+        locations = locations[~unlocated]
+        index = spatial.StationIndex.from_frame(locations)
+        inside = index.in_polygon(region["latitude"], region["longitude"])
+        locations = locations.iloc[inside]
+        if coastline is not None:
+            near_coast = spatial.within_buffer(
+                locations["latitude"], locations["longitude"], coastline, buffer_miles
+            )
+            locations = locations[near_coast]
         return locations
 
+    def get_dataset_locations(self):
+        """ Location of every dataset on the server, from its allDatasets table
+
+        Returns:
+            (pd.DataFrame): station_id with the center of the dataset's
+            latitude and longitude bounds
+        """
+        url = "{}tabledap/allDatasets.csv?datasetID,minLongitude,maxLongitude,minLatitude,maxLatitude".format(self.server_id)
+        # second row of erddap csv responses holds units
+        bounds = pd.read_csv(url, skiprows=[1])
+        return pd.DataFrame({
+            "station_id": bounds["datasetID"],
+            "latitude": (bounds["minLatitude"] + bounds["maxLatitude"]) / 2,
+            "longitude": (bounds["minLongitude"] + bounds["maxLongitude"]) / 2,
+        })
+
     def get_data(
         self,
         dataset_id,
         start_date,
-        end_date        
+        end_date,
+        thin=None,
+        parameters=None
     ):
         """ Retrieves data from input server and time range as DataFrame.
         
@@ -79,6 +130,10 @@ class ERDDAP():
             dataset_id (str): id of dataset hosted on input server_id.
             start_date (datetime): Earliest time to retrieve measurements from
             end_date (datetime): Latest time to retrieve measurements from
+            thin (int): If set, ERDDAP returns only the sample closest to
+                each `thin` minute interval (server side orderByClosest)
+            parameters (list): If set, only variables normalized to these
+                parameters, and their quality flags, are requested
         Returns:
             pd.DataFrame: Contains information on all platforms listed in the input csv.
         """
@@ -93,14 +148,43 @@ class ERDDAP():
             "time>=": "{}".format(start_date.strftime(self.time_format)),
             "time<=": "{}".format(end_date.strftime(self.time_format)),
         }
-        dataset_df = erddap_builder.to_pandas()
+        if parameters is not None:
+            variables = self.selected_variables(dataset_id, parameters)
+            if not variables:
+                logging.info(f"{dataset_id} has none of the requested parameters")
+                return pd.DataFrame()
+            erddap_builder.variables = index_variables + variables
+        if thin:
+            # orderByClosest is not a constraint erddapy knows how to quote
+            order_by = 'orderByClosest("station,z,time/{}minutes")'.format(thin)
+            url = erddap_builder.get_download_url(response="csvp")
+            dataset_df = pd.read_csv(url + "&" + quote(order_by))
+        else:
+            dataset_df = erddap_builder.to_pandas()
         dataset_df['station_id'] = dataset_id
         long_df = self.standardize_data(dataset_df)
         return long_df
 
+    def selected_variables(self, dataset_id, parameters) -> list:
+        """ Variables of a dataset normalized to one of parameters, with their qc variables """
+        if dataset_id not in self.dataset_variables:
+            erddap_builder = erddapy.ERDDAP(server=self.server_id, protocol="tabledap")
+            info = pd.read_csv(erddap_builder.get_info_url(dataset_id, response="csv"))
+            self.dataset_variables[dataset_id] = info.loc[info["Row Type"] == "variable", "Variable Name"]
+        variables = self.dataset_variables[dataset_id]
+        raw_names = utils.raw_parameter_names(parameters)
+        # qc variables are var_name_qc_agg and var_name_qc_tests
+        measured = variables.str.replace("_qc_(agg|tests)$", "", regex=True)
+        return list(variables[measured.isin(raw_names)])
+
+    def request_count(self, station_id, parameters=None):
+        """ Number of requests get_data makes for a station """
+        # the dataset's variables are listed before selecting from them
+        return 1 if parameters is None else 2
+
     def filter_poor_data(self, dataset: pd.DataFrame) -> pd.DataFrame:
         """Remove suspect / poor quality data"""
-        dataset["suspect"] = (dataset["quality"] >= 3)
+        dataset["suspect"] = (dataset["quality"] >= qc.SUSPECT)
         return dataset[~dataset["suspect"]]
 
     def standardize_data(self, dataset: pd.DataFrame):
@@ -126,9 +210,10 @@ class ERDDAP():
         long_df.dropna(subset=['value'], inplace=True)
         long_df.rename(columns={"qc_agg": "quality"}, inplace=True)
         long_df.reset_index(inplace=True)
-        parameter_metadata = pd.read_csv(station_parameter_metadata, index_col=["station_id", "parameter"])
-        long_df = long_df.join(parameter_metadata, on=["station_id", "parameter"], how='left')
-        long_df['parameter'] = long_df["parameter"].map(utils.parameter_dict)
+        long_df = lookup.get_lookup().enrich(long_df)
         long_df["depth_unit"] = "m"
+        # only the provider's own flags remove data, variables without qc
+        # columns are then flagged by our tests
         long_df = self.filter_poor_data(long_df)
+        long_df["quality"] = qc.fill_flags(long_df)
         return long_df
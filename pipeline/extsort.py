@@ -0,0 +1,165 @@
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator
+import numpy as np
+import pandas as pd
+from pipeline.spill import SpilledFrames
+
+# order of agency results files
+SORT_COLUMNS = ["station_id", "parameter", "datetime"]
+# bytes of data held in memory at once while sorting
+MEMORY_BUDGET = 512 * 2**20
+
+# sort keys added to spilled blocks
+GROUP = "_sort_group"
+TIME = "_sort_time"
+ROW = "_sort_row"
+
+
+def rebatch(frames: Iterable[pd.DataFrame], rows: int) -> Iterator[pd.DataFrame]:
+    """ Consecutive rows of frames in batches of exactly `rows` rows, the last may be shorter """
+    pending, pending_rows = [], 0
+    for frame in frames:
+        start = 0
+        while start < len(frame):
+            piece = frame.iloc[start:start + rows - pending_rows]
+            pending.append(piece)
+            pending_rows += len(piece)
+            start += len(piece)
+            if pending_rows == rows:
+                yield pd.concat(pending)
+                pending, pending_rows = [], 0
+    if pending:
+        yield pd.concat(pending)
+
+
+def sorted_chunks(
+    frames, memory_budget: int = MEMORY_BUDGET, spill_directory: Path = None
+) -> Iterator[pd.DataFrame]:
+    """ Standardized data sorted by station, parameter and time
+
+    Data that fits the memory budget is sorted in memory. Larger data is
+    cut into runs that fit the budget, each run is sorted and spilled to
+    disk in blocks, and the runs are merged reading one block of each at
+    a time. Missing parameters and times sort last, and rows with equal
+    keys keep their input order, as with a stable DataFrame.sort_values.
+
+    Args:
+        frames: DataFrame, list of DataFrames or SpilledFrames in
+            standardized format. Frames are read twice and never all
+            held at once, except when they fit the budget.
+        memory_budget: approximate bytes of data to hold at once
+        spill_directory: where runs are spilled, defaults to the system
+            temporary directory
+    Yields:
+        consecutive sorted chunks of the data with the input's index
+    """
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    total = len(frames) if isinstance(frames, SpilledFrames) else sum(len(frame) for frame in frames)
+    if total == 0:
+        return
+    sample = next(frame for frame in frames if len(frame)).head(1000)
+    row_bytes = max(sample.memory_usage(deep=True).sum() / len(sample), 1)
+    run_rows = max(int(memory_budget // row_bytes), 1)
+    keys = SortKeys(frames)
+    if total <= run_rows:
+        data = pd.concat(frames)
+        yield data.iloc[keys.order(keys.add(data, 0))]
+        return
+    n_runs = -(-total // run_rows)
+    # a block of every run, and the rows merged from them, fit the budget
+    block_rows = max(run_rows // (2 * n_runs), 1)
+    with tempfile.TemporaryDirectory(dir=spill_directory) as directory:
+        runs = []
+        first_row = 0
+        for run_no, run in enumerate(rebatch(frames, run_rows)):
+            run = keys.add(run, first_row)
+            first_row += len(run)
+            run = run.iloc[keys.order(run)]
+            blocks = []
+            for block_no, block in enumerate(rebatch([run], block_rows)):
+                path = Path(directory) / "run{}_block{}.pkl".format(run_no, block_no)
+                block.to_pickle(path)
+                blocks.append(path)
+            runs.append(blocks)
+        yield from _merge(runs)
+
+
+class SortKeys():
+    """ Integer sort keys of standardized data
+
+    Station and parameter names are ranked once over all frames, so runs
+    sorted separately compare on the same keys.
+    """
+
+    def __init__(self, frames: list):
+        stations, parameters = [], []
+        for frame in frames:
+            stations.append(frame["station_id"].unique())
+            parameters.append(frame["parameter"].unique())
+        stations = pd.Index(np.concatenate(stations))
+        parameters = pd.Index(np.concatenate(parameters))
+        self.stations = stations.dropna().unique().sort_values()
+        self.parameters = parameters.dropna().unique().sort_values()
+
+    def add(self, data: pd.DataFrame, first_row: int) -> pd.DataFrame:
+        """ data with sort key columns added """
+        station_codes = self._codes(data["station_id"], self.stations)
+        parameter_codes = self._codes(data["parameter"], self.parameters)
+        times = pd.to_datetime(data["datetime"], utc=True)
+        time_codes = times.values.view("i8").copy()
+        time_codes[times.isna().values] = np.iinfo(np.int64).max
+        return data.assign(**{
+            GROUP: station_codes * (len(self.parameters) + 1) + parameter_codes,
+            TIME: time_codes,
+            ROW: np.arange(first_row, first_row + len(data)),
+        })
+
+    @staticmethod
+    def _codes(values: pd.Series, index: pd.Index) -> np.ndarray:
+        # missing values sort last
+        codes = index.get_indexer(values)
+        codes[codes < 0] = len(index)
+        return codes.astype(np.int64)
+
+    @staticmethod
+    def order(data: pd.DataFrame) -> np.ndarray:
+        """ Positions of data's rows in sorted order """
+        return np.lexsort((data[ROW].values, data[TIME].values, data[GROUP].values))
+
+
+def _load(blocks: list):
+    for path in blocks:
+        yield pd.read_pickle(path)
+
+
+def _merge(runs: list) -> Iterator[pd.DataFrame]:
+    """ K-way merge of sorted runs spilled in blocks
+
+    The smallest last key of the loaded blocks bounds what is left unread,
+    so every loaded row up to it can be merged and emitted.
+    """
+    readers = [_load(blocks) for blocks in runs]
+    loaded = [next(reader) for reader in readers]
+    while readers:
+        bound = min(
+            (block[GROUP].iat[-1], block[TIME].iat[-1], block[ROW].iat[-1]) for block in loaded
+        )
+        heads = []
+        for i, block in enumerate(loaded):
+            group, time, row = block[GROUP].values, block[TIME].values, block[ROW].values
+            before = (group < bound[0]) | (group == bound[0]) & (
+                (time < bound[1]) | (time == bound[1]) & (row <= bound[2])
+            )
+            n = int(before.sum())
+            heads.append(block.iloc[:n])
+            loaded[i] = block.iloc[n:]
+        merged = pd.concat(heads)
+        yield merged.iloc[SortKeys.order(merged)].drop(columns=[GROUP, TIME, ROW])
+        for i in reversed(range(len(readers))):
+            if loaded[i].empty:
+                try:
+                    loaded[i] = next(readers[i])
+                except StopIteration:
+                    del readers[i], loaded[i]
@@ -1,12 +1,26 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 import pandas as pd
+from pipeline import extsort
+from pipeline import xlsx
+from pipeline.csvencode import write_csv
+from pipeline import manifest
+from pipeline import spill
 
 HERE = Path(__file__).resolve().parent
 
 class Formatter(ABC):
 
+    # bytes of data sorted in memory before spilling to disk
+    memory_budget = extsort.MEMORY_BUDGET
+    # gzip csv files as they are written, adding .gz to their names
+    compress = False
+    # save batches as xlsx workbooks instead of csv files, where supported
+    excel = False
+    supports_excel = False
+
     @property
     def start(self) -> str:
         """ Name of state to format for """
@@ -19,6 +33,15 @@ class Formatter(ABC):
 
     def __init__(self, output_directory: Path=None):
         """ initialize with proper output directory """
+        # relative path of each output file -> stations whose data it holds
+        self.artifacts = {}
+        # relative path of each output file -> hash and size of its content
+        self.manifest = {}
+        # relative paths of output files written, or found unchanged
+        self.written = set()
+        self.unchanged = []
+        # fed every batch of standardized data before it is formatted
+        self.sinks = []
         if output_directory is None:
             request_time = datetime.now().strftime("%Y-%m-%dT%H-%M")
             self.relative_path = Path("output") / self.state / request_time
@@ -29,12 +52,122 @@ class Formatter(ABC):
             self.relative_path = Path("output") / self.state / output_directory.name
 
     @abstractmethod
-    def format_data_for_agency(self, data: pd.DataFrame) -> Path:
+    def format_data_for_agency(self, data: pd.DataFrame, only_stations: list=None) -> Path:
         """ Outermost method for transforming data into agency ready format
         
         Args:
             data: data from collector subclass in standardized format 
+            only_stations: if set, only output files that hold data from
+                these stations are rewritten
         Returns:
             nothing. Creates directory with results.
         """
         return NotImplemented
+
+    def sorted_batches(self, data, max_rows: int):
+        """ data in station, parameter and time order, split in batches
+
+        Batches have at most max_rows rows, and as many batches as
+        np.array_split would make, of nearly equal size.
+
+        Args:
+            data: DataFrame or SpilledFrames
+        """
+        if data.empty:
+            return self.feed_sinks(spill.parts(data))
+        split_n = len(data) // max_rows + 1
+        batch_rows = -(-len(data) // split_n)
+        return self.feed_sinks(
+            extsort.rebatch(extsort.sorted_chunks(data, self.memory_budget), batch_rows)
+        )
+
+    def feed_sinks(self, batches):
+        """ Passes each batch to every sink on its way to the agency files """
+        for batch in batches:
+            for sink in self.sinks:
+                sink.write(batch)
+            yield batch
+
+    def output_path(self, path: Path) -> Path:
+        """ Where an output file is written, with .gz added to csv files if compressing """
+        path = Path(path)
+        if self.compress and path.suffix == ".csv":
+            return path.with_name(path.name + ".gz")
+        return path
+
+    def relative(self, path: Path) -> str:
+        """ Key of an output file in the manifest and artifacts """
+        return self.output_path(path).relative_to(self.results_directory).as_posix()
+
+    @contextmanager
+    def output(self, path: Path):
+        """ Handle to write an output file through
+
+        The content is hashed into the manifest as it is written. If the
+        file already holds the same content, it is left untouched.
+        """
+        relative = self.relative(path)
+        compress = self.output_path(path) != Path(path)
+        with manifest.write_if_changed(self.output_path(path), self.manifest, relative, compress) as f:
+            yield f
+        self.written.add(relative)
+        if not f.changed:
+            self.unchanged.append(relative)
+
+    def prune(self) -> list:
+        """ Removes output files in the manifest that were not written this time
+
+        Returns:
+            relative paths of the removed files
+        """
+        removed = sorted(set(self.manifest) - self.written)
+        for relative in removed:
+            path = self.results_directory / relative
+            if path.exists():
+                path.unlink()
+            if path.parent != self.results_directory and path.parent.exists() and not any(path.parent.iterdir()):
+                path.parent.rmdir()
+            del self.manifest[relative]
+            self.artifacts.pop(relative, None)
+        return removed
+
+    def batch_files(self, batch_no: int) -> list:
+        """ Output files of a batch of locations and results, the results last """
+        if self.excel:
+            return [self.results_directory / "cbd_b{}.xlsx".format(batch_no)]
+        return [
+            self.results_directory / "cbd_locations_b{}.csv".format(batch_no),
+            self.results_directory / "cbd_results_b{}.csv".format(batch_no),
+        ]
+
+    def save_batch(self, batch_no: int, station_ids, locations: pd.DataFrame, results: pd.DataFrame):
+        """ Writes a batch's locations and results as two csv files, or one workbook
+
+        The workbook has a Locations and a Field Results sheet.
+        """
+        if self.excel:
+            [workbook_file] = self.batch_files(batch_no)
+            with self.output(workbook_file) as f:
+                xlsx.write_workbook(f, {"Locations": locations, "Field Results": results})
+            self.track(workbook_file, station_ids)
+            return
+        for path, table in zip(self.batch_files(batch_no), [locations, results]):
+            with self.output(path) as f:
+                write_csv(table, f)
+            self.track(path, station_ids)
+
+    def track(self, path: Path, station_ids) -> None:
+        """ Records which stations' data an output file holds """
+        self.artifacts[self.relative(path)] = sorted(str(i) for i in station_ids)
+
+    def affected(self, station_ids, only_stations: list=None, path: Path=None) -> bool:
+        """ Whether an output file with station_ids must be written
+
+        Files are written if no station filter is given, if they hold data
+        from only_stations, or if path used to hold a different set of stations.
+        """
+        if only_stations is None or set(station_ids) & set(only_stations):
+            return True
+        if path is None:
+            return False
+        return self.artifacts.get(self.relative(path)) != sorted(str(i) for i in station_ids)
@@ -1,10 +1,8 @@
 from .formatter import Formatter
+from . import lookup
+from .spec import FormattedTable, TableSpec, formatted_times, renamed
 from pathlib import Path
 import pandas as pd
-import numpy as np
-
-HERE = Path(__file__).resolve().parent
-stations = HERE / "metadata" / "stations.csv"
 
 MAX_BATCH_SIZE = 150000
 
@@ -27,8 +25,40 @@ results_columns = {
     "depth_unit": "DepthUnit"
 }
 
+location_template = [
+    "station_id",
+    "name",
+    "source",
+    "accessed_via",
+    "latitude",
+    "longitude",
+    "description",
+    "setting",
+    "horizontal_datum",
+    "horizontal_coordinate_collection_method",
+    "horizontal_coordinate_accuracy",
+]
+
+results_template = [
+    "Station", "Date", "Time", "Latitude", "Longitude", "Parameter",
+    "Value", "Unit", "CollectionMethod", "Instrument", "QualityCodes",
+    "Depth", "DepthUnit"
+]
+
+location_spec = TableSpec({
+    **renamed({column: column for column in location_template}),
+    **renamed(location_columns),
+}, location_template)
+
+results_spec = TableSpec({
+    **renamed(results_columns),
+    "Date": formatted_times("datetime", "%d/%m/%Y", "D"),
+    "Time": formatted_times("datetime", "%H:%M", "min"),
+}, results_template)
+
 class Hawaii(Formatter):
     state = "Hawaii"
+    supports_excel = True
     instructions = """Hawaii Submission Instructions
     Before you run the pipeline, you should have:
      - Filled out the Data submission form: https://health.hawaii.gov/cwb/files/2021/03/data-submittal-2022.pdf
@@ -38,56 +68,25 @@ class Hawaii(Formatter):
      - Submit results to the HIDOH as CSVs via email: cleanwaterbranch@doh.hawaii.gov
     """  
 
-    def format_data_for_agency(self, data: pd.DataFrame) -> Path:
-        split_n = data.shape[0] // MAX_BATCH_SIZE + 1
-        dfs = np.array_split(data, split_n)
-
-        for batch_no, df in enumerate(dfs):
-            stations_table = pd.read_csv(stations, index_col="station_id")
+    def format_data_for_agency(self, data: pd.DataFrame, only_stations: list=None) -> Path:
+        stations_table = lookup.get_lookup().stations_table
+        for batch_no, df in enumerate(self.sorted_batches(data, MAX_BATCH_SIZE)):
             stations_used = df["station_id"].unique()
+            if not self.affected(stations_used, only_stations, path=self.batch_files(batch_no)[-1]):
+                continue
             stations_subset = stations_table[stations_table.index.isin(stations_used)]
             locations = self.populate_locations(stations_subset)
             results = self.populate_field_results(df)
-            location_file = self.results_directory / "cbd_locations_b{}.csv".format(batch_no)
-            locations.to_csv(location_file)
-            results_file = self.results_directory / "cbd_results_b{}.csv".format(batch_no)
-            results.to_csv(results_file)
+            self.save_batch(batch_no, stations_used, locations, results)
 
         # create instructions
-        with open(self.results_directory / "README.txt", "w") as f:
+        with self.output(self.results_directory / "README.txt") as f:
             f.write(self.instructions.format(self.relative_path))
 
         return self.relative_path
 
-    def populate_locations(self, df: pd.DataFrame) -> pd.DataFrame:
-        df = df.reset_index()
-        df.rename(columns=location_columns, inplace=True,
-        errors='ignore')
-        df = df.loc[:, df.columns.isin(
-            [
-                "station_id",
-                "name",
-                "source"
-                "accessed_via",
-                "latitude",
-                "longitude",
-                "description",
-                "setting",
-                "horizontal_datum",
-                "horizontal_coordinate_collection_method",
-                "horizontal_coordinate_accuracy",      
-            ]
-        )]
-        return df
+    def populate_locations(self, df: pd.DataFrame) -> FormattedTable:
+        return location_spec.apply(df.reset_index())
 
-    def populate_field_results(self, df: pd.DataFrame) -> pd.DataFrame:
-        df["Time"] = pd.to_datetime(df["datetime"], utc=True).dt.strftime("%H:%M")
-        df["Date"] = pd.to_datetime(df["datetime"], utc=True).dt.strftime("%d/%m/%Y")
-        df.rename(columns=results_columns, inplace=True, errors="ignore")
-        required_results_columns = {
-            "Station", "Date", "Time", "Latitude", "Longitude", "Parameter",
-            "Value", "Unit", "CollectionMethod", "Instrument", "QualityCodes",
-            "Depth", "DepthUnit"
-        }
-        df = df.loc[:, df.columns.isin(required_results_columns)]
-        return df
+    def populate_field_results(self, df: pd.DataFrame) -> FormattedTable:
+        return results_spec.apply(df)
@@ -0,0 +1,86 @@
+import hashlib
+import json
+from pathlib import Path
+import pandas as pd
+from pipeline import checkpoint
+from pipeline import lookup
+
+HERE = Path(__file__).resolve().parent
+stations = HERE / "metadata" / "stations.csv"
+station_parameter_metadata = HERE / 'metadata' / 'station_parameter_metadata.csv'
+
+FINGERPRINT_FILE = "metadata_fingerprints.json"
+ARTIFACTS_FILE = "artifacts.json"
+
+
+def station_fingerprints(station_ids) -> dict:
+    """ Hash of each station's rows in stations.csv and station_parameter_metadata.csv """
+    stations_table = pd.read_csv(stations, index_col="station_id", dtype=str)
+    parameter_metadata = pd.read_csv(station_parameter_metadata, index_col=0, dtype=str)
+    parameter_metadata = parameter_metadata.sort_values(["station_id", "parameter"])
+    fingerprints = {}
+    for station_id in station_ids:
+        digest = hashlib.sha256()
+        digest.update(stations_table[stations_table.index == station_id].to_csv().encode())
+        rows = parameter_metadata[parameter_metadata["station_id"] == station_id]
+        digest.update(rows.to_csv(index=False).encode())
+        fingerprints[station_id] = digest.hexdigest()
+    return fingerprints
+
+
+def _read_json(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path: Path, content: dict):
+    with open(path, "w") as f:
+        json.dump(content, f, indent=2)
+
+
+def save_fingerprints(results_directory: Path, station_ids):
+    """ Records the metadata the stations' checkpoints were enriched with """
+    path = checkpoint.checkpoint_directory(results_directory) / FINGERPRINT_FILE
+    fingerprints = _read_json(path)
+    fingerprints.update(station_fingerprints(station_ids))
+    _write_json(path, fingerprints)
+
+
+def changed_stations(results_directory: Path, station_ids) -> list:
+    """ Stations whose metadata changed since their checkpoints were enriched """
+    path = checkpoint.checkpoint_directory(results_directory) / FINGERPRINT_FILE
+    recorded = _read_json(path)
+    current = station_fingerprints(station_ids)
+    return [i for i in station_ids if recorded.get(i) != current[i]]
+
+
+def load_artifacts(results_directory: Path) -> dict:
+    """ Output files of the run and the stations each one holds """
+    return _read_json(checkpoint.checkpoint_directory(results_directory) / ARTIFACTS_FILE)
+
+
+def save_artifacts(results_directory: Path, artifacts: dict):
+    _write_json(checkpoint.checkpoint_directory(results_directory) / ARTIFACTS_FILE, artifacts)
+
+
+def reenrich(data: pd.DataFrame, add_locations: bool) -> pd.DataFrame:
+    """ Replaces the metadata of standardized data with current metadata
+
+    Args:
+        data: standardized data with the provider's names in raw_parameter
+        add_locations: whether station locations came from stations.csv
+            rather than the provider
+    Returns:
+        data with the same columns, enriched from the current metadata files
+    """
+    if "raw_parameter" not in data.columns:
+        raise ValueError("Data has no raw_parameter column and must be collected again")
+    replaced = lookup.metadata_columns + ["raw_parameter"]
+    if add_locations:
+        replaced += lookup.location_columns
+    raw = data.drop(columns=replaced, errors="ignore")
+    raw["parameter"] = data["raw_parameter"].values
+    enriched = lookup.get_lookup().enrich(raw, add_locations=add_locations)
+    return enriched[data.columns]
@@ -1,21 +1,22 @@
-from readline import parse_and_bind
 import pandas as pd
 import requests
 from io import StringIO
 from tqdm import tqdm
-import time
-from datetime import date
 from pathlib import Path
 from pipeline import utils
+from pipeline import lookup
+from pipeline import qc
 
 HERE = Path(__file__).resolve().parent
 measurements_path = HERE / 'metadata' / 'ipacoa_platform_measurements.csv'
-stations = HERE / "metadata" / "stations.csv"
-station_parameter_metadata = HERE / 'metadata' / 'station_parameter_metadata.csv'
 
 class IPACOA():
 
-    def get_data(self, station_id, start_date, end_date):
+    def __init__(self):
+        # reuses connections from one request to the next
+        self.session = requests.Session()
+
+    def get_data(self, station_id, start_date, end_date, thin=None, parameters=None):
         """ Retrieves data for input station(s) and time range as DataFrame.
 
         Args:
@@ -24,18 +25,18 @@ class IPACOA():
             start_date (MM/DD/YYYY): Default None. If none supplied, 
                 starts with earliest available
             end_date(MM/DD/YYYY): Default None. If none, uses current date.
+            thin (int): Default None. If set, keep only one record per
+                `thin` minutes of each measurement.
+            parameters (list): Default None. If set, only measurements
+                normalized to these parameters are requested.
         Returns:
             pd.DataFrame: Contains information on all platforms listed in the input csv.
         """
         url = "http://www.ipacoa.org/ssa/get_platform_data.php"
         # Setting up parameters for GET request
-        platform_measurement = pd.read_csv(measurements_path)
-
-        # Filtering for measurements of interest
-        platform_measurement = platform_measurement[platform_measurement["process"]]
-        if station_id:
-            station_mask = platform_measurement["platform_label"] == station_id
-            platform_measurement = platform_measurement[station_mask]
+        platform_measurement = self.selected_measurements(station_id, parameters)
+        if platform_measurement.empty:
+            return pd.DataFrame()
         # Iterate over platform * measurement combinations
         dfs = []
         for i, (platform, measurement, process) in tqdm(
@@ -46,7 +47,7 @@ class IPACOA():
                 ("var_id", measurement),
                 ("data_type", "csv"),
             )
-            response = requests.get(url, params=params)
+            response = self.session.get(url, params=params)
 
             # Raise error if request is not successful
             response.raise_for_status()
@@ -66,6 +67,7 @@ class IPACOA():
                 inplace=True,
             )
             df["depth"] = df["depth"].str.strip(" ft").astype(int)
+            df = utils.thin_data(df, thin, by=["depth"])
             dfs.append(df)
 
         all_measures = pd.concat(dfs, ignore_index=True)
@@ -83,19 +85,31 @@ class IPACOA():
             ["station_id", "datetime", "parameter", "value", "depth", "depth_unit"]
         ]
 
-        # add station metadata (location)        
-        stations_df = pd.read_csv(stations, index_col="station_id")
-        stations_df = stations_df[["latitude", "longitude"]]
-        long_df = all_measures.join(stations_df, on="station_id", how="left")
-
-        # map parameter names to device names, normalized names, and units
-        parameter_metadata = pd.read_csv(station_parameter_metadata, index_col=["station_id", "parameter"])
-        # if pd.merge(left=long_df, right=parameter_metadata, on=["station_id", "parameter"], indicator=True)
-        
-        long_df = long_df.join(parameter_metadata, on=["station_id", "parameter"], how='left')
-        long_df["parameter"] = long_df["parameter"].map(utils.parameter_dict)
+        # add station location, device names, normalized names, and units
+        long_df = lookup.get_lookup().enrich(all_measures, add_locations=True)
 
-        # ipacoa has no quality flags
+        # ipacoa has no quality flags, so they come from our own tests,
+        # which only flag rows and never remove them
         long_df["quality"] = None
+        long_df["quality"] = qc.fill_flags(long_df)
 
         return long_df
+
+    def selected_measurements(self, station_id=None, parameters=None) -> pd.DataFrame:
+        """ Rows of ipacoa_platform_measurements.csv to request
+
+        Measurements with process TRUE, of station_id if given, and
+        normalized to one of parameters if given.
+        """
+        platform_measurement = pd.read_csv(measurements_path)
+        selected = platform_measurement["process"]
+        if station_id:
+            selected = selected & (platform_measurement["platform_label"] == station_id)
+        if parameters is not None:
+            raw_names = utils.raw_parameter_names(parameters)
+            selected = selected & platform_measurement["measurement_label"].isin(raw_names)
+        return platform_measurement[selected]
+
+    def request_count(self, station_id, parameters=None):
+        """ Number of requests get_data makes for a station """
+        return len(self.selected_measurements(station_id, parameters))
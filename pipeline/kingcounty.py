@@ -1,19 +1,15 @@
+import codecs
 import pandas as pd
 import requests
-from io import StringIO
-from tqdm import tqdm
 from pathlib import Path
 import json
-from datetime import datetime, date, timedelta
-import time
-import re
 from pipeline import utils
+from pipeline import lookup
+from pipeline import qc
 
 
 HERE = Path(__file__).resolve().parent
 KEYS = HERE / "metadata" / 'king-county-keys.json'
-station_parameter_metadata = HERE / 'metadata' / 'station_parameter_metadata.csv'
-stations = HERE / "metadata" / "stations.csv"
 
 COLS = [
     "station_id",
@@ -38,16 +34,130 @@ COLS = [
     "Depth_m",
 ]
 
+# columns of COLS holding text, all others are numeric
+text_columns = ["station_id", "Date"]
+
+# raw parameter name of each value column of COLS, and its quality column
+value_columns = {
+    "Air_Pressure_inHg": ("Air_Pressure", "Qual_Air_Pressure"),
+    "Air_Temperature_F": ("Air_Temperature", "Qual_Air_Temperature"),
+    "Dissolved_Oxygen_%Sat": ("Dissolved_Oxygen_Sat", "Qual_DO"),
+    "Dissolved_Oxygen_mg/L": ("Dissolved_Oxygen", "Qual_DO"),
+    "Water_Temperature_degC": ("Water_Temperature", "Qual_Water_Temperature"),
+    "SeaFET_Temperature_degC": ("SeaFET_Temperature", "Qual_SeaFET_Temperature"),
+    "Sonde_pH": ("Sonde_pH", "Qual_Sonde_pH"),
+    "SeaFET_External_pH_recalc_w_salinity": (
+        "SeaFET_External_pH_recalc_w_salinity", "Qual_SeaFET_External_pH_recalc_w_salinity"
+    ),
+    "Salinity_PSU": ("Salinity", "Qual_Salinity"),
+}
+
+# Data.aspx returns an html page, then this marker, then the tab separated data
+END_MARKER = "***END***"
+
+
+class TailReader():
+    """ File-like text stream of a response body after END_MARKER
+
+    The body is read in chunks as pandas asks for it, so neither the
+    html before the marker nor the full data section are held in memory.
+    """
+
+    def __init__(self, response: requests.Response, chunk_size: int = 1 << 16):
+        self.chunks = response.iter_content(chunk_size=chunk_size)
+        self.decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+        self.buffer = self.skip_to_marker()
+
+    def skip_to_marker(self) -> str:
+        """ Discards the body up to and including END_MARKER """
+        carry = ""
+        for chunk in self.chunks:
+            text = carry + self.decoder.decode(chunk)
+            found = text.find(END_MARKER)
+            if found >= 0:
+                return text[found + len(END_MARKER):]
+            # the marker may be split across chunks
+            carry = text[-len(END_MARKER):]
+        raise ValueError("King County response does not contain {}".format(END_MARKER))
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.buffer += self.decoder.decode(b"", final=True)
+                break
+            self.buffer += self.decoder.decode(chunk)
+        if size < 0:
+            size = len(self.buffer)
+        text, self.buffer = self.buffer[:size], self.buffer[size:]
+        return text
+
+    def __iter__(self):
+        # pandas only accepts objects with read and __iter__ as file handles
+        return self
+
+
+# Seattle Aquarium columns carry one of these depth prefixes
+depth_prefixes = ["1_", "2_"]
+
+
+def base_column(column: str) -> str:
+    """ Name of a Data.aspx column in COLS, without its depth prefix """
+    for prefix in depth_prefixes:
+        column = column.replace(prefix, "")
+    return column
+
+
+def is_used_column(column: str, columns: list = COLS) -> bool:
+    """ Whether a Data.aspx column is in columns """
+    return base_column(column) in columns
+
+
+def column_dtypes(columns: list = COLS) -> dict:
+    """ dtype of every Data.aspx column is_used_column accepts for columns, prefixed or not
+
+    Columns missing from the response are ignored by read_csv.
+    """
+    dtypes = {}
+    for column in columns:
+        if column in text_columns:
+            continue
+        for name in [column] + [prefix + column for prefix in depth_prefixes]:
+            dtypes[name] = "float64"
+    return dtypes
+
+
+def selected_columns(parameters=None) -> list:
+    """ Columns of COLS needed for normalized parameters, all of them if None """
+    if parameters is None:
+        return COLS
+    raw_names = utils.raw_parameter_names(parameters)
+    selected = set()
+    for column, (raw_name, quality_column) in value_columns.items():
+        if raw_name in raw_names:
+            selected.update([column, quality_column])
+    # station, time and depth columns are always needed
+    common = [column for column in COLS if column not in value_columns and not column.startswith("Qual_")]
+    return [column for column in COLS if column in selected or column in common]
+
+
 class KingCounty():
     time_format = "%m/%d/%Y"
 
-    def get_data(self, station_id, start_date, end_date):
+    def __init__(self):
+        # reuses connections from one station to the next
+        self.session = requests.Session()
+
+    def get_data(self, station_id, start_date, end_date, thin=None, parameters=None):
         """ Retrieves data for input station(s) and time range as DataFrame.
 
         Args:
             station_id (str): id for station of interest
             start_date (datetime): earliest time from which to collect data
             end_date(datetime): latest time from which to collect data
+            thin (int): If set, keep only one record per `thin` minutes
+            parameters (list): If set, only columns of these normalized
+                parameters are parsed. Data.aspx always sends every column.
         Returns:
             pd.DataFrame: Contains information on all platforms listed in the input json.
         """
@@ -63,9 +173,16 @@ class KingCounty():
         data = params[station_id]
         data[start_date_key] = start_date.strftime(self.time_format)
         data[end_date_key] = end_date.strftime(self.time_format)
-        response = requests.post(url, data=data)
-        tsv = response.text.split("***END***")[1]
-        station_data = pd.read_csv(StringIO(tsv), sep="\t", low_memory=False)
+        columns = selected_columns(parameters)
+        with self.session.post(url, data=data, stream=True) as response:
+            response.raise_for_status()
+            station_data = pd.read_csv(
+                TailReader(response),
+                sep="\t",
+                usecols=lambda column: is_used_column(column, columns),
+                dtype=column_dtypes(columns),
+            )
+        station_data = utils.thin_data(station_data, thin, time_column="Date")
         station_data["station_id"] = station_id
         station_data.dropna(how="all", axis=1, inplace=True)
 
@@ -83,17 +200,22 @@ class KingCounty():
         long_df = self.standardize_data(station_data)
         return long_df
 
+    def request_count(self, station_id, parameters=None):
+        """ Number of requests get_data makes for a station """
+        return 1
+
     def filter_poor_data(self, dataset: pd.DataFrame):
         """Remove data with low or suspect quality"""
-        dataset["suspect"] = (dataset["quality"] // 100 >= 3)
+        dataset["suspect"] = (dataset["quality"] >= qc.SUSPECT)
         return dataset[~dataset["suspect"]]
 
     def standardize_data(self, dataset: pd.DataFrame):
         """ Reformat data to match a single standard format """
         dataset = dataset.filter(items=COLS)
         # Dissolved Oxygen measures share on qc column 'DO'
-        dataset["Qual_Dissolved_Oxygen_Sat"] = dataset["Qual_DO"]
-        dataset["Qual_Dissolved_Oxygen"] = dataset.pop("Qual_DO")
+        if "Qual_DO" in dataset.columns:
+            dataset["Qual_Dissolved_Oxygen_Sat"] = dataset["Qual_DO"]
+            dataset["Qual_Dissolved_Oxygen"] = dataset.pop("Qual_DO")
         # restructure columns for wide_to_long
         dataset.rename(columns=utils.positional_column_mapping, inplace=True)
         # kingcounty cols are Var_Name_Unit, Qual_Var_Name
@@ -115,14 +237,13 @@ class KingCounty():
         long_df.dropna(subset=["value"], inplace=True)
         # add final metadata
         long_df["depth_unit"] = "m"
-        stations_df = pd.read_csv(stations, index_col="station_id")
-        stations_df = stations_df[["latitude", "longitude"]]
-        long_df = long_df.join(stations_df, on="station_id", how="left")
-
         # map parameter names to device names, normalized names, and units
-        parameter_metadata = pd.read_csv(station_parameter_metadata, index_col=["station_id", "parameter"])
-        long_df = long_df.join(parameter_metadata, on=["station_id", "parameter"], how='left')
-        long_df["parameter"] = long_df["parameter"].map(utils.parameter_dict)
+        long_df = lookup.get_lookup().enrich(long_df, add_locations=True)
+        # king county flags are QARTOD flags times 100
+        long_df["quality"] = long_df["quality"] // 100
+        # only the provider's own flags remove data, unflagged rows are
+        # then flagged by our tests
         long_df = self.filter_poor_data(long_df)
+        long_df["quality"] = qc.fill_flags(long_df)
 
         return long_df
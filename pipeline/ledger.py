@@ -0,0 +1,141 @@
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+HERE = Path(__file__).resolve().parent
+# output/ is mounted by run_tool.sh, so the ledger survives container restarts
+LEDGER = HERE.parent / "output" / "fetch_ledger.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fetches (
+    id INTEGER PRIMARY KEY,
+    provider TEXT NOT NULL,
+    station_id TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    days REAL NOT NULL,
+    thin INTEGER,
+    requests INTEGER,
+    rows INTEGER,
+    memory_bytes INTEGER,
+    seconds REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    fetched_at TEXT NOT NULL
+)
+"""
+
+time_format = "%Y-%m-%dT%H:%M:%S"
+
+
+class FetchLedger():
+    """ Log of every collector call, used to plan future runs """
+
+    def __init__(self, path: Path = LEDGER):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.execute(SCHEMA)
+
+    def record(
+        self,
+        provider: str,
+        station_id: str,
+        start_time: datetime,
+        end_time: datetime,
+        seconds: float,
+        outcome: str,
+        data: pd.DataFrame = None,
+        thin: int = None,
+        requests: int = None,
+    ):
+        """ Logs one collector call
+
+        Args:
+            provider: provider column of stations.csv
+            station_id: station that was collected
+            start_time: start of the requested window
+            end_time: end of the requested window
+            seconds: wall time of the call
+            outcome: 'ok', or the name of the error raised
+            data: standardized data returned, if any. Its in-memory size is
+                logged, not the size of the download.
+            thin: thinning interval used in minutes
+            requests: number of requests the collector made
+        """
+        rows = None if data is None else len(data)
+        memory_bytes = None if data is None else int(data.memory_usage(deep=True).sum())
+        with closing(sqlite3.connect(self.path)) as connection, connection:
+            connection.execute(
+                "INSERT INTO fetches (provider, station_id, start, end, days, thin,"
+                " requests, rows, memory_bytes, seconds, outcome, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    provider, station_id,
+                    start_time.strftime(time_format), end_time.strftime(time_format),
+                    _days(start_time, end_time), thin, requests, rows, memory_bytes,
+                    seconds, outcome, datetime.now().strftime(time_format),
+                )
+            )
+
+    def history(self) -> pd.DataFrame:
+        """ Every logged collector call """
+        with closing(sqlite3.connect(self.path)) as connection:
+            return pd.read_sql_query("SELECT * FROM fetches", connection)
+
+    def estimate(
+        self,
+        provider: str,
+        station_id: str,
+        start_time: datetime,
+        end_time: datetime,
+        thin: int = None,
+        history: pd.DataFrame = None,
+    ) -> dict:
+        """ Estimates the cost of collecting a station for a time window
+
+        Rows and in-memory size of the standardized data scale with the
+        window length. Wall time is a least squares fit of seconds =
+        overhead + rate * days when past windows differ in length, else
+        proportional to days. Uses the station's own successful calls,
+        falling back to the provider's, and only calls with the same thin
+        interval.
+
+        Returns:
+            dict with estimated rows, memory_bytes and seconds, the number of
+            past calls the estimate is based on, and what they were
+            ('station', 'provider' or None if there is no history).
+        """
+        if history is None:
+            history = self.history()
+        days = _days(start_time, end_time)
+        history = history[(history["outcome"] == "ok") & (history["days"] > 0)]
+        same_thin = history["thin"].isna() if thin is None else history["thin"] == thin
+        history = history[same_thin]
+        for basis, rows in [
+            ("station", history[history["station_id"] == station_id]),
+            ("provider", history[history["provider"] == provider]),
+        ]:
+            if not rows.empty:
+                break
+        else:
+            return {"rows": None, "memory_bytes": None, "seconds": None, "based_on": 0, "basis": None}
+        total_days = rows["days"].sum()
+        if rows["days"].nunique() > 1:
+            rate, overhead = np.polyfit(rows["days"], rows["seconds"], 1)
+            seconds = max(overhead + rate * days, 0)
+        else:
+            seconds = rows["seconds"].sum() / total_days * days
+        return {
+            "rows": int(rows["rows"].sum() / total_days * days),
+            "memory_bytes": int(rows["memory_bytes"].sum() / total_days * days),
+            "seconds": float(seconds),
+            "based_on": len(rows),
+            "basis": basis,
+        }
+
+
+def _days(start_time: datetime, end_time: datetime) -> float:
+    return (end_time - start_time).total_seconds() / 86400
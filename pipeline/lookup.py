@@ -0,0 +1,153 @@
+import logging
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pipeline import utils
+
+HERE = Path(__file__).resolve().parent
+station_parameter_metadata = HERE / 'metadata' / 'station_parameter_metadata.csv'
+stations = HERE / "metadata" / "stations.csv"
+
+# columns of station_parameter_metadata.csv added to every row
+metadata_columns = ["unit", "instrument", "method", "equipment_id"]
+location_columns = ["latitude", "longitude"]
+
+
+def codes(values: pd.Series, index: pd.Index) -> np.ndarray:
+    """ Position of each value in index
+
+    Values are hashed once, only the distinct values are looked up.
+
+    Returns:
+        position in index, len(index) for values not in index and
+        len(index) + 1 for missing values
+    """
+    value_codes, uniques = pd.factorize(values)
+    positions = index.get_indexer(uniques)
+    positions[positions < 0] = len(index)
+    return np.append(positions, len(index) + 1)[value_codes]
+
+
+class AgencyNames():
+    """ Compiled mapping from standardized parameter and unit names to an agency's names """
+
+    def __init__(self, parameters: dict, units: dict):
+        self.parameters = self.compile(parameters)
+        self.units = self.compile(units)
+
+    @staticmethod
+    def compile(mapping: dict):
+        keys = [k for k in mapping if not (isinstance(k, float) and np.isnan(k))]
+        missing = [v for k, v in mapping.items() if k not in keys]
+        values = np.array([mapping[k] for k in keys] + [np.nan] + (missing or [np.nan]), dtype=object)
+        return pd.Index(keys), values
+
+    def parameter(self, parameters: pd.Series) -> np.ndarray:
+        """ Agency parameter names, NaN where the agency has none """
+        index, values = self.parameters
+        return values[codes(parameters, index)]
+
+    def unit(self, units: pd.Series) -> np.ndarray:
+        """ Agency unit names, NaN where the agency has none """
+        index, values = self.units
+        return values[codes(units, index)]
+
+
+class ParameterLookup():
+    """ Table of (station, raw parameter) -> parameter metadata
+
+    Compiled from station_parameter_metadata.csv, stations.csv and
+    utils.parameter_dict into flat arrays, so enriching collected data is
+    an array gather on integer keys instead of joins and string maps.
+    """
+
+    def __init__(self, parameter_metadata: pd.DataFrame, stations_table: pd.DataFrame):
+        duplicated = parameter_metadata.duplicated(["station_id", "parameter"], keep="last")
+        if duplicated.any():
+            logging.warning(
+                f"Duplicate station and parameter rows in station_parameter_metadata.csv, keeping the last: "
+                f"{list(parameter_metadata.loc[duplicated, 'parameter'])}"
+            )
+            parameter_metadata = parameter_metadata[~duplicated]
+        self.stations = pd.Index(pd.unique(np.concatenate([
+            stations_table.index.values, parameter_metadata["station_id"].values
+        ])))
+        self.parameters = pd.Index(pd.unique(np.concatenate([
+            parameter_metadata["parameter"].values, np.array(list(utils.parameter_dict), dtype=object)
+        ])))
+        # one slot past the end of each array for unknown and missing keys
+        n_keys = len(self.stations) * len(self.parameters) + 2
+        keys = self.keys(parameter_metadata["station_id"], parameter_metadata["parameter"])
+        self.metadata = {}
+        for column in metadata_columns:
+            dtype = parameter_metadata[column].dtype
+            values = np.full(n_keys, np.nan, dtype=dtype if dtype.kind == "f" else object)
+            values[keys] = parameter_metadata[column].values
+            self.metadata[column] = values
+        self.normalized = np.append(
+            self.parameters.map(utils.parameter_dict).values.astype(object), [np.nan, np.nan]
+        )
+        self.locations = {}
+        for column in location_columns:
+            values = np.full(len(self.stations) + 2, np.nan)
+            values[self.stations.get_indexer(stations_table.index)] = stations_table[column].values
+            self.locations[column] = values
+        self.agencies = {}
+        # read by formatters for station columns of agency tables
+        self.stations_table = stations_table
+
+    def keys(self, station_ids: pd.Series, parameters: pd.Series) -> np.ndarray:
+        """ Integer key of each (station, raw parameter) pair """
+        station_codes = codes(station_ids, self.stations)
+        parameter_codes = codes(parameters, self.parameters)
+        unknown = (station_codes >= len(self.stations)) | (parameter_codes >= len(self.parameters))
+        keys = station_codes * len(self.parameters) + parameter_codes
+        return np.where(unknown, len(self.stations) * len(self.parameters), keys)
+
+    def enrich(self, long_df: pd.DataFrame, add_locations: bool = False) -> pd.DataFrame:
+        """ Adds parameter metadata and normalizes parameter names
+
+        Args:
+            long_df: collected data with station_id and raw parameter names
+            add_locations: also add station latitude and longitude
+        Returns:
+            copy of long_df with metadata_columns added, parameter names
+            normalized with utils.parameter_dict and the provider's names
+            kept in raw_parameter
+        """
+        enriched = {}
+        if add_locations:
+            station_codes = codes(long_df["station_id"], self.stations)
+            for column in location_columns:
+                enriched[column] = self.locations[column][station_codes]
+        keys = self.keys(long_df["station_id"], long_df["parameter"])
+        for column in metadata_columns:
+            enriched[column] = self.metadata[column][keys]
+        enriched["raw_parameter"] = long_df["parameter"].values
+        enriched["parameter"] = self.normalized[codes(long_df["parameter"], self.parameters)]
+        return long_df.assign(**enriched)
+
+    def agency(self, name: str, parameters: dict, units: dict) -> AgencyNames:
+        """ Agency name mappings, compiled on first use """
+        if name not in self.agencies:
+            self.agencies[name] = AgencyNames(parameters, units)
+        return self.agencies[name]
+
+
+@lru_cache(maxsize=1)
+def _compile(metadata_version: tuple) -> ParameterLookup:
+    parameter_metadata = pd.read_csv(station_parameter_metadata, index_col=0)
+    stations_table = pd.read_csv(stations, index_col="station_id")
+    return ParameterLookup(parameter_metadata, stations_table)
+
+
+def get_lookup() -> ParameterLookup:
+    """ Lookup compiled from the current metadata files
+
+    Compiled once per process and again only when a metadata file changes.
+    """
+    metadata_version = tuple(
+        path.stat().st_mtime_ns for path in [station_parameter_metadata, stations]
+    )
+    return _compile(metadata_version)
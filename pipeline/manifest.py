@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+MANIFEST_FILE = "manifest.json"
+
+
+# content of an output file held in memory before it goes to a temporary file
+BUFFER_BYTES = 128 * 2**20
+
+
+class HashingWriter():
+    """ File that hashes the bytes of its content as they are written
+
+    Takes text or bytes. Accepted by DataFrame.to_csv and
+    csvencode.write_csv as a file handle, so output files are hashed while
+    they are streamed out instead of read back afterwards. Content is
+    held in memory until it passes buffer_bytes, and only then written to
+    path, so content that turns out unchanged never touches disk. If
+    compress is set the file is gzipped, and the hash and size are of the
+    content before compression.
+    """
+
+    def __init__(self, path: Path, encoding: str = "utf-8", compress: bool = False,
+                 buffer_bytes: int = BUFFER_BYTES):
+        self.path = Path(path)
+        self.compress = compress
+        self.buffer_bytes = buffer_bytes
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.encoding = encoding
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, content) -> int:
+        if isinstance(content, str):
+            content = content.encode(self.encoding)
+        self.digest.update(content)
+        self.size += len(content)
+        if self.file is None and self.size > self.buffer_bytes:
+            self.spill()
+        if self.file is None:
+            return self.buffer.write(content)
+        return self.file.write(content)
+
+    def spill(self):
+        """ Moves the buffered content to path, and writes there from now on """
+        # no timestamp in the gzip header, so equal content gives equal files
+        self.file = gzip.GzipFile(self.path, "wb", mtime=0) if self.compress else open(self.path, "wb")
+        self.file.write(self.buffer.getbuffer())
+        self.buffer = io.BytesIO()
+
+    @property
+    def spilled(self) -> bool:
+        return self.file is not None
+
+    def __iter__(self):
+        # pandas only accepts objects with write and __iter__ as file handles
+        return self
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def entry(self) -> dict:
+        """ Manifest entry of what was written """
+        return {"sha256": self.digest.hexdigest(), "bytes": self.size}
+
+
+@contextmanager
+def write_if_changed(path: Path, manifest: dict, key: str, compress: bool = False):
+    """ Writes a file only if its content differs from its manifest entry
+
+    Content is hashed while it is held in memory, or written to a
+    temporary file next to path once it passes BUFFER_BYTES. If path
+    exists and the hash matches manifest[key], nothing is written and
+    path is left untouched, otherwise the content replaces path.
+
+    Yields:
+        HashingWriter to write the content to, gzipped if compress is
+        set. Its `changed` attribute is set once the block exits.
+    """
+    path = Path(path)
+    partial = path.with_name(path.name + ".partial")
+    writer = HashingWriter(partial, compress=compress, buffer_bytes=BUFFER_BYTES)
+    try:
+        yield writer
+    except BaseException:
+        writer.close()
+        if writer.spilled:
+            partial.unlink()
+        raise
+    entry = writer.entry()
+    writer.changed = not (path.exists() and manifest.get(key) == entry)
+    if writer.changed and not writer.spilled:
+        writer.spill()
+    writer.close()
+    if writer.changed:
+        os.replace(partial, path)
+        manifest[key] = entry
+    elif writer.spilled:
+        partial.unlink()
+
+
+def load_manifest(results_directory: Path) -> dict:
+    """ Relative path of each output file -> hash and size of its content """
+    path = Path(results_directory) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(results_directory: Path, manifest: dict):
+    """ Saves the manifest with the output files, sorted by path """
+    with open(Path(results_directory) / MANIFEST_FILE, "w") as f:
+        json.dump(dict(sorted(manifest.items())), f, indent=2)
@@ -1,40 +1,65 @@
 from xml.sax import SAXParseException
 from suds.client import Client
-from datetime import datetime, timedelta
-from urllib.error import HTTPError
 import pandas as pd
-import numpy as np
-import erddapy
-import requests
 import logging
 from pathlib import Path
 from pipeline import utils
+from pipeline import lookup
+from pipeline import qc
 from bs4 import BeautifulSoup, NavigableString
 
 
 index_columns = ["datetime", "station_id", "depth"]
 
 HERE = Path(__file__).resolve().parent
-station_parameter_metadata = HERE / 'metadata' / 'station_parameter_metadata.csv'
-stations = HERE / "metadata" / "stations.csv"
+
+# CDMO parameter code of each raw parameter name, which is the lowercase tag in responses
+cdmo_parameters = {
+    "temp": "Temp",
+    "sal": "Sal",
+    "spcond": "SpCond",
+    "do_pct": "DO_pct",
+    "do_mgl": "DO_mgl",
+    "ph": "pH",
+    "turb": "Turb",
+}
 
 class NERRS():
 
     api_endpoint = "http://cdmo.baruch.sc.edu/webservices2/requests.cfc?wsdl"
     time_format = "%Y-%m-%d"
 
+    def __init__(self):
+        self.soap_client = None
+
+    def client(self) -> Client:
+        """ SOAP client of the CDMO web services, built from the WSDL once """
+        if self.soap_client is None:
+            self.soap_client = Client(self.api_endpoint, timeout=90, retxml=True)
+        return self.soap_client
+
     def get_data(
         self,
         dataset_id,
         start_date,
-        end_date
+        end_date,
+        thin=None,
+        parameters=None
     ):
-        """ Retrieves data from input server and time range as dataframe """
+        """ Retrieves data from input server and time range as dataframe
+
+        If thin is set, only one record per `thin` minutes is kept. If
+        parameters is set, only those normalized parameters are requested.
+        """
+        param_list = self.param_list(parameters)
+        if not param_list:
+            logging.info(f"{dataset_id} has none of the requested parameters")
+            return pd.DataFrame()
         start_date = start_date.strftime(self.time_format)
         end_date = end_date.strftime(self.time_format)
-        soapClient = Client(self.api_endpoint, timeout=90, retxml=True)
+        soapClient = self.client()
         try:
-            raw_data = soapClient.service.exportAllParamsDateRangeXMLNew(dataset_id, start_date, end_date, '*')
+            raw_data = soapClient.service.exportAllParamsDateRangeXMLNew(dataset_id, start_date, end_date, param_list)
         except SAXParseException as e:
             logging.warning(f"{dataset_id} raises error, may not have data for period.")
             return pd.DataFrame()
@@ -54,11 +79,23 @@ class NERRS():
                 " with http://cdmo.baruch.sc.edu/web-services-request/"
             )
             return pd.DataFrame()
+        dataset_df = utils.thin_data(dataset_df, thin, time_column="utcstamp", by=["level"])
         dataset_df["station_id"] = dataset_id
         long_df = self.standardize_data(dataset_df)
         return long_df
 
 
+    def param_list(self, parameters=None) -> str:
+        """ CDMO param argument for normalized parameters, '*' for all """
+        if parameters is None:
+            return "*"
+        raw_names = utils.raw_parameter_names(parameters)
+        return ",".join(code for name, code in cdmo_parameters.items() if name in raw_names)
+
+    def request_count(self, station_id, parameters=None):
+        """ Number of requests get_data makes for a station """
+        return int(bool(self.param_list(parameters)))
+
     def standardize_data(self, dataset: pd.DataFrame):
         """ Reformat data to match single standard format """
         desired_columns = [
@@ -92,11 +129,7 @@ class NERRS():
         long_df.dropna(subset=['value'], inplace=True)
         long_df.rename(columns={"f": "quality"}, inplace=True)
         long_df.reset_index(inplace=True)
-        parameter_metadata = pd.read_csv(station_parameter_metadata, index_col=["station_id", "parameter"])
-        long_df = long_df.join(parameter_metadata, on=["station_id", "parameter"], how='left')
-        stations_metadata = pd.read_csv(stations, index_col="station_id")
-        stations_metadata = stations_metadata[["latitude", "longitude"]]
-        long_df = long_df.join(stations_metadata, on="station_id", how="left")
-        long_df['parameter'] = long_df["parameter"].map(utils.parameter_dict)
+        long_df = lookup.get_lookup().enrich(long_df, add_locations=True)
         long_df["depth_unit"] = "m"
+        long_df["quality"] = qc.decode_nerrs_flags(long_df["quality"])
         return long_df
\ No newline at end of file
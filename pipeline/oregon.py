@@ -1,11 +1,15 @@
 from .formatter import Formatter
+from .csvencode import write_csv
+from . import lookup
+from . import spill
+from .spec import FormattedTable, Mapped, TableSpec, converted_values, formatted_times, renamed
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import pytemp
+from pytemp import pytemp
 
-HERE = Path(__file__).resolve().parent
-stations = HERE / "metadata" / "stations.csv"
+# rows formatted and appended to the results file at a time
+MAX_BATCH_SIZE = 150000
 
 location_columns = {
     "station_id": "Monitoring Location ID",
@@ -56,6 +60,59 @@ qa_dict = {
     ## ?? : "Validated" # reported result has been verified and reviewed
 }
 
+location_template = [
+    "Monitoring Location ID",
+    "Monitoring Location Name",
+    "Monitoring Location Type",
+    "Monitoring Location Latitude",
+    "Monitoring Location Longitude",
+    "Horizontal Datum",
+    "Coordinate Collection Method",
+    "Tribal Land Indicator",
+]
+
+results_template = [
+    "Monitoring Location ID",
+    "Activity Start Date",
+    "Activity Start Time",
+    "Activity Time Zone",
+    "Equipment ID",
+    "Characteristic Name",
+    "Result Value",
+    "Result Unit",
+    "Result Status ID",
+]
+
+# unit -> conversion of values to the unit in unit_dict
+conversions = {
+    "µmol/kg": lambda values: values * 1000,
+    "F": lambda values: values.apply(lambda x: pytemp(x, "f", "c")),
+    "inHg": lambda values: values / 0.0393701,
+    "mS/cm": lambda values: values * 1000,
+}
+
+
+def agency_names():
+    return lookup.get_lookup().agency("oregon", parameter_dict, unit_dict)
+
+
+location_spec = TableSpec({
+    **renamed(location_columns),
+    "Coordinate Collection Method": Mapped(
+        "horizontal_coordinate_collection", lambda values: np.where(values, values, "Unknown")
+    ),
+}, location_template)
+
+results_spec = TableSpec({
+    **renamed(results_columns),
+    "Activity Start Date": formatted_times("datetime", "%Y/%m/%d", "D"),
+    "Activity Start Time": formatted_times("datetime", "%H:%M", "min"),
+    "Result Value": converted_values(conversions),
+    "Result Unit": Mapped("unit", lambda units: agency_names().unit(units)),
+    "Characteristic Name": Mapped("parameter", lambda parameters: agency_names().parameter(parameters)),
+    "Result Status ID": Mapped("quality", qa_dict),
+}, results_template)
+
 class Oregon(Formatter):
     state = "Oregon"
     instructions = """Oregon Submission Guidelines
@@ -70,25 +127,32 @@ class Oregon(Formatter):
     """
 
 
-    def format_data_for_agency(self, data: pd.DataFrame) -> Path:
-        stations_table = pd.read_csv(stations, index_col="station_id")
-        stations_used = data["station_id"].unique()
+    def format_data_for_agency(self, data: pd.DataFrame, only_stations: list=None) -> Path:
+        # every station is in the same files, so they are always rewritten
+        stations_table = lookup.get_lookup().stations_table
+        stations_used = spill.station_ids(data)
         stations_subset = stations_table[stations_table.index.isin(stations_used)]
         locations = self.populate_locations(stations_subset)
-        results = self.populate_field_results(data)
         location_file = self.results_directory / "cbd_locations.csv"
-        locations.to_csv(location_file)
+        with self.output(location_file) as f:
+            write_csv(locations, f)
         results_file = self.results_directory / "cbd_results.csv"
-        results.to_csv(results_file)
+        # sorted rows are appended in batches, so data never needs to fit in memory
+        with self.output(results_file) as f:
+            for batch_no, batch in enumerate(self.sorted_batches(data, MAX_BATCH_SIZE)):
+                results = self.populate_field_results(batch)
+                write_csv(results, f, header=batch_no == 0)
+        self.track(location_file, stations_used)
+        self.track(results_file, stations_used)
 
         # create instructions
-        with open(self.results_directory / "README.txt", "w") as f:
+        with self.output(self.results_directory / "README.txt") as f:
             f.write(self.instructions.format(self.relative_path))
 
         return self.results_directory
 
 
-    def populate_locations(self, df: pd.DataFrame):
+    def populate_locations(self, df: pd.DataFrame) -> FormattedTable:
         """ Processes Oregon data to match DEQ template restrictions.
 
         Args:
@@ -96,67 +160,17 @@ class Oregon(Formatter):
                 and 'stations' tables for Oregon stations. 
             
         Returns:
-            locations_dataframe
+            locations table
         """
-        df = df.reset_index()
-        df.rename(columns=location_columns, inplace=True, errors="ignore")
-        df["Coordinate Collection Method"] = np.where(df["Coordinate Collection Method"], df["Coordinate Collection Method"], "Unknown")
-        df = df.loc[:, df.columns.isin(
-            [
-                "Monitoring Location ID",
-                "Monitoring Location Name",
-                "Monitoring Location Type",
-                "Monitoring Location Latitude",
-                "Monitoring Location Longitude",
-                "Horizontal Datum",
-                "Coordinate Collection Method",
-                "Tribal Land Indicator",
-            ]
-        )]
-
-        return df
-
-    def populate_field_results(self, df):
+        return location_spec.apply(df.reset_index())
+
+    def populate_field_results(self, df: pd.DataFrame) -> FormattedTable:
         """ Processes Oregon data to match DEQ template restrictions.
 
         Args:
             df (DataFrame): Contains the merged columns of 'measurements' 
                 and 'stations' tables for Oregon stations.             
         Returns:
-            field_results dataframe
+            field results table, df is left unchanged
         """
-        stations_table = pd.read_csv(stations)
-        df["Activity Start Date"] = pd.to_datetime(df["datetime"], utc=True).dt.strftime("%Y/%m/%d") 
-        df["Activity Start Time"] = pd.to_datetime(df["datetime"], utc=True).dt.strftime("%H:%M") 
-
-        molg = df.loc[df.unit == "µmol/kg", "value"] * 1000
-        df.loc[df.unit == "µmol/kg", "value"] = molg
-
-        deg_c = df.loc[df.unit == "F", "value"].apply(lambda x: pytemp(x, "f", "c"))
-        df.loc[df.unit == "F", "value"] = deg_c
-
-        mmhg = df.loc[df.unit == "inHg", "value"] / 0.0393701
-        df.loc[df.unit == "inHg", "value"] = mmhg
-
-        uScm = df.loc[df.unit == "mS/cm", "value"] * 1000
-        df.loc[df.unit == "mS/cm", "value"] = uScm
-
-        df["unit"] = df["unit"].map(unit_dict)
-        df["parameter"] = df["parameter"].map(parameter_dict)
-        df["quality"] = df["quality"].map(qa_dict)
-        df.sort_values(["station_id", "parameter", "datetime"])
-        df.rename(columns=results_columns, inplace=True, errors="ignore")
-        df = df.loc[:, df.columns.isin(
-            [
-                "Monitoring Location ID",
-                "Activity Start Date",
-                "Activity Start Time",
-                "Activity Time Zone",
-                "Equipment ID",
-                "Characteristic Name",
-                "Result Value",
-                "Result Unit",
-                "Result Status ID",
-            ]
-        )]
-        return df
+        return results_spec.apply(df)
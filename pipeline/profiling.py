@@ -0,0 +1,140 @@
+import logging
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pipeline import qc
+from pipeline import spill
+
+PROFILE_FILE = "profile.csv"
+
+# a step longer than this between consecutive samples of a series is a gap
+GAP_HOURS = 24
+
+# counted quality flags, other flags are counted together
+flag_columns = {
+    qc.PASS: "flag_pass",
+    qc.NOT_EVALUATED: "flag_not_evaluated",
+    qc.SUSPECT: "flag_suspect",
+    qc.FAIL: "flag_fail",
+    qc.MISSING: "flag_missing",
+}
+
+profile_columns = [
+    "station_id", "parameter", "rows", "values", "depths", "min", "mean", "max",
+    "first", "last", "gaps", "largest_gap_hours", "duplicates",
+    *flag_columns.values(), "flag_other", "flag_none",
+]
+
+
+def codes(values: pd.Series) -> tuple:
+    """ Integer code of each value and the values, missing values included """
+    codes, uniques = pd.factorize(values)
+    missing = codes < 0
+    if missing.any():
+        codes[missing] = len(uniques)
+        uniques = uniques.insert(len(uniques), np.nan)
+    return codes.astype(np.int64), uniques
+
+
+def sort_order(series: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """ Order of rows by series, then time
+
+    Both are packed into one int64 key where they fit, which sorts about
+    three times faster than lexsort.
+    """
+    offsets = times - times.min()
+    time_bits = int(offsets.max()).bit_length()
+    if time_bits + int(series.max()).bit_length() > 63:
+        return np.lexsort((times, series))
+    return np.argsort((series << time_bits) | offsets)
+
+
+def profile_data(data: pd.DataFrame) -> pd.DataFrame:
+    """ Data quality profile of each station and parameter
+
+    Rows are sorted once by station, parameter, depth and time, and every
+    statistic is computed over the sorted group boundaries with ufunc
+    reduceat, so there is no groupby per statistic.
+
+    Args:
+        data: standardized long format data
+    Returns:
+        one row per station and parameter with its row count, numeric
+        values, number of depths, value range and mean, time span, gaps of
+        more than GAP_HOURS within a depth, rows repeating the time of the
+        previous row at the same depth, and the number of rows with each
+        quality flag
+    """
+    if data.empty:
+        return pd.DataFrame(columns=profile_columns)
+    station_codes, station_ids = codes(data["station_id"])
+    parameter_codes, parameters = codes(data["parameter"])
+    depth_codes, depths = codes(data["depth"])
+    times = pd.to_datetime(data["datetime"], utc=True).values.astype("int64")
+    pairs = station_codes * len(parameters) + parameter_codes
+    series = pairs * len(depths) + depth_codes
+    order = sort_order(series, times)
+
+    pairs = pairs[order]
+    series = series[order]
+    times = times[order]
+    new_pair = np.append(True, pairs[1:] != pairs[:-1])
+    new_series = np.append(True, series[1:] != series[:-1])
+    starts = np.flatnonzero(new_pair)
+    steps = np.append(0, np.diff(times))
+    steps[new_series] = 0
+
+    values = pd.to_numeric(data["value"], errors="coerce").to_numpy(float)[order]
+    has_value = ~np.isnan(values)
+    value_counts = np.add.reduceat(has_value, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(np.where(has_value, values, 0), starts) / value_counts
+
+    first_rows = order[starts]
+    profile = {
+        "station_id": station_ids[station_codes[first_rows]],
+        "parameter": parameters[parameter_codes[first_rows]],
+        "rows": np.diff(np.append(starts, len(order))),
+        "values": value_counts,
+        "depths": np.add.reduceat(new_series, starts),
+        "min": np.fmin.reduceat(values, starts),
+        "mean": np.where(value_counts > 0, mean, np.nan),
+        "max": np.fmax.reduceat(values, starts),
+        "first": pd.to_datetime(np.minimum.reduceat(times, starts), utc=True),
+        "last": pd.to_datetime(np.maximum.reduceat(times, starts), utc=True),
+        "gaps": np.add.reduceat(steps > GAP_HOURS * 3600e9, starts),
+        "largest_gap_hours": np.maximum.reduceat(steps, starts) / 3600e9,
+        "duplicates": np.add.reduceat(~new_series & (steps == 0), starts),
+    }
+    quality = data["quality"] if "quality" in data.columns else pd.Series(np.nan, index=data.index)
+    flags = pd.to_numeric(quality, errors="coerce").to_numpy(float)[order]
+    unflagged = quality.isna().to_numpy()[order]
+    counted = np.zeros(len(order), dtype=bool)
+    for flag, column in flag_columns.items():
+        matches = flags == flag
+        counted |= matches
+        profile[column] = np.add.reduceat(matches, starts)
+    profile["flag_other"] = np.add.reduceat(~counted & ~unflagged, starts)
+    profile["flag_none"] = np.add.reduceat(unflagged, starts)
+    return pd.DataFrame(profile, columns=profile_columns)
+
+
+def write_profile(data, results_directory: Path) -> Path:
+    """ Saves the data quality profile next to output.log
+
+    Args:
+        data: DataFrame, or SpilledFrames with each station in one frame
+        results_directory: directory of the run
+    """
+    started = time.perf_counter()
+    profiles = [profile_data(part) for part in spill.parts(data)]
+    # a SpilledFrames holds no frame when every station failed
+    profile = pd.concat(profiles, ignore_index=True) if profiles else pd.DataFrame(columns=profile_columns)
+    profile_file = Path(results_directory) / PROFILE_FILE
+    profile.to_csv(profile_file, index=False)
+    logging.info(
+        f"Profiled {int(profile['rows'].sum())} rows of {len(profile)} station parameters "
+        f"in {time.perf_counter() - started:.1f}s. Profile saved to {profile_file}"
+    )
+    return profile_file
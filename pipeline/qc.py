@@ -0,0 +1,228 @@
+import re
+import numpy as np
+import pandas as pd
+from pipeline import utils
+
+# QARTOD flags
+PASS = 1
+NOT_EVALUATED = 2
+SUSPECT = 3
+FAIL = 4
+MISSING = 9
+
+# test limits of each normalized parameter, in the first of its units
+#   units: unit -> factor converting values to the unit of the limits. The
+#       None key is used for values without a unit.
+#   gross_range: ((fail min, fail max), (suspect min, suspect max))
+#   spike: (suspect, fail) distance from the mean of the neighbouring samples
+#   rate_of_change: suspect change per hour
+#   flat_line: largest change still counted as flat
+ph_tests = {
+    # pH has no unit to mix up, so values without one are tested too
+    "units": {"pH": 1, None: 1},
+    "gross_range": ((0, 14), (6.5, 9.0)),
+    "spike": (0.2, 0.5),
+    "rate_of_change": 0.5,
+    "flat_line": 0.00001,
+}
+
+qc_config = {
+    "water_temperature": {
+        "units": {"C": 1},
+        "gross_range": ((-5, 45), (-2, 35)),
+        "spike": (2, 5),
+        "rate_of_change": 5,
+        "flat_line": 0.0001,
+    },
+    "pH": ph_tests,
+    "pH_external": ph_tests,
+    "pH_internal": ph_tests,
+    "pH_salinity": ph_tests,
+    "salinity": {
+        "units": {"PSU": 1},
+        "gross_range": ((0, 45), (2, 42)),
+        "spike": (1, 3),
+        "rate_of_change": 3,
+        "flat_line": 0.0001,
+    },
+    "oxygen_concentration": {
+        # 32 g/mol of O2, 1.43 mg per mL and seawater of about 1.025 kg/L
+        "units": {"mg/L": 1, "micromol/L": 0.032, "micromol/kg": 0.0328, "mL/L": 1.429},
+        "gross_range": ((0, 30), (0, 20)),
+        "spike": (1, 3),
+        "rate_of_change": 3,
+        "flat_line": 0.0001,
+    },
+    "oxygen_saturation": {
+        "units": {"%": 1},
+        "gross_range": ((0, 300), (0, 200)),
+        "spike": (10, 30),
+        "rate_of_change": 30,
+        "flat_line": 0.001,
+    },
+}
+
+# consecutive flat samples before a series is (suspect, failed)
+FLAT_LINE_COUNTS = (6, 12)
+
+# NERRS QAQC flags, see https://cdmo.baruch.sc.edu/data/qaqc.cfm
+nerrs_flags = {
+    -5: FAIL,  # outside high sensor range
+    -4: FAIL,  # outside low sensor range
+    -3: FAIL,  # rejected
+    -2: MISSING,  # missing data
+    -1: MISSING,  # optional parameter not collected
+    0: PASS,  # passed initial QAQC checks
+    1: SUSPECT,  # suspect data
+    2: NOT_EVALUATED,  # reserved for future use
+    3: PASS,  # calculated data
+    4: NOT_EVALUATED,  # historical data, pre-auto QAQC
+    5: PASS,  # corrected data
+}
+
+# raw_parameter keeps sensors with the same normalized parameter apart
+series_columns = ["station_id", "raw_parameter", "depth"]
+
+
+def decode_nerrs_flags(flags: pd.Series) -> np.ndarray:
+    """ QARTOD flags of NERRS flag strings such as '<0> [GIC]'
+
+    Each distinct flag string is parsed once and the result gathered back
+    to every row.
+    """
+    codes, uniques = pd.factorize(flags)
+    decoded = np.full(len(uniques) + 1, NOT_EVALUATED)
+    for i, flag in enumerate(uniques):
+        match = re.search(r"<(-?\d+)>", str(flag))
+        if match:
+            decoded[i] = nerrs_flags.get(int(match.group(1)), NOT_EVALUATED)
+    return decoded[codes]
+
+
+def fill_flags(data: pd.DataFrame) -> np.ndarray:
+    """ Quality flags of data, from run_tests where the provider gave none
+
+    The flags of run_tests are for agencies and analysis to weigh, and
+    collectors never drop rows by them: a value outside the suspect range,
+    such as pH below 6.5, may be a real exceedance.
+    """
+    quality = pd.to_numeric(data["quality"], errors="coerce").to_numpy(float)
+    missing = np.isnan(quality)
+    if missing.any():
+        quality[missing] = run_tests(data)[missing]
+    return quality.astype(int)
+
+
+def gross_range_test(values: np.ndarray, fail_span: tuple, suspect_span: tuple) -> np.ndarray:
+    """ Fails values outside the sensor span, suspects values outside the expected span """
+    flags = np.full(len(values), PASS)
+    flags[(values < suspect_span[0]) | (values > suspect_span[1])] = SUSPECT
+    flags[(values < fail_span[0]) | (values > fail_span[1])] = FAIL
+    return flags
+
+
+def spike_test(values: np.ndarray, first: np.ndarray, last: np.ndarray, thresholds: tuple) -> np.ndarray:
+    """ Flags values far from the mean of their neighbours in the same series
+
+    Args:
+        values: values sorted by series and time
+        first: whether each value is the first of its series
+        last: whether each value is the last of its series
+        thresholds: (suspect, fail) distance from the neighbours' mean
+    Returns:
+        flags, 0 where there are not two neighbours to compare with
+    """
+    flags = np.zeros(len(values), dtype=int)
+    inner = ~(first | last)
+    inner[[0, -1]] = False
+    spike = np.zeros(len(values))
+    spike[1:-1] = np.abs(values[1:-1] - (values[:-2] + values[2:]) / 2)
+    flags[inner] = PASS
+    flags[inner & (spike > thresholds[0])] = SUSPECT
+    flags[inner & (spike > thresholds[1])] = FAIL
+    return flags
+
+
+def rate_of_change_test(values: np.ndarray, hours: np.ndarray, first: np.ndarray, rate: float) -> np.ndarray:
+    """ Suspects values that changed faster than rate per hour since the previous sample
+
+    Returns:
+        flags, 0 for the first sample of each series
+    """
+    flags = np.zeros(len(values), dtype=int)
+    elapsed = np.diff(hours, prepend=np.nan)
+    change = np.abs(np.diff(values, prepend=np.nan))
+    evaluated = ~first & (elapsed > 0)
+    flags[evaluated] = PASS
+    flags[evaluated & (change > rate * elapsed)] = SUSPECT
+    return flags
+
+
+def flat_line_test(values: np.ndarray, first: np.ndarray, tolerance: float, counts: tuple = FLAT_LINE_COUNTS) -> np.ndarray:
+    """ Flags values that have not changed by more than tolerance for counts samples
+
+    Returns:
+        flags, SUSPECT after counts[0] and FAIL after counts[1] repeated samples
+    """
+    changed = first | ~(np.abs(np.diff(values, prepend=np.nan)) <= tolerance)
+    changed[0] = True
+    run_starts = np.flatnonzero(changed)
+    repeats = np.arange(len(values)) - run_starts[np.cumsum(changed) - 1]
+    flags = np.full(len(values), PASS)
+    flags[repeats >= counts[0]] = SUSPECT
+    flags[repeats >= counts[1]] = FAIL
+    return flags
+
+
+def run_tests(data: pd.DataFrame) -> np.ndarray:
+    """ QARTOD flag of each row from gross range, spike, rate of change and flat line tests
+
+    Rows are sorted once by series and time, each test runs over the whole
+    sorted arrays, and the worst flag of all tests is kept.
+
+    Args:
+        data: standardized data
+    Returns:
+        flags in the order of data. Values are converted to the unit of
+        their limits first. Parameters or units without limits in
+        qc_config are NOT_EVALUATED, missing values are MISSING.
+    """
+    flags = np.full(len(data), NOT_EVALUATED)
+    if data.empty:
+        return flags
+    times = pd.to_datetime(data["datetime"], utc=True).values.astype("int64")
+    columns = [c if c in data.columns else "parameter" for c in series_columns]
+    keys = [pd.factorize(data[column])[0] for column in columns]
+    order, _ = utils.group_boundaries(*keys, times)
+    # number of the series of each sorted row
+    sorted_keys = np.column_stack(keys)[order]
+    series = np.cumsum(np.append(False, np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)))
+    values = pd.to_numeric(data["value"], errors="coerce").to_numpy(float)[order]
+    hours = times[order] / 3.6e12
+    parameters = data["parameter"].to_numpy(object)[order]
+    units = data["unit"].to_numpy(object)[order]
+    sorted_flags = np.full(len(data), NOT_EVALUATED)
+    for parameter, config in qc_config.items():
+        rows = np.flatnonzero(parameters == parameter)
+        if not len(rows):
+            continue
+        unit_codes, unit_names = pd.factorize(units[rows])
+        factors = np.array([config["units"].get(unit, np.nan) for unit in unit_names] + [
+            config["units"].get(None, np.nan)
+        ])[unit_codes]
+        rows, factors = rows[~np.isnan(factors)], factors[~np.isnan(factors)]
+        if not len(rows):
+            continue
+        series_values = values[rows] * factors
+        series_first = np.diff(series[rows], prepend=-1) != 0
+        series_last = np.diff(series[rows], append=-1) != 0
+        worst = np.maximum.reduce([
+            gross_range_test(series_values, *config["gross_range"]),
+            spike_test(series_values, series_first, series_last, config["spike"]),
+            rate_of_change_test(series_values, hours[rows], series_first, config["rate_of_change"]),
+            flat_line_test(series_values, series_first, config["flat_line"]),
+        ])
+        sorted_flags[rows] = worst
+    sorted_flags[np.isnan(values)] = MISSING
+    flags[order] = sorted_flags
+    return flags
@@ -0,0 +1,228 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import quote, unquote
+from urllib.request import Request, urlopen
+import pandas as pd
+from pipeline import utils
+
+# the trigger only listens on the local machine
+HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# each collection reaches back this far before the end of the last one,
+# for samples providers publish late
+OVERLAP = timedelta(hours=6)
+
+# seconds between checks for states due a collection
+TICK_SECONDS = 30
+# a failed scheduled run is tried again after this long
+RETRY = timedelta(minutes=15)
+
+
+class StateJob():
+    """ Schedule, options and warm data of one state the service collects
+
+    The collected data of the last `window_days` is kept in memory. Each
+    run only collects each station from the end of its last successful
+    collection, less OVERLAP, and merges it in, so the agency files of the
+    whole window are formatted from memory after a short collection. A
+    station that fails is collected from the same point again next run.
+    """
+
+    def __init__(
+        self, state: str, output_directory: Path, window_days: float = 30,
+        every_hours: float = 24, **options
+    ):
+        self.state = state
+        self.output_directory = Path(output_directory)
+        self.window = timedelta(days=window_days)
+        self.every = timedelta(hours=every_hours)
+        # thin, parameters, station_ids and the formatting options of main.py
+        self.options = options
+        self.recent = None
+        # station -> end of its last successful collection
+        self.collected_until = {}
+        self.last_run = None
+        self.last_result = None
+
+    def due(self, now: datetime) -> bool:
+        return self.last_run is None or now - self.last_run >= self.every
+
+    def collection_window(self, now: datetime, station_id: str = None) -> tuple:
+        """ Start of the data to collect now from station_id and start of the window kept """
+        start = now - self.window
+        if station_id not in self.collected_until:
+            return start, start
+        return max(start, self.collected_until[station_id] - OVERLAP), start
+
+    def merge(self, new: pd.DataFrame, start: datetime, now: datetime, station_ids=()) -> pd.DataFrame:
+        """ Adds newly collected data to the warm data and drops data before start
+
+        Samples collected again in the overlap replace their earlier copy.
+
+        Args:
+            new: data collected this run
+            start: start of the window kept
+            now: end of the data collected this run
+            station_ids: stations collected successfully this run, whose
+                next collection starts from now
+        """
+        if self.recent is None or new.empty:
+            data = new if self.recent is None else self.recent
+        else:
+            data = pd.concat([self.recent, new], ignore_index=True)
+        if not data.empty:
+            keys = [column for column in utils.sample_columns if column in data.columns]
+            data = data.drop_duplicates(subset=keys, keep="last")
+            times = pd.to_datetime(data["datetime"], utc=True)
+            data = data[(times >= pd.Timestamp(start, tz="UTC")).to_numpy()]
+        self.recent = data.reset_index(drop=True)
+        for station_id in station_ids:
+            self.collected_until[station_id] = now
+        return self.recent
+
+    def status(self) -> dict:
+        return {
+            "every_hours": self.every / timedelta(hours=1),
+            "window_days": self.window / timedelta(days=1),
+            "warm_rows": 0 if self.recent is None else len(self.recent),
+            "collected_until": {
+                station_id: until.isoformat() for station_id, until in self.collected_until.items()
+            },
+            "last_run": None if self.last_run is None else self.last_run.isoformat(),
+            "last_result": self.last_result,
+        }
+
+
+def load_jobs(config_path: Path, output_root: Path) -> dict:
+    """ StateJob of each state listed in a service config
+
+    The config is json mapping each state to its schedule and options:
+        {"California": {"every_hours": 6, "window_days": 30, "excel": true}}
+    Output goes to output_root/<state>/service unless "output_dir" is set.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    jobs = {}
+    for state, options in config.items():
+        options = dict(options)
+        output_directory = options.pop("output_dir", Path(output_root) / state / "service")
+        jobs[state] = StateJob(state, output_directory, **options)
+    return jobs
+
+
+class Service():
+    """ Resident process running scheduled and triggered runs of StateJobs
+
+    Collectors, their sessions and clients, metadata lookups and each
+    state's warm data live as long as the process, so a triggered run
+    only pays for collecting what is new and formatting.
+
+    Args:
+        jobs: state -> StateJob
+        run_job: callable taking a StateJob and the current time, which
+            collects, merges and formats the job's data and returns a
+            json serializable summary
+        port: local port of the trigger, 0 for any free port
+    """
+
+    def __init__(self, jobs: dict, run_job, port: int = DEFAULT_PORT):
+        self.jobs = jobs
+        self.run_job = run_job
+        self.port = port
+        # one run at a time, scheduled or triggered
+        self.lock = threading.Lock()
+        self.server = None
+
+    def run(self, state: str) -> dict:
+        """ Runs one state's job now and returns its summary """
+        job = self.jobs[state]
+        with self.lock:
+            started = time.perf_counter()
+            now = datetime.now()
+            result = self.run_job(job, now)
+            result["seconds"] = round(time.perf_counter() - started, 2)
+            job.last_run = now
+            job.last_result = result
+        logging.info(f"Service run of {state} finished in {result['seconds']}s")
+        return result
+
+    def status(self) -> dict:
+        return {state: job.status() for state, job in self.jobs.items()}
+
+    def start_server(self) -> ThreadingHTTPServer:
+        """ Starts the local trigger in a background thread """
+        service = self
+
+        class TriggerHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/status":
+                    return self.respond(404, {"error": "unknown path"})
+                self.respond(200, service.status())
+
+            def do_POST(self):
+                if not self.path.startswith("/run/"):
+                    return self.respond(404, {"error": "unknown path"})
+                state = unquote(self.path[len("/run/"):])
+                if state not in service.jobs:
+                    return self.respond(404, {"error": f"{state} is not configured"})
+                try:
+                    self.respond(200, service.run(state))
+                except Exception as e:
+                    logging.error(f"Triggered run of {state} failed", exc_info=True)
+                    self.respond(500, {"error": repr(e)})
+
+            def respond(self, code: int, body: dict):
+                content = json.dumps(body, default=str).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logging.info("Trigger: " + format % args)
+
+        self.server = ThreadingHTTPServer((HOST, self.port), TriggerHandler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Trigger listening on http://{HOST}:{self.port}")
+        return self.server
+
+    def run_due(self):
+        """ Runs every job whose schedule is due """
+        for state, job in self.jobs.items():
+            if not job.due(datetime.now()):
+                continue
+            try:
+                self.run(state)
+            except Exception:
+                logging.error(f"Scheduled run of {state} failed", exc_info=True)
+                job.last_run = datetime.now() - job.every + RETRY
+
+    def serve_forever(self):
+        """ Starts the trigger and runs jobs on schedule until interrupted """
+        self.start_server()
+        try:
+            while True:
+                self.run_due()
+                time.sleep(TICK_SECONDS)
+        finally:
+            self.server.shutdown()
+
+
+def trigger(state: str, port: int = DEFAULT_PORT) -> dict:
+    """ Asks a running service to run a state now and waits for its summary """
+    request = Request(f"http://{HOST}:{port}/run/{quote(state)}", method="POST")
+    try:
+        with urlopen(request) as response:
+            return json.load(response)
+    except HTTPError as e:
+        return json.load(e)
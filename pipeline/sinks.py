@@ -0,0 +1,108 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ARCHIVE_FILE = "archive.parquet"
+SUMMARY_FILE = "station_summary.csv"
+
+# compression of the parquet archive
+COMPRESSION = "zstd"
+
+summary_columns = ["station_id", "parameter", "unit"]
+
+
+class ParquetArchive():
+    """ Compressed parquet copy of the standardized data a formatter writes
+
+    Each batch becomes a row group, so the archive is written as batches
+    are formatted, without holding or reading back all data.
+    """
+
+    def __init__(self, results_directory: Path):
+        self.path = Path(results_directory) / ARCHIVE_FILE
+        self.writer = None
+        self.columns = None
+        self.rows = 0
+
+    def write(self, batch: pd.DataFrame):
+        if batch.empty:
+            return
+        if self.writer is None:
+            self.columns = list(batch.columns)
+            table = pa.Table.from_pandas(self.normalize(batch), preserve_index=False)
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression=COMPRESSION)
+        else:
+            batch = batch.reindex(columns=self.columns)
+            table = pa.Table.from_pandas(
+                self.normalize(batch), schema=self.writer.schema, preserve_index=False
+            )
+        self.writer.write_table(table)
+        self.rows += len(batch)
+
+    @staticmethod
+    def normalize(batch: pd.DataFrame) -> pd.DataFrame:
+        """ Column types that stay the same from batch to batch
+
+        Text columns become strings and numbers floats, so a column that
+        is empty or whole numbers in one batch matches the next.
+        """
+        types = {}
+        for column, dtype in batch.dtypes.items():
+            if dtype == object:
+                types[column] = "string"
+            elif dtype.kind in "iuf":
+                types[column] = "float64"
+        return batch.astype(types)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class StationSummary():
+    """ Running count, range, mean and time span of each station's parameters
+
+    Each batch is reduced to one row per station, parameter and unit and
+    folded into the totals, which are saved as a csv on close.
+    """
+
+    def __init__(self, results_directory: Path):
+        self.path = Path(results_directory) / SUMMARY_FILE
+        self.totals = None
+
+    def write(self, batch: pd.DataFrame):
+        if batch.empty:
+            return
+        keys = [c for c in summary_columns if c in batch.columns]
+        partial = pd.DataFrame({
+            **{column: batch[column].fillna("").values for column in keys},
+            "value": pd.to_numeric(batch["value"], errors="coerce").values,
+            "datetime": pd.to_datetime(batch["datetime"], utc=True).values,
+        }).groupby(keys).agg(
+            count=("value", "count"),
+            total=("value", "sum"),
+            min=("value", "min"),
+            max=("value", "max"),
+            first=("datetime", "min"),
+            last=("datetime", "max"),
+        )
+        if self.totals is None:
+            self.totals = partial
+            return
+        combined = pd.concat([self.totals, partial])
+        self.totals = combined.groupby(level=list(range(combined.index.nlevels))).agg({
+            "count": "sum", "total": "sum", "min": "min", "max": "max", "first": "min", "last": "max",
+        })
+
+    def summary(self) -> pd.DataFrame:
+        """ Totals so far, with the mean in place of the sum """
+        if self.totals is None:
+            return pd.DataFrame(columns=summary_columns + ["count", "mean", "min", "max", "first", "last"])
+        summary = self.totals.copy()
+        summary.insert(1, "mean", summary.pop("total") / summary["count"].replace(0, np.nan))
+        return summary.reset_index()
+
+    def close(self):
+        self.summary().to_csv(self.path, index=False)
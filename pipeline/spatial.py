@@ -0,0 +1,193 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+KM_PER_MILE = 1.609344
+
+
+class StationIndex():
+    """ Uniform latitude/longitude grid over point locations
+
+    Points are bucketed into square cells and kept sorted by cell, so a
+    bounding box query only reads the cells it overlaps.
+    """
+
+    def __init__(self, latitudes, longitudes, cell_degrees: float = 0.5):
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.cell_degrees = cell_degrees
+        self.n_columns = int(np.ceil(360 / cell_degrees)) + 1
+        keys = self._cell_keys(self.latitudes, self.longitudes)
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, **kwargs):
+        """ Index over the latitude and longitude columns of df """
+        return cls(df["latitude"], df["longitude"], **kwargs)
+
+    def _cells(self, latitudes, longitudes):
+        rows = np.floor((np.asarray(latitudes) + 90) / self.cell_degrees).astype("int64")
+        columns = np.floor((np.asarray(longitudes) + 180) / self.cell_degrees).astype("int64")
+        return rows, columns
+
+    def _cell_keys(self, latitudes, longitudes):
+        rows, columns = self._cells(latitudes, longitudes)
+        return rows * self.n_columns + columns
+
+    def in_bbox(self, min_longitude, min_latitude, max_longitude, max_latitude) -> np.ndarray:
+        """ Positions of points inside the bounding box, in ascending order """
+        (first_row, last_row), (first_column, last_column) = self._cells(
+            [max(min_latitude, -90), min(max_latitude, 90)],
+            [max(min_longitude, -180), min(max_longitude, 180)],
+        )
+        rows = np.arange(first_row, last_row + 1) * self.n_columns
+        starts = np.searchsorted(self.keys, rows + first_column, side="left")
+        ends = np.searchsorted(self.keys, rows + last_column, side="right")
+        if len(starts) == 0:
+            return np.array([], dtype="int64")
+        candidates = self.order[np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])]
+        inside = (
+            (self.latitudes[candidates] >= min_latitude)
+            & (self.latitudes[candidates] <= max_latitude)
+            & (self.longitudes[candidates] >= min_longitude)
+            & (self.longitudes[candidates] <= max_longitude)
+        )
+        return np.sort(candidates[inside])
+
+    def in_polygon(self, polygon_latitudes, polygon_longitudes) -> np.ndarray:
+        """ Positions of points inside the polygon, in ascending order """
+        candidates = self.in_bbox(
+            np.min(polygon_longitudes), np.min(polygon_latitudes),
+            np.max(polygon_longitudes), np.max(polygon_latitudes),
+        )
+        inside = points_in_polygon(
+            self.latitudes[candidates], self.longitudes[candidates],
+            polygon_latitudes, polygon_longitudes
+        )
+        return candidates[inside]
+
+    def nearest(self, latitude: float, longitude: float, n: int) -> np.ndarray:
+        """ Positions of the n points closest to a location, closest first """
+        n = min(n, len(self.latitudes))
+        if n <= 0:
+            return np.array([], dtype=np.intp)
+        radius = self.cell_degrees
+        while True:
+            # longitude degrees shrink towards the poles, widen the box to match
+            pole_distance = np.cos(np.radians(min(abs(latitude) + radius, 89.9)))
+            candidates = self.in_bbox(
+                longitude - radius / pole_distance, latitude - radius,
+                longitude + radius / pole_distance, latitude + radius,
+            )
+            covers_all = radius >= 180
+            if len(candidates) >= n or covers_all:
+                distances = haversine_km(
+                    latitude, longitude,
+                    self.latitudes[candidates], self.longitudes[candidates]
+                )
+                closest = np.argsort(distances, kind="stable")[:n]
+                # only points within the box's inscribed circle are certain
+                if covers_all or distances[closest[-1]] <= radius * KM_PER_DEGREE:
+                    return candidates[closest]
+            radius *= 2
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes) -> np.ndarray:
+    """ Great circle distance in km from one location to many """
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def points_in_polygon(latitudes, longitudes, polygon_latitudes, polygon_longitudes) -> np.ndarray:
+    """ Even-odd ray casting test of many points against one polygon
+
+    Loops over polygon edges and tests every point against each edge at once.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    y1 = np.asarray(polygon_latitudes, dtype=float)
+    x1 = np.asarray(polygon_longitudes, dtype=float)
+    y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+    inside = np.zeros(len(latitudes), dtype=bool)
+    for ay, ax, by, bx in zip(y1, x1, y2, x2):
+        if ay == by:
+            continue
+        crosses = (ay > latitudes) != (by > latitudes)
+        intersect = ax + (latitudes - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (longitudes < intersect)
+    return inside
+
+
+def distance_to_line_km(latitudes, longitudes, line_latitudes, line_longitudes) -> np.ndarray:
+    """ Distance in km from each point to the closest segment of a polyline
+
+    Uses a local equirectangular projection, accurate to well under 1% at
+    the distances used for coastal buffers.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    line_latitudes = np.asarray(line_latitudes, dtype=float)
+    line_longitudes = np.asarray(line_longitudes, dtype=float)
+    scale = np.cos(np.radians(latitudes))
+    px, py = longitudes * scale, latitudes
+    closest = np.full(len(latitudes), np.inf)
+    for i in range(len(line_latitudes) - 1):
+        ay, by = line_latitudes[i], line_latitudes[i + 1]
+        ax, bx = line_longitudes[i] * scale, line_longitudes[i + 1] * scale
+        dx, dy = bx - ax, by - ay
+        length = dx ** 2 + dy ** 2
+        t = np.where(length > 0, ((px - ax) * dx + (py - ay) * dy) / np.where(length > 0, length, 1), 0)
+        t = np.clip(t, 0, 1)
+        distance = np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+        closest = np.minimum(closest, distance)
+    return closest * KM_PER_DEGREE
+
+
+def within_buffer(latitudes, longitudes, line: pd.DataFrame, miles: float) -> np.ndarray:
+    """ Whether each point is within `miles` of a polyline such as a coastline """
+    distances = distance_to_line_km(latitudes, longitudes, line["latitude"], line["longitude"])
+    return distances <= miles * KM_PER_MILE
+
+
+def read_polygon(path: Path) -> pd.DataFrame:
+    """ Reads polygon or polyline vertices from a csv with latitude and longitude columns """
+    return pd.read_csv(path)[["latitude", "longitude"]]
+
+
+def select_stations(
+    stations: pd.DataFrame,
+    bbox=None,
+    polygon: pd.DataFrame = None,
+    nearest=None
+) -> pd.DataFrame:
+    """ Selects stations by location
+
+    Args:
+        stations: stations table with latitude and longitude columns
+        bbox: (min_longitude, min_latitude, max_longitude, max_latitude)
+        polygon: vertices with latitude and longitude columns
+        nearest: (latitude, longitude, n) to keep the n closest stations
+    Returns:
+        rows of stations meeting every given condition
+    """
+    stations = stations[stations["latitude"].notna() & stations["longitude"].notna()]
+    index = StationIndex.from_frame(stations)
+    keep = np.arange(len(stations))
+    if bbox is not None:
+        keep = np.intersect1d(keep, index.in_bbox(*bbox))
+    if polygon is not None:
+        keep = np.intersect1d(keep, index.in_polygon(polygon["latitude"], polygon["longitude"]))
+    stations = stations.iloc[keep]
+    if nearest is not None:
+        latitude, longitude, n = nearest
+        closest = StationIndex.from_frame(stations).nearest(latitude, longitude, int(n))
+        stations = stations.iloc[closest]
+    return stations
@@ -0,0 +1,256 @@
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+
+
+class LazyColumn(ABC):
+    """ Column of a FormattedTable kept unexpanded until it is written
+
+    Writers call encode with their encoder for a Series, and only the
+    distinct values are encoded.
+    """
+
+    def __len__(self) -> int:
+        return self.length
+
+    @abstractmethod
+    def encode(self, encode):
+        """ Column encoded by encode, which is called on the distinct values only """
+
+    @abstractmethod
+    def to_numpy(self) -> np.ndarray:
+        """ Every row's value """
+
+
+class Repeated(LazyColumn):
+    """ The same value in every row """
+
+    def __init__(self, value, length: int):
+        self.value = value
+        self.length = length
+
+    def __getitem__(self, rows: slice) -> "Repeated":
+        return Repeated(self.value, len(range(self.length)[rows]))
+
+    def encode(self, encode):
+        # a scalar, which arrow repeats for every row
+        return encode(pd.Series([self.value]))[0]
+
+    def to_numpy(self) -> np.ndarray:
+        return np.full(self.length, self.value, dtype=object)
+
+
+class Lookup(LazyColumn):
+    """ Label of each row, stored as a code into few distinct labels """
+
+    def __init__(self, codes: np.ndarray, labels):
+        # missing codes point to a missing label at the end
+        self.labels = pd.concat([pd.Series(labels), pd.Series([np.nan])], ignore_index=True)
+        self.codes = np.where(codes < 0, len(self.labels) - 1, codes)
+        self.length = len(codes)
+
+    @classmethod
+    def of(cls, values: pd.Series, label) -> "Lookup":
+        """ label applied once to each distinct value, missing values included """
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Series(uniques)
+        missing = codes < 0
+        if missing.any():
+            # labelled too, as label may give missing values a label of their own
+            codes = np.where(missing, len(uniques), codes)
+            uniques = pd.concat([uniques, pd.Series([np.nan])], ignore_index=True)
+        return cls(codes, label(uniques))
+
+    def __getitem__(self, rows: slice) -> "Lookup":
+        part = Lookup.__new__(Lookup)
+        part.labels = self.labels
+        part.codes = self.codes[rows]
+        part.length = len(part.codes)
+        return part
+
+    def encode(self, encode):
+        return encode(self.labels).take(self.codes)
+
+    def to_numpy(self) -> np.ndarray:
+        return self.labels.to_numpy()[self.codes]
+
+
+class _Rows():
+    """ Row slicing of a FormattedTable, like DataFrame.iloc """
+
+    def __init__(self, table: "FormattedTable"):
+        self.table = table
+
+    def __getitem__(self, rows: slice) -> "FormattedTable":
+        return FormattedTable(
+            {name: values[rows] for name, values in self.table.items()},
+            len(range(len(self.table))[rows]),
+        )
+
+
+class FormattedTable():
+    """ Agency table produced by a TableSpec
+
+    Holds Series for columns computed per row and LazyColumns for
+    constants and mapped values. Accepted wherever a DataFrame is written
+    with csvencode.write_csv or xlsx.write_workbook.
+    """
+
+    def __init__(self, columns: dict, length: int):
+        self._columns = columns
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def columns(self) -> list:
+        return list(self._columns)
+
+    @property
+    def empty(self) -> bool:
+        return self.length == 0 or not self._columns
+
+    @property
+    def iloc(self) -> _Rows:
+        return _Rows(self)
+
+    def items(self):
+        return self._columns.items()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._columns[key]
+        return FormattedTable({name: self._columns[name] for name in key}, self.length)
+
+    def to_frame(self) -> pd.DataFrame:
+        """ All columns expanded into a DataFrame """
+        return pd.DataFrame({
+            name: values.to_numpy() if isinstance(values, LazyColumn) else np.asarray(values)
+            for name, values in self.items()
+        }, columns=self.columns)
+
+
+class Source():
+    """ A column of the input as is, or through convert """
+
+    def __init__(self, column: str, convert=None):
+        self.column = column
+        self.convert = convert
+
+    def applies(self, columns) -> bool:
+        return self.column in columns
+
+    def __call__(self, data: pd.DataFrame):
+        values = data[self.column]
+        return values if self.convert is None else self.convert(values)
+
+
+class Mapped(Source):
+    """ A column of the input mapped to agency values
+
+    Mapping is a dict, a Series indexed by input value, or a function of
+    a Series of input values. It is applied to each distinct value once.
+    """
+
+    def __call__(self, data: pd.DataFrame) -> Lookup:
+        mapping = self.convert
+        if isinstance(mapping, (dict, pd.Series)):
+            return Lookup.of(data[self.column], lambda values: values.map(mapping))
+        return Lookup.of(data[self.column], mapping)
+
+
+class Derived():
+    """ A column computed from the input by function """
+
+    def __init__(self, function, requires=()):
+        self.function = function
+        self.requires = requires
+
+    def applies(self, columns) -> bool:
+        return set(self.requires).issubset(columns)
+
+    def __call__(self, data: pd.DataFrame):
+        return self.function(data)
+
+
+class Constant():
+    """ The same value in every row, never expanded before it is written """
+
+    def __init__(self, value):
+        self.value = value
+
+    def applies(self, columns) -> bool:
+        return True
+
+    def __call__(self, data: pd.DataFrame) -> Repeated:
+        return Repeated(self.value, len(data))
+
+
+def formatted_times(column: str, time_format: str, resolution: str, utc: bool = True):
+    """ Step writing a time column with time_format
+
+    Times are floored to resolution, the finest unit time_format shows,
+    and each distinct time is formatted once.
+    """
+    def format_times(data: pd.DataFrame) -> Lookup:
+        times = pd.to_datetime(data[column], utc=utc).dt.floor(resolution)
+        codes, uniques = pd.factorize(times)
+        return Lookup(codes, uniques.strftime(time_format))
+    return Derived(format_times, requires=[column])
+
+
+def converted_values(conversions: dict):
+    """ Step writing value, converted to the agency unit where conversions lists its unit
+
+    Args:
+        conversions: unit -> function converting a Series of values
+    """
+    def convert(data: pd.DataFrame) -> pd.Series:
+        values = data["value"]
+        for unit, conversion in conversions.items():
+            matches = (data["unit"] == unit).to_numpy()
+            if matches.any():
+                if values is data["value"]:
+                    values = values.copy()
+                values[matches] = np.asarray(conversion(values[matches]))
+        return values
+    return Derived(convert, requires=["value", "unit"])
+
+
+def renamed(columns: dict) -> dict:
+    """ Source step of each agency column, from input column -> agency column """
+    return {agency_column: Source(column) for column, agency_column in columns.items()}
+
+
+class TableSpec():
+    """ Columns of an agency table in template order, and how to fill each
+
+    Columns whose input column is missing are left out, as the agency
+    templates mark them optional. The steps that apply to a set of input
+    columns are compiled once, and the input is never modified.
+
+    Args:
+        steps: agency column -> Source, Mapped, Derived or Constant
+        template: agency columns in the order of the template, steps of
+            other columns are left out
+    """
+
+    def __init__(self, steps: dict, template: list):
+        self.columns = {name: steps[name] for name in template if name in steps}
+        self.plans = {}
+
+    def compile(self, input_columns) -> list:
+        """ (name, step) of each output column for input with input_columns """
+        key = tuple(input_columns)
+        if key not in self.plans:
+            self.plans[key] = [
+                (name, step) for name, step in self.columns.items() if step.applies(input_columns)
+            ]
+        return self.plans[key]
+
+    def apply(self, data: pd.DataFrame) -> FormattedTable:
+        """ Agency table of data """
+        return FormattedTable(
+            {name: step(data) for name, step in self.compile(data.columns)}, len(data)
+        )
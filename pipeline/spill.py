@@ -0,0 +1,161 @@
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+import pandas as pd
+
+size_units = {"K": 2**10, "M": 2**20, "G": 2**30}
+
+
+def parse_size(size: str) -> int:
+    """ Bytes in a size such as '512M' or '4G' """
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in size_units:
+        return int(float(size[:-1]) * size_units[size[-1]])
+    return int(size)
+
+
+class SpilledFrames():
+    """ Standardized data kept in memory up to a budget, and on disk past it
+
+    Frames are appended whole, usually one per station. Once the frames in
+    memory take more than max_memory, the oldest are written to parquet
+    files in a temporary directory. Iterating yields every frame in the
+    order appended, reading spilled ones back one at a time, so stages
+    that work frame by frame never hold more than the budget and one frame.
+    """
+
+    def __init__(self, max_memory: int, directory: Path = None):
+        self.max_memory = max_memory
+        self.directory = Path(tempfile.mkdtemp(prefix="spill-", dir=directory))
+        # DataFrame, or path of a spilled one
+        self.parts = []
+        self.row_counts = []
+        self.part_stations = []
+        self.sizes = []
+        self.memory = 0
+
+    def append(self, frame: pd.DataFrame):
+        """ Adds a frame, spilling the oldest frames in memory if over budget """
+        size = int(frame.memory_usage(deep=True).sum())
+        self.parts.append(frame)
+        self.row_counts.append(len(frame))
+        self.part_stations.append(set(frame["station_id"].unique()) if "station_id" in frame else set())
+        self.sizes.append(size)
+        self.memory += size
+        for i, part in enumerate(self.parts):
+            if self.memory <= self.max_memory:
+                break
+            if isinstance(part, pd.DataFrame):
+                self._spill(i)
+
+    def _spill(self, i: int):
+        frame = self.parts[i]
+        path = self.directory / "part{}.parquet".format(i)
+        try:
+            frame.to_parquet(path)
+        except (ImportError, ValueError, TypeError) as e:
+            # object columns mixing types can't be written as parquet
+            logging.info(f"Spilling frame {i} as pickle: {e}")
+            path = path.with_suffix(".pkl")
+            frame.to_pickle(path)
+        self.parts[i] = path
+        self.memory -= self.sizes[i]
+        logging.info(f"Spilled {len(frame)} rows to {path}")
+
+    @staticmethod
+    def _read(part):
+        if isinstance(part, pd.DataFrame):
+            return part
+        if part.suffix == ".pkl":
+            return pd.read_pickle(part)
+        return pd.read_parquet(part)
+
+    def __iter__(self):
+        for part in self.parts:
+            yield self._read(part)
+
+    def __len__(self) -> int:
+        return sum(self.row_counts)
+
+    @property
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    @property
+    def spilled(self) -> int:
+        """ Number of frames on disk """
+        return sum(not isinstance(part, pd.DataFrame) for part in self.parts)
+
+    def station_ids(self) -> list:
+        """ Stations with data, without reading spilled frames """
+        return sorted(set().union(*self.part_stations))
+
+    def select(self, station_ids) -> pd.DataFrame:
+        """ Rows of station_ids, reading only the frames that hold them """
+        station_ids = set(station_ids)
+        frames = [
+            self._read(part) for part, stations in zip(self.parts, self.part_stations)
+            if stations & station_ids
+        ]
+        if not frames:
+            return self._read(self.parts[0]).iloc[:0]
+        data = pd.concat(frames)
+        return data[data["station_id"].isin(station_ids)]
+
+    def map(self, function) -> "SpilledFrames":
+        """ New SpilledFrames of function applied to each frame """
+        mapped = SpilledFrames(self.max_memory, self.directory.parent)
+        for frame in self:
+            mapped.append(function(frame))
+        self.close()
+        return mapped
+
+    def to_frame(self) -> pd.DataFrame:
+        """ All frames concatenated in memory """
+        return pd.concat(list(self))
+
+    def close(self):
+        """ Removes spilled files """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self) -> "SpilledFrames":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parts(data):
+    """ Frames of data, which is a DataFrame or SpilledFrames """
+    return [data] if isinstance(data, pd.DataFrame) else data
+
+
+def cleanup(data):
+    """ Removes the spilled files of data if it is a SpilledFrames """
+    if isinstance(data, SpilledFrames):
+        data.close()
+
+
+def apply(data, function):
+    """ function applied to data, frame by frame if it is a SpilledFrames
+
+    Only for functions that treat each station separately.
+    """
+    if isinstance(data, pd.DataFrame):
+        return function(data)
+    return data.map(function)
+
+
+def station_ids(data) -> list:
+    """ Stations with data in a DataFrame or SpilledFrames """
+    if isinstance(data, pd.DataFrame):
+        return list(data["station_id"].unique())
+    return data.station_ids()
+
+
+def select(data, station_ids) -> pd.DataFrame:
+    """ Rows of station_ids in a DataFrame or SpilledFrames """
+    if isinstance(data, pd.DataFrame):
+        return data[data["station_id"].isin(station_ids)]
+    return data.select(station_ids)
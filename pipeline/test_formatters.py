@@ -40,13 +40,25 @@ class TestDataCollection():
         ## should have results, locations, and README.txt
         for obj in results_directory.iterdir():
             if "results" in obj.name:
-                results = pd.read_csv(obj, index_col=0)
+                results = pd.read_csv(obj)
             elif "locations" in obj.name:
-                locations = pd.read_csv(obj, index_col=0)
+                locations = pd.read_csv(obj)
             else:
                 assert obj.name == "README.txt"
         self.ceden_tests(results, locations)
 
+    @pytest.mark.state_test_data("ceden")
+    def test_ceden_excel(self, state_test):
+        formatter = CEDEN()
+        formatter.excel = True
+        results_directory = formatter.format_data_for_agency(state_test)
+        workbooks = sorted(results_directory.glob("*.xlsx"))
+        assert [obj.name for obj in workbooks] == ["cbd_b0.xlsx"]
+        sheets = pd.read_excel(workbooks[0], sheet_name=None)
+        assert list(sheets) == ["Locations", "Field Results"]
+        assert len(sheets["Field Results"]) == len(state_test)
+        self.ceden_tests(sheets["Field Results"], sheets["Locations"])
+
     @pytest.mark.state_test_data("eim")
     def test_eim_standard(self, state_test):
         formatter = EIM()
@@ -62,10 +74,10 @@ class TestDataCollection():
                 for grandchild in obj.iterdir():
                     if "locations" in grandchild.name:
                         location_files_found += 1
-                        locations = pd.read_csv(grandchild, index_col=0)
+                        locations = pd.read_csv(grandchild)
                     else:
                         assert grandchild.name.startswith(study_name)
-                        results_batch = pd.read_csv(grandchild, index_col=0)
+                        results_batch = pd.read_csv(grandchild)
                         results_batches.append(results_batch)
                 assert location_files_found == 1
                 results = pd.concat(results_batches)
@@ -78,10 +90,10 @@ class TestDataCollection():
         all_results = []
         for obj in results_directory.iterdir():
             if "results" in obj.name:
-                results = pd.read_csv(obj, index_col=0)
+                results = pd.read_csv(obj)
                 all_results.append(results)
             elif "locations" in obj.name:
-                locations = pd.read_csv(obj, index_col=0)
+                locations = pd.read_csv(obj)
             else:
                 assert obj.name == "README.txt"  
         full_results = pd.concat(all_results)
@@ -0,0 +1,653 @@
+import hashlib
+import os
+import time
+import pytest
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from . import utils
+from .aggregate import aggregate_data
+from .analysis import exceedance_summary, write_exceedance_summary, ROLLING_DAYS
+from . import spatial
+from . import checkpoint
+from .ledger import FetchLedger
+from .lookup import ParameterLookup
+from . import lookup
+from . import incremental
+from . import extsort
+from . import qc
+from . import carbonate
+from . import align
+from . import dedup
+from . import spill
+from . import sinks
+from . import csvencode
+from . import service
+from . import workqueue
+from . import coverage
+from . import profiling
+from . import spec
+from . import manifest
+from .ceden import CEDEN
+from .erddap import ERDDAP
+from .hawaii import Hawaii
+
+HERE = Path(__file__).resolve().parent
+
+
+class TestProcessing():
+
+    def test_thin_data(self):
+        dataset = pd.DataFrame({
+            "datetime": pd.date_range("2022-01-01", periods=120, freq="1min"),
+            "depth": [0, 1] * 60,
+        })
+        thinned = utils.thin_data(dataset, 30, by=["depth"])
+        # 4 half hour buckets for each of 2 depths
+        assert len(thinned) == 8
+        assert utils.thin_data(dataset, None) is dataset
+
+    def test_aggregate_data(self):
+        dataset = pd.DataFrame({
+            "datetime": pd.date_range("2022-01-01", periods=120, freq="1min").repeat(2),
+            "station_id": "a",
+            "parameter": ["pH", "salinity"] * 120,
+            "depth": 0.0,
+            "value": np.arange(240, dtype=float),
+            "quality": 1,
+        })
+        dataset.loc[3, "quality"] = 3
+        # a spike, and an hour of salinity that failed throughout
+        dataset.loc[0, ["value", "quality"]] = [1000.0, 4]
+        dataset.loc[121::2, "quality"] = 4
+        aggregated = aggregate_data(dataset, "hourly")
+        assert len(aggregated) == 4
+        first = aggregated.iloc[0]
+        assert first["parameter"] == "pH"
+        assert first["sample_count"] == 59
+        assert first["value_min"] == 2 and first["value_max"] == 118
+        assert first["value"] == 60
+        assert first["quality"] == 1
+        # worst flag of the rows used is kept
+        salinity = aggregated[aggregated["parameter"] == "salinity"]
+        assert salinity["quality"].tolist() == [3, 4]
+        assert salinity["sample_count"].tolist() == [60, 60]
+
+    def test_exceedance_summary(self):
+        hours = 24 * 10
+        dataset = pd.DataFrame({
+            "datetime": np.tile(pd.date_range("2022-01-01", periods=hours, freq="1H"), 2),
+            "station_id": "a",
+            "parameter": np.repeat(["pH", "oxygen_concentration"], hours),
+            "depth": 0.0,
+            "value": np.concatenate([np.full(hours, 8.0), np.full(hours, 5.5)]),
+        })
+        dataset.loc[0, "value"] = 9.0
+        dataset.loc[hours, "value"] = 4.0
+        summary = exceedance_summary(dataset)
+        ph = summary.loc[("a", "pH")]
+        assert ph["samples"] == hours and ph["exceedances"] == 1
+        assert ph["days"] == 10
+        oxygen = summary.loc[("a", "oxygen_concentration")]
+        assert oxygen["exceedances"] == 1
+        # every complete 7 day window of daily minima is below 6 mg/L
+        assert oxygen["rolling_windows"] == 10 - ROLLING_DAYS + 1
+        assert oxygen["rolling_exceedances"] == oxygen["rolling_windows"]
+
+    def test_exceedance_summary_skips_failed_samples(self):
+        dataset = pd.DataFrame({
+            "datetime": pd.date_range("2022-01-01", periods=4, freq="1H"),
+            "station_id": "a",
+            "parameter": "pH",
+            "depth": 0.0,
+            "value": [8.0, 8.1, 11.0, 6.0],
+            "quality": [qc.PASS, qc.PASS, qc.FAIL, qc.SUSPECT],
+        })
+        ph = exceedance_summary(dataset).loc[("a", "pH")]
+        # the failed spike is neither a sample nor an exceedance
+        assert ph["samples"] == 3 and ph["exceedances"] == 1
+
+    def test_exceedance_summary_without_criteria(self, tmp_path):
+        dataset = pd.DataFrame({
+            "datetime": pd.date_range("2022-01-01", periods=3, freq="1H"),
+            "station_id": "a",
+            "parameter": "salinity",
+            "depth": 0.0,
+            "value": [30.0, 31.0, 32.0],
+        })
+        assert exceedance_summary(dataset).empty
+        summary_file = write_exceedance_summary(dataset, tmp_path)
+        summary = pd.read_csv(summary_file)
+        assert summary.empty and "exceedances" in summary.columns
+        # a --max-memory run where every station failed
+        with spill.SpilledFrames(max_memory=0, directory=tmp_path) as nothing:
+            summary = pd.read_csv(write_exceedance_summary(nothing, tmp_path))
+        assert summary.empty and "exceedances" in summary.columns
+
+    def test_station_index(self):
+        rng = np.random.default_rng(0)
+        latitudes = rng.uniform(30, 50, 2000)
+        longitudes = rng.uniform(-135, -115, 2000)
+        index = spatial.StationIndex(latitudes, longitudes)
+        in_box = index.in_bbox(-125, 35, -120, 40)
+        expected = np.flatnonzero(
+            (latitudes >= 35) & (latitudes <= 40) & (longitudes >= -125) & (longitudes <= -120)
+        )
+        assert (in_box == expected).all()
+        square = index.in_polygon([35, 40, 40, 35], [-125, -125, -120, -120])
+        assert (square == expected).all()
+        distances = spatial.haversine_km(37, -122, latitudes, longitudes)
+        assert (index.nearest(37, -122, 10) == np.argsort(distances)[:10]).all()
+
+    def test_select_stations(self):
+        stations = pd.read_csv(HERE / "metadata" / "stations.csv", index_col="station_id")
+        selected = spatial.select_stations(stations, bbox=(-123, 47, -122, 48), nearest=(47.6, -122.3, 2))
+        assert len(selected) == 2
+        assert selected.index[0] == "SEATTLE_AQUARIUM"
+        # no station in the box is left to be nearest
+        selected = spatial.select_stations(stations, bbox=(0, 0, 1, 1), nearest=(47.6, -122.3, 2))
+        assert selected.empty
+        assert len(spatial.select_stations(stations, nearest=(47.6, -122.3, 0))) == 0
+
+    def test_checkpoints(self, tmp_path):
+        data = pd.read_csv(HERE / "metadata" / "small_dataset.csv", index_col=0)
+        checkpoint.save_checkpoint(tmp_path, "station-a", data)
+        checkpoint.save_checkpoint(tmp_path, "station-b", data.iloc[:0])
+        assert checkpoint.completed_stations(tmp_path) == {"station-a", "station-b"}
+        pd.testing.assert_frame_equal(checkpoint.load_checkpoint(tmp_path, "station-a"), data)
+        start, end = datetime(2022, 1, 1), datetime(2022, 2, 1)
+        checkpoint.save_run(tmp_path, "Washington", start, end, thin=None)
+        run = checkpoint.load_run(tmp_path)
+        assert (run["state"], run["start"], run["end"]) == ("Washington", start, end)
+
+    def test_fetch_ledger(self, tmp_path):
+        ledger = FetchLedger(tmp_path / "ledger.sqlite")
+        end = datetime(2022, 3, 1)
+        assert ledger.estimate("NERRS", "a", end - timedelta(1), end)["basis"] is None
+        for days in [10, 20]:
+            data = pd.DataFrame({"value": np.ones(days * 24)})
+            ledger.record("NERRS", "a", end - timedelta(days), end, 1 + days, "ok", data=data)
+        ledger.record("NERRS", "a", end - timedelta(5), end, 90, "HTTPError")
+        estimate = ledger.estimate("NERRS", "a", end - timedelta(100), end)
+        assert estimate["basis"] == "station" and estimate["based_on"] == 2
+        assert estimate["rows"] == 2400
+        assert estimate["seconds"] == pytest.approx(101)
+        assert ledger.estimate("NERRS", "b", end - timedelta(100), end)["basis"] == "provider"
+        assert estimate["memory_bytes"] > 0
+        # history of unthinned calls says nothing about thinned ones
+        assert ledger.estimate("NERRS", "a", end - timedelta(100), end, thin=60)["basis"] is None
+
+    def test_parameter_lookup(self):
+        metadata = pd.DataFrame({
+            "station_id": ["a", "a", "b"],
+            "parameter": ["Sonde_pH", "Salinity", "Sonde_pH"],
+            "unit": [None, "PSU", None],
+            "instrument": ["sonde", "ctd", "other sonde"],
+            "method": [np.nan] * 3,
+            "equipment_id": [np.nan] * 3,
+        })
+        stations = pd.DataFrame({"latitude": [47.0], "longitude": [-122.0]}, index=pd.Index(["a"], name="station_id"))
+        lookup = ParameterLookup(metadata, stations)
+        data = pd.DataFrame({
+            "station_id": ["a", "b", "a", "c"],
+            "parameter": ["Salinity", "Sonde_pH", "not_listed", "Sonde_pH"],
+        })
+        enriched = lookup.enrich(data, add_locations=True)
+        assert enriched["parameter"].tolist()[:2] == ["salinity", "pH"]
+        assert pd.isna(enriched["parameter"][2])
+        assert enriched["instrument"].tolist()[:2] == ["ctd", "other sonde"]
+        assert enriched["instrument"][2:].isna().all()
+        assert enriched["raw_parameter"].tolist() == data["parameter"].tolist()
+        assert enriched["latitude"][0] == 47.0 and pd.isna(enriched["latitude"][1])
+        names = lookup.agency("test", {"pH": "PH"}, {"PSU": "psu", np.nan: "none"})
+        assert names.parameter(pd.Series(["pH", "salinity"])).tolist()[0] == "PH"
+        assert names.unit(pd.Series(["PSU", np.nan])).tolist() == ["psu", "none"]
+
+    def test_incremental_formatting(self, tmp_path):
+        data = pd.read_csv(HERE / "metadata" / "small_dataset.csv", index_col=0)
+        data["station_id"] = "test-hawaii"
+        formatter = Hawaii(tmp_path)
+        formatter.format_data_for_agency(data)
+        assert formatter.artifacts["cbd_results_b0.csv"] == ["test-hawaii"]
+        (tmp_path / "cbd_results_b0.csv").unlink()
+        formatter.format_data_for_agency(data, only_stations=["other-station"])
+        assert not (tmp_path / "cbd_results_b0.csv").exists()
+        formatter.format_data_for_agency(data, only_stations=["test-hawaii"])
+        assert (tmp_path / "cbd_results_b0.csv").exists()
+
+    def test_output_manifest(self, tmp_path, monkeypatch):
+        data = pd.read_csv(HERE / "metadata" / "small_dataset.csv", index_col=0)
+        data["station_id"] = "test-hawaii"
+        formatter = Hawaii(tmp_path)
+        formatter.format_data_for_agency(data)
+        results_file = tmp_path / "cbd_results_b0.csv"
+        entry = formatter.manifest["cbd_results_b0.csv"]
+        assert entry["bytes"] == results_file.stat().st_size
+        assert entry["sha256"] == hashlib.sha256(results_file.read_bytes()).hexdigest()
+        assert formatter.unchanged == []
+        written = results_file.stat().st_mtime_ns
+        rerun = Hawaii(tmp_path)
+        rerun.manifest = dict(formatter.manifest)
+        # unchanged content is only hashed, never written
+        with monkeypatch.context() as patch:
+            patch.setattr(manifest.HashingWriter, "spill", None)
+            rerun.format_data_for_agency(data)
+        assert sorted(rerun.unchanged) == sorted(formatter.manifest)
+        assert results_file.stat().st_mtime_ns == written
+        # content past the buffer goes through a temporary file
+        monkeypatch.setattr(manifest, "BUFFER_BYTES", 1000)
+        rerun.format_data_for_agency(data)
+        assert results_file.stat().st_mtime_ns == written
+        rerun.format_data_for_agency(data.iloc[:10])
+        assert rerun.manifest["cbd_results_b0.csv"] != entry
+        # a batch only the last run had
+        stale = tmp_path / "cbd_results_b1.csv"
+        stale.write_text("old")
+        rerun.manifest["cbd_results_b1.csv"] = {"sha256": "", "bytes": 3}
+        assert rerun.prune() == ["cbd_results_b1.csv"]
+        assert not stale.exists() and results_file.exists()
+        assert not list(tmp_path.glob("*.partial"))
+
+    def test_sinks(self, tmp_path):
+        data = pd.read_csv(HERE / "metadata" / "small_dataset.csv", index_col=0)
+        data["station_id"] = "test-hawaii"
+        formatter = Hawaii(tmp_path)
+        formatter.sinks = [sinks.ParquetArchive(tmp_path), sinks.StationSummary(tmp_path)]
+        batches = list(formatter.sorted_batches(data, 100))
+        for sink in formatter.sinks:
+            sink.close()
+        assert len(batches) > 1
+        archive = pd.read_parquet(tmp_path / sinks.ARCHIVE_FILE)
+        assert len(archive) == len(data)
+        assert archive["station_id"].tolist() == pd.concat(batches)["station_id"].tolist()
+        summary = pd.read_csv(tmp_path / sinks.SUMMARY_FILE)
+        values = pd.to_numeric(data["value"], errors="coerce")
+        assert summary["count"].sum() == values.notna().sum()
+        ph = summary[summary["parameter"] == "pH"].iloc[0]
+        ph_values = values[data["parameter"] == "pH"]
+        assert ph["mean"] == pytest.approx(ph_values.mean())
+        assert ph["max"] == ph_values.max()
+
+    def test_csv_encoder(self, tmp_path, monkeypatch):
+        table = pd.DataFrame({
+            "station": ["a", "b, c", 'd"e', None],
+            "value": [8.0, 0.5, np.nan, 1e-05],
+            "count": [1, 2, 3, 4],
+            "approved": [True, False, True, True],
+        }, index=[7, 8, 9, 10])
+        path = tmp_path / "table.csv"
+        monkeypatch.setattr(csvencode, "BLOCK_ROWS", 3)
+        csvencode.write_csv(table, path, columns=["count", "station", "value", "approved"])
+        assert path.read_text().splitlines()[:3] == [
+            "count,station,value,approved", "1,a,8,True", '2,"b, c",0.5,False'
+        ]
+        pd.testing.assert_frame_equal(
+            pd.read_csv(path), table[["count", "station", "value", "approved"]].reset_index(drop=True)
+        )
+        csvencode.write_csv(table.rename_axis("row"), path, index=True, header=False)
+        assert path.read_text().splitlines()[0] == "7,a,8,1,True"
+        data = pd.read_csv(HERE / "metadata" / "small_dataset.csv", index_col=0)
+        data["station_id"] = "test-hawaii"
+        formatter = Hawaii(tmp_path)
+        formatter.compress = True
+        formatter.format_data_for_agency(data)
+        assert "cbd_results_b0.csv.gz" in formatter.manifest
+        assert len(pd.read_csv(tmp_path / "cbd_results_b0.csv.gz")) == len(data)
+
+    def test_reenrich(self, tmp_path):
+        raw = pd.DataFrame({
+            "station_id": ["tiburon-water-tibc1"] * 2,
+            "parameter": ["sea_water_electrical_conductivity", "mass_concentration_of_oxygen_in_sea_water"],
+            "value": [52.1, 7.5],
+        })
+        enriched = lookup.get_lookup().enrich(raw, add_locations=True)
+        stale = enriched.assign(instrument="old sonde", latitude=0.0, parameter="old name")
+        pd.testing.assert_frame_equal(incremental.reenrich(stale, add_locations=True), enriched)
+        with pytest.raises(ValueError):
+            incremental.reenrich(raw, add_locations=True)
+        incremental.save_fingerprints(tmp_path, ["tiburon-water-tibc1", "test-hawaii"])
+        assert incremental.changed_stations(tmp_path, ["tiburon-water-tibc1", "test-ceden"]) == ["test-ceden"]
+
+    def test_external_sort(self, tmp_path):
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame({
+            "station_id": rng.choice(["b", "a", "c"], 5000),
+            "parameter": rng.choice(["pH", "salinity", np.nan], 5000),
+            "datetime": pd.Timestamp("2022-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 50, 5000), "h"),
+            "value": np.arange(5000.0),
+        })
+        expected = data.sort_values(extsort.SORT_COLUMNS, kind="mergesort")
+        frames = [data.iloc[:1234], data.iloc[1234:]]
+        chunks = list(extsort.sorted_chunks(frames, memory_budget=400000, spill_directory=tmp_path))
+        assert len(chunks) > 1
+        pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+        assert not list(tmp_path.iterdir())
+        batches = list(extsort.rebatch(chunks, 2000))
+        assert [len(b) for b in batches] == [2000, 2000, 1000]
+
+    def test_qc_tests(self):
+        values = [8.0, 8.02, 8.04, 8.9, 8.06, 8.08, 8.1] + [8.12] * 13
+        data = pd.DataFrame({
+            "datetime": pd.date_range("2022-01-01", periods=len(values), freq="1H", tz="UTC"),
+            "station_id": "a",
+            "parameter": "pH",
+            "raw_parameter": "Sonde_pH",
+            "depth": 0.0,
+            "unit": "pH",
+            "value": values,
+        })
+        data.loc[len(data)] = data.iloc[0].copy()
+        data.loc[len(data) - 1, ["parameter", "raw_parameter", "unit"]] = ["turbidity", "Turb", "ntu"]
+        flags = qc.run_tests(data.iloc[::-1])[::-1].tolist()
+        assert flags[:2] == [qc.PASS] * 2
+        # the spike, and its neighbours by half as much
+        assert flags[2:5] == [qc.SUSPECT, qc.FAIL, qc.SUSPECT]
+        assert flags[7:13] == [qc.PASS] * 6
+        assert flags[13] == qc.SUSPECT and flags[19] == qc.FAIL
+        assert flags[-1] == qc.NOT_EVALUATED
+        assert qc.gross_range_test(np.array([7.0, 6.0, 15.0]), (0, 14), (6.5, 9.0)).tolist() == [1, 3, 4]
+        # other pH sensors, oxygen in other units and pH without a unit are tested too
+        oxygen = data.iloc[:3].assign(
+            raw_parameter="H4_Oxygen", parameter="oxygen_concentration", unit="micromol/kg",
+            value=[250.0, 260.0, 2000.0]
+        )
+        external = data.iloc[:3].assign(
+            raw_parameter="SeaFET_External_pH_1_recalc_w", parameter="pH_external", unit=np.nan, value=15.0
+        )
+        flags = qc.run_tests(pd.concat([oxygen, external], ignore_index=True)).tolist()
+        # 2000 micromol/kg is past the 30 mg/L sensor span, and spikes its neighbour
+        assert flags == [qc.PASS, qc.FAIL, qc.FAIL] + [qc.FAIL] * 3
+        nerrs = pd.Series(["<0>", "<1> (CSM)", "<-3> [GIC]", "<-2>", None, "<0>"])
+        assert qc.decode_nerrs_flags(nerrs).tolist() == [1, 3, 4, 9, 2, 1]
+
+    def test_qc_flags_keep_exceedances(self):
+        variable = "sea_water_ph_reported_on_total_scale"
+        dataset = pd.DataFrame({
+            "station": "tiburon-water-tibc1",
+            "station_id": "tiburon-water-tibc1",
+            "time (UTC)": pd.date_range("2022-01-01", periods=4, freq="1H", tz="UTC"),
+            "latitude (degrees_north)": 37.9,
+            "longitude (degrees_east)": -122.4,
+            "z (m)": 1.0,
+            f"{variable} (1)": [6.3, 6.2, 6.25, 7.9],
+            f"{variable}_qc_agg": [np.nan, np.nan, np.nan, qc.FAIL],
+            f"{variable}_qc_tests": np.nan,
+        })
+        data = ERDDAP("https://erddap.example.org/erddap/").standardize_data(dataset)
+        # below the pH criteria but physically valid, so only flagged, while
+        # the row the provider failed is removed
+        assert data["value"].tolist() == [6.3, 6.2, 6.25]
+        assert data["quality"].tolist() == [qc.SUSPECT] * 3
+
+    def test_derive_carbonate(self):
+        measured = {
+            "pH": (8.0458, "pH"),
+            "total_alkalinity": (2300.0, "micromol/kg"),
+            "salinity": (35.0, "PSU"),
+            "water_temperature": (25.0, "C"),
+        }
+        data = pd.DataFrame([
+            {"datetime": "2022-01-01T00:{:02d}:00Z".format(i), "station_id": "a", "depth": 1.0,
+             "parameter": parameter, "value": value, "unit": unit, "quality": 1}
+            for i, (parameter, (value, unit)) in enumerate(measured.items())
+        ])
+        # tco2 and alkalinity alone are solved for pH first
+        without_ph = data[data["parameter"] != "pH"].assign(station_id="b")
+        without_ph.loc[len(data)] = ["2022-01-01T00:00:00Z", "b", 1.0, "tco2", 2000.0, "micromol/kg", 3]
+        derived = carbonate.derive_carbonate(pd.concat([data, without_ph]))
+        a = derived[derived["station_id"] == "a"].set_index("parameter")
+        assert a.loc["tco2", "value"] == pytest.approx(2000, abs=0.5)
+        assert a.loc["omega_aragonite", "value"] == pytest.approx(3.38, abs=0.01)
+        assert a.loc["co2", "derived_from"] == "pH,total_alkalinity,salinity,water_temperature"
+        b = derived[derived["station_id"] == "b"].set_index("parameter")
+        assert "tco2" not in b.index and b.loc["co2", "quality"] == 3
+        assert b.loc["co2", "value"] == pytest.approx(a.loc["co2", "value"], rel=1e-3)
+
+    def test_align(self):
+        data = pd.DataFrame({
+            "datetime": ["2022-01-01T00:01:00Z", "2022-01-01T00:14:00Z", "2022-01-01T00:31:00Z",
+                         "2022-01-01T00:08:00Z", "2022-01-01T00:23:00Z", "2022-01-01T00:00:00Z"],
+            "station_id": ["a", "a", "a", "a", "a", "b"],
+            "depth": [1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
+            "parameter": ["pH", "pH", "pH", "salinity", "salinity", "salinity"],
+            "value": [8.0, 8.1, 8.2, 33.0, 34.0, 30.0],
+            "quality": [1, 1, 1, 3, 1, 1],
+        })
+        wide = align.align(data, frequency="15min", tolerance="5min")
+        assert wide["datetime"].dt.strftime("%H:%M").tolist() == ["00:00", "00:15", "00:30", "00:00"]
+        assert wide["pH"].tolist()[:3] == [8.0, 8.1, 8.2] and np.isnan(wide["pH"][3])
+        # 00:08 is too far from 00:00 and 00:15, 00:23 too far from 00:15 and 00:30
+        assert wide["salinity"].isna().tolist() == [True, True, True, False]
+        wide = align.align(data, frequency="15min")
+        # within 7.5 minutes by default, the nearer sample wins
+        assert wide["salinity"].tolist()[1:3] == [33.0, 34.0]
+        assert wide["quality_salinity"].tolist()[1:3] == [3, 1]
+
+    def test_remove_duplicates(self):
+        sample = {
+            "datetime": "2022-01-01T00:01:00Z", "latitude": 47.96, "longitude": -124.95,
+            "depth": 1.0, "depth_unit": "m", "parameter": "pH", "value": 8.01,
+        }
+        data = pd.DataFrame([
+            dict(sample, station_id="APL_Chaba"),
+            # the same sample through ERDDAP, in feet and a minute later
+            dict(sample, station_id="tiburon-water-tibc1", depth=3.0, depth_unit="ft", datetime="2022-01-01T00:02:00Z"),
+            dict(sample, station_id="APL_Chaba", value=8.3),
+        ])
+        fingerprints = dedup.fingerprints(data)
+        assert fingerprints[0] == fingerprints[1] != fingerprints[2]
+        kept = dedup.remove_duplicates(data)
+        assert kept["station_id"].tolist() == ["tiburon-water-tibc1", "APL_Chaba"]
+        # a metadata change of tiburon can change which APL_Chaba rows survive
+        changed = dedup.fingerprints(data[data["station_id"] == "tiburon-water-tibc1"])
+        assert dedup.sharing_stations(data, changed) == {"APL_Chaba", "tiburon-water-tibc1"}
+        assert dedup.sharing_stations(data.iloc[1:2], fingerprints[2:]) == set()
+
+    def test_spilled_frames(self, tmp_path):
+        rng = np.random.default_rng(0)
+        frames = [
+            pd.DataFrame({
+                "station_id": station,
+                "parameter": rng.choice(["pH", "salinity"], 1000),
+                "datetime": pd.Timestamp("2022-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 50, 1000), "h"),
+                "value": rng.random(1000),
+            })
+            for station in ["c", "a", "b"]
+        ]
+        # room for one frame
+        frame_size = frames[0].memory_usage(deep=True).sum()
+        data = spill.SpilledFrames(max_memory=1.5 * frame_size, directory=tmp_path)
+        for frame in frames:
+            data.append(frame)
+        assert data.spilled == 2
+        assert len(data) == 3000
+        assert data.station_ids() == ["a", "b", "c"]
+        pd.testing.assert_frame_equal(data.to_frame(), pd.concat(frames))
+        pd.testing.assert_frame_equal(data.select(["a"]), frames[1])
+        expected = pd.concat(frames).sort_values(extsort.SORT_COLUMNS, kind="mergesort")
+        chunks = extsort.sorted_chunks(data, memory_budget=100000, spill_directory=tmp_path)
+        pd.testing.assert_frame_equal(pd.concat(list(chunks)), expected)
+        halves = spill.apply(data, lambda frame: frame.iloc[:500])
+        assert len(halves) == 1500
+        assert spill.parse_size("4G") == 4 * 2**30
+        spill.cleanup(halves)
+        spill.cleanup(frames[0])
+        with spill.SpilledFrames(max_memory=0, directory=tmp_path) as spilled:
+            spilled.append(frames[0])
+            assert spilled.spilled == 1
+        assert not list(tmp_path.iterdir())
+
+    def test_service(self, tmp_path):
+        job = service.StateJob("California", tmp_path, window_days=2, every_hours=1)
+        now = datetime(2022, 1, 3)
+        assert job.collection_window(now) == (datetime(2022, 1, 1), datetime(2022, 1, 1))
+        first = pd.DataFrame({
+            "station_id": "a",
+            "parameter": "pH",
+            "depth": 0,
+            "datetime": pd.date_range("2022-01-01", periods=48, freq="1h"),
+            "value": 8.0,
+        })
+        # b failed, so it is collected over the whole window again
+        job.merge(first, datetime(2022, 1, 1), now, ["a"])
+        later = now + timedelta(hours=12)
+        fetch_start, start = job.collection_window(later, "a")
+        assert fetch_start == now - service.OVERLAP
+        assert job.collection_window(later, "b") == (start, start)
+        # the overlap is collected again with a corrected value
+        second = first.iloc[-6:].assign(value=7.9)
+        data = job.merge(second, start, later, ["a"])
+        assert len(data) == 36
+        assert data["value"].iloc[-1] == 7.9
+        assert job.collected_until == {"a": later}
+        # a run where every station failed keeps the warm data
+        assert len(job.merge(pd.DataFrame(), start, later + timedelta(hours=1))) == 36
+        assert job.collected_until == {"a": later}
+
+        runs = []
+        def run_job(job, now):
+            runs.append(job.state)
+            return {"rows": len(job.recent)}
+        running = service.Service({"California": job}, run_job, port=0)
+        server = running.start_server()
+        try:
+            assert service.trigger("California", running.port)["rows"] == 36
+            assert "error" in service.trigger("Oregon", running.port)
+        finally:
+            server.shutdown()
+        assert runs == ["California"]
+        assert not job.due(job.last_run + timedelta(minutes=30))
+        assert job.due(job.last_run + timedelta(hours=1))
+
+    def test_work_queue(self, tmp_path, monkeypatch):
+        stations = pd.DataFrame({"provider": ["NERRS", "IPACOA"]}, index=["a", "b"])
+        start, end = datetime(2022, 1, 1), datetime(2022, 3, 1)
+        assert workqueue.plan_jobs(tmp_path, stations, start, end, shard_days=30) == 4
+        lock = workqueue.claim(tmp_path, "000000", "w1")
+        assert lock is not None
+        assert workqueue.claim(tmp_path, "000000", "w2") is None
+        # a dead worker's claim is handed over once its lease expires
+        expired = time.time() - workqueue.LEASE.total_seconds() - 1
+        os.utime(lock, (expired, expired))
+        taken = workqueue.claim(tmp_path, "000000", "w2")
+        assert taken is not None and taken != lock
+        # the dead worker's claim is left in place, the newer one holds the job
+        assert lock.exists()
+        assert workqueue.claim(tmp_path, "000000", "w3") is None
+        # a running job renews its claim
+        monkeypatch.setattr(workqueue, "LEASE", timedelta(seconds=0.2))
+        os.utime(taken, (expired, expired))
+        with workqueue.renewing(taken):
+            time.sleep(0.15)
+        assert time.time() - taken.stat().st_mtime < 1
+        for path in lock.parent.iterdir():
+            path.unlink()
+        monkeypatch.undo()
+
+        def collect_job(job):
+            if job["station_id"] == "b" and job["start"] > start:
+                return None
+            # both shards return the sample at their boundary
+            times = pd.date_range(job["start"], job["end"], freq="1D")
+            return pd.DataFrame({
+                "station_id": job["station_id"], "parameter": "pH", "depth": 0,
+                "datetime": times, "value": 8.0,
+            })
+        assert workqueue.run_worker(tmp_path, collect_job, worker="w1") == 4
+        assert workqueue.run_worker(tmp_path, collect_job, worker="w2") == 0
+        assert workqueue.pending_jobs(tmp_path) == []
+        assert workqueue.merge_shards(tmp_path) == ["a"]
+        merged = checkpoint.load_checkpoint(tmp_path, "a")
+        assert len(merged) == (end - start).days + 1
+        assert merged["datetime"].is_unique
+        assert checkpoint.completed_stations(tmp_path) == {"a"}
+
+    def test_coverage_store(self, tmp_path):
+        store = coverage.CoverageStore(tmp_path)
+        start, end = datetime(2022, 1, 1), datetime(2022, 1, 31, 12)
+        assert store.gaps("a", start, end) == [(start, datetime(2022, 2, 1))]
+
+        def fetch(fetch_start, fetch_end, parameters):
+            times = pd.date_range(fetch_start, fetch_end, freq="6h")
+            return pd.concat([
+                pd.DataFrame({
+                    "station_id": "a", "parameter": parameter, "depth": 0,
+                    "datetime": times, "value": 8.0,
+                })
+                for parameter in parameters
+            ], ignore_index=True)
+        store.save("a", datetime(2022, 1, 10), datetime(2022, 1, 20), fetch(
+            datetime(2022, 1, 10), datetime(2022, 1, 20), ["pH", "salinity"]
+        ))
+        store.save("a", datetime(2022, 1, 20), datetime(2022, 2, 1), fetch(
+            datetime(2022, 1, 20), datetime(2022, 2, 1), ["pH"]
+        ), parameters=["pH"])
+        # reopened from disk
+        store = coverage.CoverageStore(tmp_path)
+        assert store.gaps("a", start, end, ["pH"]) == [(start, datetime(2022, 1, 10))]
+        assert store.gaps("a", start, end, ["pH", "salinity"]) == [
+            (start, datetime(2022, 1, 10)), (datetime(2022, 1, 20), datetime(2022, 2, 1))
+        ]
+        data = store.load("a", datetime(2022, 1, 15), datetime(2022, 1, 25), ["pH"])
+        # the sample at the boundary of both fetches is kept once
+        assert len(data) == 10 * 4 + 1
+        assert set(data["parameter"]) == {"pH"}
+        report = store.coverage(["a"], start, end, ["pH", "salinity"])
+        assert report["covered_days"].tolist() == [22, 10]
+        # days not over yet are stored but not marked covered
+        today = datetime.combine(datetime.now().date(), datetime.min.time())
+        store.save("b", today, today + coverage.DAY, pd.DataFrame())
+        assert store.gaps("b", today, today + timedelta(hours=1)) == [(today, today + coverage.DAY)]
+
+    def test_profile(self, tmp_path):
+        data = pd.DataFrame({
+            "station_id": ["a"] * 6 + ["b"] * 2,
+            "parameter": ["pH"] * 5 + ["salinity"] + ["pH"] * 2,
+            "depth": [0, 0, 0, 0, 1, 0, 0, 0],
+            "datetime": pd.to_datetime([
+                "2022-01-03", "2022-01-01", "2022-01-01", "2022-01-05", "2022-01-01",
+                "2022-01-01", "2022-01-01", "2022-01-01 01:00",
+            ], utc=True),
+            "value": [8.0, 7.0, 7.0, np.nan, 8.5, 30.0, 8.1, 8.2],
+            "quality": [qc.PASS, qc.PASS, qc.SUSPECT, None, "good", qc.PASS, qc.PASS, qc.FAIL],
+        })
+        profile = profiling.profile_data(data).set_index(["station_id", "parameter"])
+        ph = profile.loc[("a", "pH")]
+        assert (ph["rows"], ph["values"], ph["depths"]) == (5, 4, 2)
+        assert (ph["min"], ph["mean"], ph["max"]) == (7.0, 7.625, 8.5)
+        assert ph["last"] == pd.Timestamp("2022-01-05", tz="UTC")
+        # Jan 1 to 3 and 3 to 5 at depth 0, depth 1 has one sample
+        assert (ph["gaps"], ph["largest_gap_hours"], ph["duplicates"]) == (2, 48, 1)
+        assert (ph["flag_pass"], ph["flag_suspect"], ph["flag_other"], ph["flag_none"]) == (2, 1, 1, 1)
+        assert profile.loc[("b", "pH"), "flag_fail"] == 1
+        assert len(profile) == 3
+        profiling.write_profile(data, tmp_path)
+        assert len(pd.read_csv(tmp_path / profiling.PROFILE_FILE)) == 3
+        # a --max-memory run where every station failed
+        with spill.SpilledFrames(max_memory=0, directory=tmp_path) as nothing:
+            profile = pd.read_csv(profiling.write_profile(nothing, tmp_path))
+        assert profile.empty and "rows" in profile.columns
+
+    def test_table_spec(self, tmp_path):
+        data = pd.read_csv(HERE / "metadata" / "small_dataset.csv", index_col=0)
+        data["station_id"] = "test-ceden"
+        data.loc[data.index[:2], "unit"] = "inHg"
+        original = data.copy()
+        results = CEDEN(tmp_path).populate_field_results(data)
+        pd.testing.assert_frame_equal(data, original)
+        # constants and mapped columns are only expanded when written
+        assert isinstance(results["ProjectCode"], spec.Repeated)
+        assert isinstance(results["SampleDate"], spec.Lookup)
+        assert results.columns[:2] == ["StationCode", "SampleDate"]
+        assert "Elevation" not in results.columns
+        assert list(results["Result"][:2]) == list(original["value"][:2] / 0.0393701)
+        csvencode.write_csv(results, tmp_path / "results.csv")
+        written = pd.read_csv(tmp_path / "results.csv")
+        expanded = results.to_frame()
+        assert list(written.columns) == list(expanded.columns)
+        assert (written["ProjectCode"] == utils.ceden_field_misc["ProjectCode"]).all()
+        assert list(written["CollectionTime"]) == list(expanded["CollectionTime"])
+        assert list(written["Replicate"][:3]) == [1, 2, 3]
+        assert len(results.iloc[10:20]["MatrixName"].to_numpy()) == 10
@@ -1,9 +1,10 @@
 import collections
 import pytest
+import pandas as pd
 from datetime import datetime, timedelta
 
 from .ipacoa import IPACOA
-from .kingcounty import KingCounty
+from .kingcounty import KingCounty, TailReader, column_dtypes, is_used_column, selected_columns
 from .erddap import ERDDAP
 from .nerrs import NERRS
 class TestDataCollection():
@@ -38,6 +39,36 @@ class TestDataCollection():
         self.run_collector_tests(collector, station_id, self.month_prior, self.now)
 
 
+    def test_kingcounty_tail_reader(self):
+        class StreamedResponse():
+            encoding = "utf-8"
+            body = "<html>page</html>***END***Date\tSonde_pH\tChl_ug/L\n1/1/2022\t7.9\t4\n".encode()
+
+            def iter_content(self, chunk_size):
+                # small chunks so the marker is split between chunks
+                for i in range(0, len(self.body), 5):
+                    yield self.body[i:i + 5]
+
+        data = pd.read_csv(TailReader(StreamedResponse()), sep="\t", usecols=is_used_column)
+        assert list(data.columns) == ["Date", "Sonde_pH"]
+        assert data.loc[0, "Sonde_pH"] == 7.9
+        # depth prefixed Seattle Aquarium columns are parsed as numbers too
+        StreamedResponse.body = "***END***Date\t1_Sonde_pH\t2_Sonde_pH\n1/1/2022\t8\t\n".encode()
+        data = pd.read_csv(
+            TailReader(StreamedResponse()), sep="\t", usecols=is_used_column, dtype=column_dtypes()
+        )
+        assert data.dtypes.to_dict() == {"Date": object, "1_Sonde_pH": "float64", "2_Sonde_pH": "float64"}
+
+    def test_parameter_pushdown(self):
+        assert NERRS().param_list() == "*"
+        assert NERRS().param_list(["pH", "salinity"]) == "Sal,pH"
+        assert NERRS().request_count("elksmwq", ["tco2"]) == 0
+        selected = IPACOA().selected_measurements("APL_Chaba", ["pH"])
+        assert selected["measurement_label"].tolist() == ["H1_pH"]
+        columns = selected_columns(["oxygen_saturation"])
+        assert columns == ["station_id", "Date", "Qual_DO", "Dissolved_Oxygen_%Sat", "Depth_m"]
+        assert not is_used_column("1_Sonde_pH", columns)
+
     def run_collector_tests(self, collector, station_id, start, end):
         """ Runs get_data tests and asserts properly formed table """
         data = collector.get_data(station_id, start, end)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import pandas as pd
 
 # column names to be renamed before pivot to long format
 positional_column_mapping = {
@@ -15,6 +16,10 @@ positional_column_mapping = {
     "utcstamp": "datetime"
 }
 
+# rows of standardized data with equal values of these are the same
+# sample, collected twice
+sample_columns = ["station_id", "parameter", "depth", "datetime"]
+
 # parameter names to be renamed after pivot to long format
 parameter_dict = {
     "A1_AirTemp": "air_temperature",
@@ -138,3 +143,56 @@ ceden_datum_dict = {
     "Carlsbad Aquafarm": "NR",
     "CeNCOOS": "NR",
 }
+
+
+def raw_parameter_names(parameters) -> set:
+    """ Provider parameter names normalized to any of parameters
+
+    Args:
+        parameters: normalized names from parameter_dict, or None for all
+    Returns:
+        raw names to request from providers, None if parameters is None
+    """
+    if parameters is None:
+        return None
+    return {raw for raw, name in parameter_dict.items() if name in parameters}
+
+
+def thin_data(dataset: pd.DataFrame, minutes: int, time_column="datetime", by=None):
+    """ Keeps only the first record in each `minutes` wide time bucket
+
+    Cheap decimation applied right after a provider response is parsed, for
+    providers that cannot thin data server side.
+
+    Args:
+        dataset: wide or long table of records from a provider
+        minutes: width of time buckets in minutes
+        time_column: name of column containing record timestamps
+        by: additional columns that identify a series (e.g. depth)
+    Returns:
+        dataset with at most one row per series per time bucket
+    """
+    if not minutes or dataset.empty:
+        return dataset
+    times = pd.to_datetime(dataset[time_column], errors="coerce", utc=True)
+    keys = pd.DataFrame({"bucket": times.dt.floor("{}min".format(minutes)).values})
+    for column in by or []:
+        if column in dataset.columns:
+            keys[column] = dataset[column].values
+    return dataset[~keys.duplicated().values]
+
+
+def group_boundaries(*keys):
+    """ Sorts rows by integer keys and finds where each group of equal keys starts
+
+    Args:
+        keys: integer arrays of equal length, most significant first
+    Returns:
+        order: indices that sort rows by keys
+        starts: positions in sorted order where each group starts
+    """
+    order = np.lexsort(keys[::-1])
+    sorted_keys = np.column_stack(keys)[order]
+    change = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    starts = np.concatenate(([0], np.flatnonzero(change) + 1))
+    return order, starts
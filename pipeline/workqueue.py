@@ -0,0 +1,254 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+import pandas as pd
+from pipeline import checkpoint
+from pipeline import incremental
+from pipeline import utils
+
+QUEUE_DIRECTORY = "queue"
+SHARD_DIRECTORY = "shards"
+
+# a claim older than this without a result is taken to be from a dead
+# worker, and the job is handed to another
+LEASE = timedelta(hours=1)
+
+time_format = checkpoint.time_format
+
+
+def worker_id() -> str:
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def queue_directory(results_directory: Path, name: str) -> Path:
+    """ Subdirectory of the queue: 'jobs', 'claims', 'done' or 'logs' """
+    directory = Path(results_directory) / QUEUE_DIRECTORY / name
+    directory.mkdir(exist_ok=True, parents=True)
+    return directory
+
+
+def shard_windows(start_time: datetime, end_time: datetime, shard_days: float) -> list:
+    """ Consecutive (start, end) windows of at most shard_days covering the period """
+    windows = []
+    shard = timedelta(days=shard_days)
+    while start_time < end_time:
+        windows.append((start_time, min(start_time + shard, end_time)))
+        start_time += shard
+    return windows
+
+
+def plan_jobs(results_directory: Path, stations: pd.DataFrame, start_time, end_time, shard_days: float) -> int:
+    """ Writes one job per station and time shard to the queue of a run
+
+    Args:
+        results_directory: directory of the run, shared by all workers
+        stations: rows of stations.csv to collect, indexed by station_id
+        start_time, end_time: period of the run
+        shard_days: days of data collected by each job
+    Returns:
+        number of jobs written
+    """
+    # jobs and results of an earlier queue in the directory
+    for name in [QUEUE_DIRECTORY, SHARD_DIRECTORY]:
+        shutil.rmtree(Path(results_directory) / name, ignore_errors=True)
+    jobs = queue_directory(results_directory, "jobs")
+    number = 0
+    for station_id, row in stations.iterrows():
+        for shard_start, shard_end in shard_windows(start_time, end_time, shard_days):
+            job = {
+                "station_id": station_id,
+                "provider": row["provider"],
+                "start": shard_start.strftime(time_format),
+                "end": shard_end.strftime(time_format),
+            }
+            path = jobs / "{:06d}.json".format(number)
+            with open(path.with_suffix(".partial"), "w") as f:
+                json.dump(job, f, indent=2)
+            os.replace(path.with_suffix(".partial"), path)
+            number += 1
+    return number
+
+
+def load_job(path: Path) -> dict:
+    with open(path) as f:
+        job = json.load(f)
+    job["id"] = path.stem
+    job["start"] = datetime.strptime(job["start"], time_format)
+    job["end"] = datetime.strptime(job["end"], time_format)
+    return job
+
+
+def claim(results_directory: Path, job_id: str, worker: str) -> Path:
+    """ Atomically takes a job for worker
+
+    A claim is a lock file <job>.<generation>.lock created with O_EXCL,
+    which only one process can create, also over a shared filesystem. The
+    newest generation holds the job. A claim whose lock was not touched
+    for LEASE is taken over by creating the next generation, so of the
+    workers that see it expire only one gets the job, and no live claim is
+    ever moved or removed.
+
+    Returns:
+        path of the lock, to renew while the job runs, or None if the job
+        is claimed by another worker
+    """
+    claims = queue_directory(results_directory, "claims")
+    generations = [int(path.name.split(".")[1]) for path in claims.glob("{}.*.lock".format(job_id))]
+    generation = 0
+    if generations:
+        latest = claims / "{}.{}.lock".format(job_id, max(generations))
+        try:
+            if time.time() - latest.stat().st_mtime < LEASE.total_seconds():
+                return None
+        except FileNotFoundError:
+            return None
+        generation = max(generations) + 1
+    lock = claims / "{}.{}.lock".format(job_id, generation)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # another worker claimed it first
+        return None
+    with os.fdopen(fd, "w") as f:
+        f.write(worker)
+    if generation:
+        logging.warning(f"Claim of job {job_id} expired, taking it over")
+    return lock
+
+
+@contextmanager
+def renewing(lock: Path):
+    """ Touches a claim every quarter LEASE until the block exits, so long jobs keep it """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(LEASE.total_seconds() / 4):
+            try:
+                os.utime(lock)
+            except OSError:
+                logging.warning(f"Could not renew claim {lock.name}", exc_info=True)
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield lock
+    finally:
+        stop.set()
+        thread.join()
+
+
+def is_done(results_directory: Path, job_id: str) -> bool:
+    return (queue_directory(results_directory, "done") / "{}.json".format(job_id)).exists()
+
+
+def pending_jobs(results_directory: Path) -> list:
+    """ Paths of jobs without a result, in planned order """
+    return [
+        path for path in sorted(queue_directory(results_directory, "jobs").glob("*.json"))
+        if not is_done(results_directory, path.stem)
+    ]
+
+
+def shard_path(results_directory: Path, job: dict) -> Path:
+    directory = Path(results_directory) / SHARD_DIRECTORY / str(job["station_id"])
+    directory.mkdir(exist_ok=True, parents=True)
+    return directory / "{}.pkl".format(job["id"])
+
+
+def finish(results_directory: Path, job: dict, status: str, data: pd.DataFrame = None, **details):
+    """ Saves a job's standardized data and marks it done """
+    if data is not None:
+        checkpoint.write_atomic(data, shard_path(results_directory, job))
+    done = queue_directory(results_directory, "done") / "{}.json".format(job["id"])
+    with open(done.with_suffix(".partial"), "w") as f:
+        json.dump({"status": status, "rows": None if data is None else len(data), **details}, f, indent=2)
+    os.replace(done.with_suffix(".partial"), done)
+
+
+def run_worker(results_directory: Path, collect_job, worker: str = None) -> int:
+    """ Claims and runs jobs of the queue until none are left
+
+    Any number of workers, on any host sharing results_directory, can run
+    at once.
+
+    Args:
+        results_directory: directory of a run planned with plan_jobs
+        collect_job: callable taking a job dict (station_id, provider,
+            start and end) and returning its standardized data, or None
+            if the provider failed
+        worker: name written to claims, defaults to host and process id
+    Returns:
+        number of jobs this worker ran
+    """
+    worker = worker or worker_id()
+    ran = 0
+    for path in pending_jobs(results_directory):
+        job = load_job(path)
+        if is_done(results_directory, job["id"]):
+            continue
+        lock = claim(results_directory, job["id"], worker)
+        if lock is None:
+            continue
+        logging.info(f"{worker} collecting job {job['id']}: {job['station_id']} {job['start']} to {job['end']}")
+        started = time.perf_counter()
+        try:
+            with renewing(lock):
+                data = collect_job(job)
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed", exc_info=True)
+            finish(results_directory, job, "error", error=repr(e), worker=worker)
+        else:
+            finish(
+                results_directory, job, "ok" if data is not None else "failed", data,
+                worker=worker, seconds=round(time.perf_counter() - started, 2)
+            )
+        ran += 1
+    return ran
+
+
+def merge_shards(results_directory: Path) -> list:
+    """ Combines the shards of each station into the run's checkpoints
+
+    Only stations whose jobs all succeeded get a checkpoint. Others are
+    left to be collected when the run is resumed. Samples at the boundary
+    of two shards, returned by both, are kept once.
+
+    Returns:
+        ids of the stations merged
+    """
+    station_jobs = {}
+    for path in sorted(queue_directory(results_directory, "jobs").glob("*.json")):
+        job = load_job(path)
+        station_jobs.setdefault(job["station_id"], []).append(job)
+    completed = checkpoint.completed_stations(results_directory)
+    merged = []
+    for station_id, jobs in station_jobs.items():
+        if station_id in completed:
+            continue
+        results = []
+        for job in jobs:
+            done = queue_directory(results_directory, "done") / "{}.json".format(job["id"])
+            if not done.exists():
+                break
+            with open(done) as f:
+                if json.load(f)["status"] != "ok":
+                    break
+            results.append(pd.read_pickle(shard_path(results_directory, job)))
+        else:
+            data = pd.concat(results, ignore_index=True)
+            if not data.empty:
+                keys = [column for column in utils.sample_columns if column in data.columns]
+                data = data.drop_duplicates(subset=keys, keep="last")
+            checkpoint.save_checkpoint(results_directory, station_id, data)
+            incremental.save_fingerprints(results_directory, [station_id])
+            merged.append(station_id)
+            continue
+        logging.warning(f"Jobs of {station_id} did not all succeed, it will be collected again")
+    return merged
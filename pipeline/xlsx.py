@@ -0,0 +1,121 @@
+import zipfile
+from xml.sax.saxutils import quoteattr
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pipeline import csvencode
+from pipeline import spec
+
+# rows encoded and written at once
+BLOCK_ROWS = 50000
+
+# rows per sheet allowed by Excel, with the header
+MAX_ROWS = 1048576
+
+# zip entries are dated to the zip epoch, so equal tables give equal files
+ENTRY_DATE = (1980, 1, 1, 0, 0, 0)
+
+# characters XML 1.0 does not allow
+ILLEGAL_CHARACTERS = "[\x00-\x08\x0b\x0c\x0e-\x1f]"
+
+MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+RELATIONSHIPS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+
+def encode_cells(values: pd.Series) -> pa.Array:
+    """ Spreadsheet cell of each value, an empty cell where it is missing """
+    if isinstance(values, spec.LazyColumn):
+        return values.encode(encode_cells)
+    if values.dtype.kind == "f":
+        # a cell can't hold infinity
+        values = values.where(np.isfinite(values))
+    text = csvencode.column_text(values)
+    if csvencode.is_numeric(values):
+        cells = pc.binary_join_element_wise("<c><v>", text, "</v></c>", "")
+    else:
+        text = pc.replace_substring_regex(text, ILLEGAL_CHARACTERS, "")
+        for character, entity in [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")]:
+            text = pc.replace_substring(text, character, entity)
+        cells = pc.binary_join_element_wise(
+            '<c t="inlineStr"><is><t xml:space="preserve">', text, "</t></is></c>", ""
+        )
+    return pc.fill_null(cells, "<c/>")
+
+
+def encode_rows(table: pd.DataFrame) -> bytes:
+    """ Sheet rows of every row of table """
+    if table.empty:
+        return b""
+    cells = csvencode.broadcast([encode_cells(table[column]) for column in table.columns], len(table))
+    return csvencode.concatenate(pc.binary_join_element_wise("<row>", *cells, "</row>\n", ""))
+
+
+def _entry(name: str) -> zipfile.ZipInfo:
+    entry = zipfile.ZipInfo(name, date_time=ENTRY_DATE)
+    entry.compress_type = zipfile.ZIP_DEFLATED
+    return entry
+
+
+def write_sheet(archive: zipfile.ZipFile, name: str, table: pd.DataFrame):
+    """ Streams table into a sheet of the archive, a block of rows at a time """
+    if len(table) >= MAX_ROWS:
+        raise ValueError("Table has more rows than an Excel sheet holds")
+    header = pd.DataFrame([[str(column) for column in table.columns]], dtype=object)
+    with archive.open(_entry(name), "w", force_zip64=True) as f:
+        f.write((XML_HEADER + '<worksheet xmlns="{}"><sheetData>\n'.format(MAIN)).encode())
+        f.write(encode_rows(header))
+        for start in range(0, len(table), BLOCK_ROWS):
+            f.write(encode_rows(table.iloc[start:start + BLOCK_ROWS]))
+        f.write(b"</sheetData></worksheet>")
+
+
+def write_workbook(handle, sheets: dict):
+    """ Writes tables as the sheets of one xlsx workbook
+
+    Cells are encoded in bulk like csvencode and each sheet is streamed
+    into the zip in blocks, so memory stays constant however many rows
+    there are. Text is stored inline, numbers as numbers.
+
+    Args:
+        handle: path or binary file
+        sheets: sheet name -> table, in sheet order
+    """
+    names = list(sheets)
+    with zipfile.ZipFile(handle, "w") as archive:
+        for number, name in enumerate(names, 1):
+            write_sheet(archive, "xl/worksheets/sheet{}.xml".format(number), sheets[name])
+        archive.writestr(_entry("[Content_Types].xml"), XML_HEADER + (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + "".join(
+                '<Override PartName="/xl/worksheets/sheet{}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'.format(number)
+                for number in range(1, len(names) + 1)
+            ) + "</Types>"
+        ))
+        archive.writestr(_entry("_rels/.rels"), XML_HEADER + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="{}/officeDocument" Target="xl/workbook.xml"/>'
+            "</Relationships>".format(RELATIONSHIPS)
+        ))
+        archive.writestr(_entry("xl/workbook.xml"), XML_HEADER + (
+            '<workbook xmlns="{}" xmlns:r="{}"><sheets>'.format(MAIN, RELATIONSHIPS)
+            + "".join(
+                '<sheet name={} sheetId="{}" r:id="rId{}"/>'.format(quoteattr(name), number, number)
+                for number, name in enumerate(names, 1)
+            ) + "</sheets></workbook>"
+        ))
+        archive.writestr(_entry("xl/_rels/workbook.xml.rels"), XML_HEADER + (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(
+                '<Relationship Id="rId{}" Type="{}/worksheet" Target="worksheets/sheet{}.xml"/>'.format(
+                    number, RELATIONSHIPS, number
+                )
+                for number in range(1, len(names) + 1)
+            ) + "</Relationships>"
+        ))